@@ -20,14 +20,32 @@ import os
 import traceback
 import logging
 import time
-import datetime
 import math
+import threading
+import json
+import hashlib
+import bisect
+import socket
+import re
+import collections
+import contextlib
+import functools
+import random
+from concurrent import futures
+from urllib.parse import urlsplit
+
+from requests import adapters
+import requests
+from requests.packages.urllib3.connection import HTTPConnection
+from requests.packages.urllib3 import connectionpool
 
 from inmanta.execute import proxy, util
 from inmanta.resources import resource, PurgeableResource, ManagedResource
 from inmanta import resources
 from inmanta.agent import handler
 from inmanta.agent.handler import provider, SkipResource, cache, ResourcePurged, CRUDHandler
+from inmanta.agent.cache import AgentCache
+from inmanta import const
 from inmanta.export import dependency_manager
 from inmanta.plugins import plugin
 
@@ -39,6 +57,7 @@ import novaclient.exceptions
 
 from keystoneauth1.identity import v3
 from keystoneauth1 import session
+from keystoneauth1.exceptions import Unauthorized, ConnectFailure, ConnectTimeout
 from keystoneclient.v3 import client as keystone_client
 
 from glanceclient import client as glance_client
@@ -48,14 +67,802 @@ try:
 except ImportError:
     from keystoneclient.openstack.common.apiclient.exceptions import NotFound
 
-# silence a logger
-loud_logger = logging.getLogger("requests.packages.urllib3.connectionpool")
-loud_logger.propagate = False
+# only report problems with the connection pool, such as a full pool
+loud_logger = connectionpool.log
+loud_logger.setLevel(logging.WARNING)
 
 
 LOGGER = logging.getLogger(__name__)
 
 
+DEFAULT_SESSION_OPTIONS = {"pool_size": 10, "keepalive": True, "gzip": True, "connect_timeout": 10, "read_timeout": 60,
+                           "token_cache": False, "rate_limit": 0, "rate_burst": 10, "max_inflight": 20,
+                           "throttle_retries": 5}
+THROTTLE_STATUS = (429, 503)
+THROTTLE_BACKOFF = 0.5
+THROTTLE_MAX_DELAY = 30
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+TOKEN_DIR = os.environ.get("INMANTA_OPENSTACK_TOKEN_DIR",
+                           os.path.join(os.path.expanduser("~"), ".cache", "inmanta", "openstack", "tokens"))
+TOKEN_REFRESH_MARGIN = 300
+
+
+class TokenCache(object):
+    """
+        Stores the keystone token of a user and project in a file that is only readable by the current user, so the next
+        process that logs in with the same credentials can reuse the token until it expires.
+    """
+    def __init__(self, auth_url, username, project):
+        key = "|".join([auth_url, username, project]).encode()
+        self.path = os.path.join(TOKEN_DIR, hashlib.sha256(key).hexdigest())
+
+    def load(self):
+        """
+            Return the stored authentication state if it remains valid for more than TOKEN_REFRESH_MARGIN seconds
+        """
+        try:
+            with open(self.path, "r") as fd:
+                data = json.load(fd)
+        except (IOError, ValueError):
+            return None
+
+        if data["expires_at"] - time.time() < TOKEN_REFRESH_MARGIN:
+            return None
+
+        return data["state"]
+
+    def store(self, state, expires_at):
+        try:
+            os.makedirs(TOKEN_DIR, mode=0o700, exist_ok=True)
+            tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as fh:
+                json.dump({"expires_at": expires_at, "state": state}, fh)
+
+            os.rename(tmp_path, self.path)
+        except OSError:
+            LOGGER.warning("Unable to store keystone token in %s", self.path, exc_info=True)
+
+
+class CachedPassword(v3.Password):
+    """
+        Password authentication that starts from the token in the token cache and stores every new token in it. A token
+        is renewed in the background TOKEN_REFRESH_MARGIN seconds before it expires.
+    """
+    def __init__(self, token_cache, **kwargs):
+        super().__init__(**kwargs)
+        self._token_cache = token_cache
+        self._scheduled = None
+
+        state = token_cache.load()
+        if state is not None:
+            self.set_auth_state(state)
+
+    def get_access(self, session, **kwargs):
+        access = super().get_access(session, **kwargs)
+        if access is not self._scheduled:
+            self._scheduled = access
+            expires_at = access.expires.timestamp()
+            self._token_cache.store(self.get_auth_state(), expires_at)
+
+            timer = threading.Timer(max(expires_at - time.time() - TOKEN_REFRESH_MARGIN, 0), self._refresh, (session,))
+            timer.daemon = True
+            timer.start()
+
+        return access
+
+    def _refresh(self, session):
+        try:
+            self.auth_ref = self.get_auth_ref(session)
+            self.get_access(session)
+        except Exception:
+            LOGGER.warning("Unable to renew the keystone token in the background", exc_info=True)
+
+
+METRICS_FILE = os.environ.get("INMANTA_OPENSTACK_METRICS_FILE", "")
+TRACE_FILE = os.environ.get("INMANTA_OPENSTACK_TRACE_FILE", "")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+API_IDS = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|[0-9a-f]{32}|(?<=/)[0-9]+(?=/|$)")
+API_LOCAL = threading.local()
+
+
+def api_operation(method, url):
+    """
+        The operation of an API request: its method and its path with the ids replaced by {id}
+    """
+    return "%s %s" % (method, API_IDS.sub("{id}", urlsplit(url).path))
+
+
+class ApiSummary(object):
+    """
+        The API requests made for one resource, per service and operation
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def add(self, service, operation, status, duration):
+        with self._lock:
+            entry = self._operations.setdefault("%s %s" % (service, operation), {"count": 0, "errors": 0, "seconds": 0.0})
+            entry["count"] += 1
+            entry["seconds"] += duration
+            if not status.startswith(("2", "3")):
+                entry["errors"] += 1
+
+    def log(self, ctx):
+        with self._lock:
+            operations = {name: dict(entry, seconds=round(entry["seconds"], 3)) for name, entry in self._operations.items()}
+
+        if len(operations) == 0:
+            return
+
+        slowest = max(operations, key=lambda name: operations[name]["seconds"])
+        ctx.info("Made %(count)d API requests in %(seconds).3f seconds, most time was spent in %(slowest)s",
+                 count=sum(entry["count"] for entry in operations.values()),
+                 seconds=sum(entry["seconds"] for entry in operations.values()), slowest=slowest, operations=operations)
+
+
+class ApiContext(object):
+    """
+        The labels of the API requests made by a thread: the provider, the type and id of the resource it works on and
+        the phase of the handler. All threads that work on the same resource share the summary of its requests.
+    """
+    def __init__(self, provider="", resource_type="", phase="", summary=None, resource_id=""):
+        self.provider = provider
+        self.resource_type = resource_type
+        self.phase = phase
+        self.summary = summary
+        self.resource_id = resource_id
+
+    def child(self, **labels):
+        values = dict(provider=self.provider, resource_type=self.resource_type, phase=self.phase, summary=self.summary,
+                      resource_id=self.resource_id)
+        values.update(labels)
+        return ApiContext(**values)
+
+
+NO_API_CONTEXT = ApiContext()
+
+
+def current_api_context():
+    return getattr(API_LOCAL, "context", NO_API_CONTEXT)
+
+
+@contextlib.contextmanager
+def api_context(context):
+    """
+        Label the API requests made by this thread with the given context
+    """
+    previous = current_api_context()
+    API_LOCAL.context = context
+    try:
+        yield context
+    finally:
+        API_LOCAL.context = previous
+
+
+def in_api_context(function):
+    """
+        Wrap function so it labels its API requests with the context of the calling thread when it runs in another thread
+    """
+    context = current_api_context()
+
+    @functools.wraps(function)
+    def call(*args, **kwargs):
+        with api_context(context):
+            return function(*args, **kwargs)
+
+    return call
+
+
+class ApiMetrics(object):
+    """
+        Counters and latency histograms of the OpenStack API requests of this process and the hits and misses of the
+        caches of the handlers, labeled with the provider, resource type and handler phase they were made for. The
+        metrics are exported in the Prometheus text format.
+    """
+    labels = ("provider", "resource_type", "phase")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = collections.Counter()
+        self._retries = collections.Counter()
+        self._latency = {}
+        self._cache = collections.Counter()
+        self._handler_retries = collections.Counter()
+
+    def observe(self, service, method, url, status, duration, retry=False):
+        context = current_api_context()
+        operation = api_operation(method, url)
+        key = (context.provider, context.resource_type, context.phase, service, operation)
+        with self._lock:
+            self._requests[key + (status,)] += 1
+            if retry:
+                self._retries[key] += 1
+
+            histogram = self._latency.get(key)
+            if histogram is None:
+                histogram = self._latency[key] = [0] * len(LATENCY_BUCKETS) + [0.0, 0]
+
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if duration <= bound:
+                    histogram[i] += 1
+
+            histogram[-2] += duration
+            histogram[-1] += 1
+
+        if context.summary is not None:
+            context.summary.add(service, operation, status, duration)
+
+    def handler_retry(self, operation, reason):
+        context = current_api_context()
+        with self._lock:
+            self._handler_retries[(context.provider, context.resource_type, context.phase, operation, reason)] += 1
+
+    def cache_access(self, cache_name, hit):
+        context = current_api_context()
+        with self._lock:
+            self._cache[(context.provider, context.resource_type, context.phase, cache_name, "hit" if hit else "miss")] += 1
+
+    @staticmethod
+    def _format(names, values, extra=""):
+        labels = ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                          for name, value in zip(names, values))
+        if extra != "":
+            labels = labels + "," + extra if labels != "" else extra
+
+        return "{%s}" % labels
+
+    def render(self):
+        """
+            Render the metrics in the Prometheus text exposition format
+        """
+        request_labels = self.labels + ("service", "operation")
+        with self._lock:
+            requests = sorted(self._requests.items())
+            retries = sorted(self._retries.items())
+            latency = sorted((key, list(histogram)) for key, histogram in self._latency.items())
+            cache_accesses = sorted(self._cache.items())
+            handler_retries = sorted(self._handler_retries.items())
+
+        lines = ["# HELP openstack_api_requests_total The number of OpenStack API requests by response status",
+                 "# TYPE openstack_api_requests_total counter"]
+        for key, count in requests:
+            lines.append("openstack_api_requests_total%s %d" % (self._format(request_labels + ("status",), key), count))
+
+        lines += ["# HELP openstack_api_retries_total The number of OpenStack API requests that were sent again",
+                  "# TYPE openstack_api_retries_total counter"]
+        for key, count in retries:
+            lines.append("openstack_api_retries_total%s %d" % (self._format(request_labels, key), count))
+
+        lines += ["# HELP openstack_api_request_duration_seconds The latency of OpenStack API requests",
+                  "# TYPE openstack_api_request_duration_seconds histogram"]
+        for key, histogram in latency:
+            for bound, count in zip(LATENCY_BUCKETS, histogram):
+                lines.append("openstack_api_request_duration_seconds_bucket%s %d" %
+                             (self._format(request_labels, key, 'le="%s"' % bound), count))
+
+            lines.append("openstack_api_request_duration_seconds_bucket%s %d" %
+                         (self._format(request_labels, key, 'le="+Inf"'), histogram[-1]))
+            labels = self._format(request_labels, key)
+            lines.append("openstack_api_request_duration_seconds_sum%s %f" % (labels, histogram[-2]))
+            lines.append("openstack_api_request_duration_seconds_count%s %d" % (labels, histogram[-1]))
+
+        lines += ["# HELP openstack_handler_retries_total The number of operations the handlers retried, by the kind of error",
+                  "# TYPE openstack_handler_retries_total counter"]
+        for key, count in handler_retries:
+            lines.append("openstack_handler_retries_total%s %d" %
+                         (self._format(self.labels + ("operation", "reason"), key), count))
+
+        lines += ["# HELP openstack_cache_requests_total The number of lookups in the caches of the handlers",
+                  "# TYPE openstack_cache_requests_total counter"]
+        for key, count in cache_accesses:
+            lines.append("openstack_cache_requests_total%s %d" % (self._format(self.labels + ("cache", "result"), key), count))
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+            Write the metrics to a file, for example for the textfile collector of the Prometheus node exporter
+        """
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "w") as fd:
+            fd.write(self.render())
+
+        os.rename(tmp_path, path)
+
+
+API_METRICS = ApiMetrics()
+
+
+def write_api_metrics():
+    if METRICS_FILE != "":
+        try:
+            API_METRICS.write(METRICS_FILE)
+        except OSError:
+            LOGGER.warning("Unable to write the API metrics to %s", METRICS_FILE, exc_info=True)
+
+
+class ApiTrace(object):
+    """
+        A trace of the handlers and their API requests in the Chrome trace event format, which can be opened in
+        chrome://tracing or Perfetto. Every span is written as a complete event as soon as it ends, to the array of events
+        that the file of the first span of this process starts. The format allows the array to be left open, so the
+        trace of a run that is interrupted can still be opened.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._path = None
+        self._threads = set()
+        self._pid = os.getpid()
+
+    def add(self, name, category, start, end, args):
+        thread = threading.current_thread()
+        events = []
+        if thread.ident not in self._threads:
+            events.append({"name": "thread_name", "ph": "M", "pid": self._pid, "tid": thread.ident,
+                           "args": {"name": thread.name}})
+
+        events.append({"name": name, "cat": category, "ph": "X", "ts": int(start * 1000000),
+                       "dur": int((end - start) * 1000000), "pid": self._pid, "tid": thread.ident, "args": args})
+
+        lines = "".join(json.dumps(event, default=str) + ",\n" for event in events)
+        with self._lock:
+            if self._path != TRACE_FILE:
+                self._path = TRACE_FILE
+                self._threads = set()
+                lines = "[\n" + lines
+                mode = "w"
+            else:
+                mode = "a"
+
+            self._threads.add(thread.ident)
+            try:
+                with open(self._path, mode) as fd:
+                    fd.write(lines)
+            except OSError:
+                LOGGER.warning("Unable to write the trace to %s", self._path, exc_info=True)
+
+
+API_TRACE = ApiTrace()
+
+
+@contextlib.contextmanager
+def trace_span(name, category, **args):
+    """
+        Trace the block as a span with the given name when INMANTA_OPENSTACK_TRACE_FILE is set. The span is labeled with
+        the id of the resource the thread works on. The block can add arguments to the dict it gets.
+    """
+    if TRACE_FILE == "":
+        yield args
+        return
+
+    resource_id = current_api_context().resource_id
+    if resource_id != "":
+        args.setdefault("resource_id", resource_id)
+
+    start = time.time()
+    try:
+        yield args
+    finally:
+        API_TRACE.add(name, category, start, time.time(), args)
+
+
+class ProviderSession(session.Session):
+    """
+        A keystone session that labels the API requests made through it with the type of the service they are sent to.
+        Every attempt to send a request after the first is counted as a retry.
+    """
+    def request(self, url, method, **kwargs):
+        endpoint_filter = kwargs.get("endpoint_filter") or {}
+        frames = API_LOCAL.__dict__.setdefault("requests", [])
+        frames.append({"service": endpoint_filter.get("service_type", "identity"), "attempts": 0})
+        try:
+            return super().request(url, method, **kwargs)
+        finally:
+            frames.pop()
+
+
+def parse_retry_after(value):
+    """
+        The number of seconds in a Retry-After header, or None when it is missing or a date
+    """
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class ApiLimiter(object):
+    """
+        Limits the API requests of a provider with a token bucket that allows rate requests per second with bursts of
+        burst requests, and limits the number of requests in flight with an additive increase, multiplicative decrease
+        window of at most max_inflight requests. Every request that is answered without throttling widens the window by
+        1/window, so it grows by one request per round trip. A throttled response halves the window once for all requests
+        that were in flight when it was sent and, when it has a Retry-After header, holds all requests back for that long.
+        A rate or max_inflight of 0 disables that limit.
+    """
+    def __init__(self, rate=0, burst=10, max_inflight=0):
+        self._cond = threading.Condition()
+        self._rate = float(rate)
+        self._burst = max(float(burst), 1.0)
+        self._tokens = self._burst
+        self._updated = time.time()
+        self._max_inflight = float(max_inflight)
+        self.window = self._max_inflight
+        self._inflight = 0
+        self._decreased = 0
+        self._blocked_until = 0
+
+    def _delay(self, now):
+        if self._blocked_until > now:
+            return self._blocked_until - now
+
+        if self._max_inflight > 0 and self._inflight >= int(self.window):
+            # woken up when a request completes
+            return THROTTLE_MAX_DELAY
+
+        if self._rate > 0:
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens < 1:
+                return (1 - self._tokens) / self._rate
+
+        return 0
+
+    def acquire(self):
+        """
+            Wait until a request may be sent and return the number of seconds that took
+        """
+        start = time.time()
+        with self._cond:
+            delay = self._delay(start)
+            while delay > 0:
+                self._cond.wait(delay)
+                delay = self._delay(time.time())
+
+            if self._rate > 0:
+                self._tokens -= 1
+
+            self._inflight += 1
+
+        return time.time() - start
+
+    def release(self, sent, throttled=False, retry_after=None, success=True):
+        """
+            Register the outcome of a request that was sent at the given time
+        """
+        with self._cond:
+            self._inflight -= 1
+            if throttled:
+                if self._max_inflight > 0 and sent >= self._decreased:
+                    self.window = max(self.window / 2, 1.0)
+                    self._decreased = time.time()
+                    LOGGER.debug("The API throttled a request, reducing the requests in flight to %d", self.window)
+
+                if retry_after is not None:
+                    self._blocked_until = max(self._blocked_until, time.time() + retry_after)
+
+            elif success and self._max_inflight > 0 and self.window < self._max_inflight:
+                self.window = min(self.window + 1 / self.window, self._max_inflight)
+
+            self._cond.notify_all()
+
+
+class ProviderHTTPAdapter(adapters.HTTPAdapter):
+    """
+        An HTTP adapter that applies the timeouts of the provider to requests that do not set their own timeout and
+        enables TCP keepalive on the pooled connections. The status and latency of every request are recorded in the API
+        metrics. Requests wait for the limiter of the provider before they are sent and requests that are throttled with
+        a 429 or 503 response are sent again, at most throttle_retries times.
+    """
+    def __init__(self, timeout=None, keepalive=True, limiter=None, throttle_retries=0, **kwargs):
+        self._timeout = timeout
+        self._keepalive = keepalive
+        self._limiter = limiter if limiter is not None else ApiLimiter()
+        self._throttle_retries = throttle_retries
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self._keepalive:
+            kwargs["socket_options"] = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+        super().init_poolmanager(*args, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self._timeout
+
+        frames = getattr(API_LOCAL, "requests", None)
+        frame = frames[-1] if frames else {"service": "unknown", "attempts": 0}
+        retries = 0
+        while True:
+            response = self._send(request, frame, timeout, **kwargs)
+            if response.status_code not in THROTTLE_STATUS or retries >= self._throttle_retries:
+                return response
+
+            # a Retry-After holds back all requests in the limiter, without it only this request backs off
+            retries += 1
+            response.close()
+            if parse_retry_after(response.headers.get("Retry-After")) is None:
+                time.sleep(min(THROTTLE_BACKOFF * 2 ** (retries - 1), THROTTLE_MAX_DELAY))
+
+    def _send(self, request, frame, timeout, **kwargs):
+        frame["attempts"] += 1
+        queued = self._limiter.acquire()
+        with trace_span(api_operation(request.method, request.url), "http", service=frame["service"],
+                        url=request.url, attempt=frame["attempts"], queued=queued) as span:
+            start = time.time()
+            status = "error"
+            response = None
+            try:
+                response = super().send(request, timeout=timeout, **kwargs)
+                status = str(response.status_code)
+                span["request_id"] = response.headers.get("x-openstack-request-id",
+                                                          response.headers.get("x-compute-request-id"))
+                return response
+            finally:
+                throttled = response is not None and response.status_code in THROTTLE_STATUS
+                self._limiter.release(start, throttled,
+                                      parse_retry_after(response.headers.get("Retry-After")) if throttled else None,
+                                      success=response is not None and response.status_code < 500)
+                span["status"] = status
+                API_METRICS.observe(frame["service"], request.method, request.url, status, time.time() - start,
+                                    retry=frame["attempts"] > 1)
+
+
+def get_session_options(provider):
+    """
+        The options of the HTTP session of a provider
+    """
+    return {"pool_size": provider.http_pool_size, "keepalive": provider.http_keepalive, "gzip": provider.http_gzip,
+            "connect_timeout": provider.http_connect_timeout, "read_timeout": provider.http_read_timeout,
+            "token_cache": provider.token_cache, "rate_limit": provider.http_rate_limit,
+            "rate_burst": provider.http_rate_burst, "max_inflight": provider.http_max_inflight,
+            "throttle_retries": provider.http_throttle_retries}
+
+
+def get_retry_policy(provider):
+    """
+        The options of the retry policy of the handlers of a provider
+    """
+    return {"attempts": provider.retry_attempts, "base_delay": provider.retry_base_delay,
+            "max_delay": provider.retry_max_delay}
+
+
+def get_provider_session(auth_url, project, username, password, options=None):
+    """
+        Get the keystone session for the given credentials. All API clients that use the same credentials in this process
+        share this session, its pool of HTTP connections and the limiter of its requests.
+    """
+    options = dict(DEFAULT_SESSION_OPTIONS, **(options or {}))
+    # the password is only kept in the authentication plugin of the session, not in its key
+    digest = hashlib.sha256("\0".join([auth_url, project, username, password]).encode()).hexdigest()
+    key = (auth_url, project, username, digest, tuple(sorted(options.items())))
+    with SESSIONS_LOCK:
+        if key not in SESSIONS:
+            # the sessions of a previous password of this user can no longer authenticate
+            for old_key in [k for k in SESSIONS if k[:3] == key[:3] and k[3] != digest]:
+                del SESSIONS[old_key]
+
+            http = requests.Session()
+            limiter = ApiLimiter(options["rate_limit"], options["rate_burst"], options["max_inflight"])
+            adapter = ProviderHTTPAdapter(timeout=(options["connect_timeout"], options["read_timeout"]),
+                                          keepalive=options["keepalive"], limiter=limiter,
+                                          throttle_retries=int(options["throttle_retries"]),
+                                          pool_connections=int(options["pool_size"]), pool_maxsize=int(options["pool_size"]))
+            http.mount("https://", adapter)
+            http.mount("http://", adapter)
+            http.headers["Accept-Encoding"] = "gzip, deflate" if options["gzip"] else "identity"
+            if not options["keepalive"]:
+                http.headers["Connection"] = "close"
+
+            auth_options = dict(auth_url=auth_url, username=username, password=password, project_name=project,
+                                user_domain_id="default", project_domain_id="default")
+            if options["token_cache"]:
+                auth = CachedPassword(TokenCache(auth_url, username, project), **auth_options)
+            else:
+                auth = v3.Password(**auth_options)
+
+            SESSIONS[key] = ProviderSession(auth=auth, session=http)
+
+        return SESSIONS[key]
+
+
+CATALOG_DIR = os.environ.get("INMANTA_OPENSTACK_CATALOG_DIR",
+                             os.path.join(os.path.expanduser("~"), ".cache", "inmanta", "openstack"))
+IMAGE_PAGE_SIZE = 100
+IMAGE_FIELDS = ("id", "name", "os_distro", "os_version", "updated_at")
+CATALOGS = {}
+CATALOGS_LOCK = threading.Lock()
+
+
+def run_in_background(function, name):
+    """
+        Call function in a daemon thread and return a future for its result. A slow or unreachable API does not keep the
+        process from exiting.
+    """
+    future = futures.Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            future.set_result(function())
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return future
+
+
+class Catalog(object):
+    """
+        The images and flavors of a provider. The catalog is stored on disk so that compiles can use it without querying
+        the API until it is older than the ttl. An expired catalog is still used while it is refreshed in the background.
+        In offline mode the catalog on disk is always used and the API is never queried.
+    """
+    def __init__(self, name, connection_url, username, password, tenant, ttl, offline, session_options=None):
+        self.name = name
+        self._connection_url = connection_url
+        self._username = username
+        self._password = password
+        self._tenant = tenant
+        self._ttl = ttl
+        self._offline = offline
+        self._session_options = session_options
+
+        key = "|".join([name, connection_url, username, tenant]).encode()
+        self.path = os.path.join(CATALOG_DIR, "%s.json" % hashlib.sha1(key).hexdigest())
+        self._future = None
+
+    def _fetch(self):
+        with api_context(ApiContext(provider=self.name, phase="catalog")):
+            try:
+                return self._fetch_catalog()
+            finally:
+                write_api_metrics()
+
+    def _fetch_catalog(self):
+        sess = get_provider_session(self._connection_url, self._tenant, self._username, self._password,
+                                    self._session_options)
+
+        # glance filters the public images and the result is streamed page per page, only keeping the images and the
+        # attributes find_image can use
+        images = []
+        for image in glance_client.Client("2", session=sess).images.list(filters={"visibility": "public"},
+                                                                          page_size=IMAGE_PAGE_SIZE):
+            if "image_location" not in image and "os_distro" in image and "os_version" in image:
+                images.append({key: image[key] for key in IMAGE_FIELDS})
+
+        flavors = [{"id": flavor.id, "name": flavor.name, "vcpus": flavor.vcpus, "ram": flavor.ram,
+                    "extra_specs": flavor.get_keys()}
+                   for flavor in nova_client.Client("2.1", session=sess).flavors.list()]
+
+        return {"timestamp": time.time(), "images": images, "flavors": flavors}
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as fd:
+                return json.load(fd)
+        except (IOError, ValueError):
+            return None
+
+    def _write(self, catalog):
+        os.makedirs(CATALOG_DIR, exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp_path, "w") as fd:
+            json.dump(catalog, fd, default=str)
+
+        os.rename(tmp_path, self.path)
+
+    def refresh(self):
+        catalog = self._fetch()
+        try:
+            self._write(catalog)
+        except OSError:
+            LOGGER.warning("Unable to store the catalog of provider %s in %s", self.name, self.path, exc_info=True)
+
+        return catalog
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception:
+            LOGGER.warning("Unable to refresh the catalog of provider %s", self.name, exc_info=True)
+
+    def start(self):
+        """
+            Make the catalog available, fetching it in the background when required
+        """
+        catalog = self._read()
+        fresh = catalog is not None and (self._offline or time.time() - catalog["timestamp"] < self._ttl)
+        with api_context(ApiContext(provider=self.name, phase="catalog")):
+            API_METRICS.cache_access("catalog", fresh)
+
+        if fresh:
+            self._future = futures.Future()
+            self._future.set_result(catalog)
+
+        elif self._offline:
+            self._future = futures.Future()
+            self._future.set_exception(Exception("No catalog of provider %s available in %s while in offline mode" %
+                                                 (self.name, CATALOG_DIR)))
+
+        elif catalog is not None:
+            self._future = futures.Future()
+            self._future.set_result(catalog)
+            run_in_background(self._refresh_in_background, "openstack-catalog")
+
+        else:
+            self._future = run_in_background(self.refresh, "openstack-catalog")
+
+    def get(self):
+        return self._future.result()
+
+
+def get_catalog(provider):
+    """
+        Get the catalog of the given provider. The first call for a provider starts loading it.
+    """
+    with CATALOGS_LOCK:
+        if provider.name not in CATALOGS:
+            offline = provider.catalog_offline or os.environ.get("INMANTA_OPENSTACK_OFFLINE", "") != ""
+            catalog = Catalog(provider.name, provider.connection_url, provider.username, provider.password,
+                              provider.tenant, provider.catalog_ttl, offline, get_session_options(provider))
+            catalog.start()
+            CATALOGS[provider.name] = catalog
+
+        return CATALOGS[provider.name]
+
+
+@plugin
+def prefetch_catalog(provider: "openstack::Provider"):
+    """
+        Start loading the image and flavor catalog of the provider in the background, so the catalogs of all providers
+        in the model are fetched concurrently before they are used by find_image and find_flavor.
+    """
+    try:
+        get_catalog(provider)
+    except proxy.UnknownException:
+        pass
+
+
+class ImageIndex(object):
+    """
+        The public images of a provider grouped on os_distro and os_version, with the most recent image first. The image
+        that is selected for an os and name is remembered.
+    """
+    def __init__(self, images):
+        self._images = {}
+        for image in images:
+            if "image_location" in image or image.get("visibility", "public") != "public" or \
+               "os_distro" not in image or "os_version" not in image:
+                continue
+
+            key = (image["os_distro"].lower(), image["os_version"].lower())
+            self._images.setdefault(key, []).append(image)
+
+        # the timestamps are ISO 8601 formatted, so they sort chronologically as strings
+        for image_list in self._images.values():
+            image_list.sort(key=lambda x: x["updated_at"], reverse=True)
+
+        self._selected = {}
+
+    def find(self, os_distro, os_version, name=None):
+        key = (os_distro.lower(), str(os_version).lower(), name)
+        if key not in self._selected:
+            self._selected[key] = None
+            for image in self._images.get(key[:2], []):
+                if name is None or name in image["name"]:
+                    self._selected[key] = image["id"]
+                    break
+
+        return self._selected[key]
+
+
 IMAGES = {}
 
 @plugin
@@ -73,29 +880,62 @@ def find_image(provider: "openstack::Provider", os: "std::OS", name: "string"=No
     """
     global IMAGES
     if provider.name not in IMAGES:
-        auth = v3.Password(auth_url=provider.connection_url, username=provider.username,
-                           password=provider.password, project_name=provider.tenant,
-                           user_domain_id="default", project_domain_id="default")
-        sess = session.Session(auth=auth)
-        client = glance_client.Client("2", session=sess)
-
-        IMAGES[provider.name] = list(client.images.list())
-
-    selected = (datetime.datetime(1900, 1, 1), None)
-    for image in IMAGES[provider.name]:
-        # only images that are public
-        if ("image_location" not in image and image["visibility"] == "public") and \
-           ("os_distro" in image and "os_version" in image) and \
-           (image["os_distro"].lower() == os.name.lower() and image["os_version"].lower() == str(os.version).lower()) and \
-           (name is None or name in image["name"]):
-            t = datetime.datetime.strptime(image["updated_at"], "%Y-%m-%dT%H:%M:%SZ")
-            if t > selected[0]:
-                selected = (t, image)
-
-    if len(selected) < 2 or selected[1]["id"] is None:
+        IMAGES[provider.name] = ImageIndex(get_catalog(provider).get()["images"])
+
+    image_id = IMAGES[provider.name].find(os.name, os.version, name)
+    if image_id is None:
         raise Exception("No image found for os %s and version %s" % (os.name, os.version))
 
-    return selected[1]["id"]
+    return image_id
+
+class FlavorIndex(object):
+    """
+        The flavors of a provider split in pinned and unpinned flavors and sorted on (vcpus, ram). The flavor that is
+        selected for a combination of vcpus, ram and pinning is remembered.
+    """
+    def __init__(self, flavors):
+        self._flavors = {True: [], False: []}
+        for position, flavor in enumerate(flavors):
+            keys = flavor["extra_specs"]
+            is_pinned = "hw:cpu_policy" in keys and keys["hw:cpu_policy"] == "dedicated"
+            # the position in the catalog makes sure ties are resolved in the same way as a scan of the catalog
+            self._flavors[is_pinned].append((flavor["vcpus"], flavor["ram"] / 1024, position, flavor))
+
+        for flavor_list in self._flavors.values():
+            flavor_list.sort(key=lambda x: x[:3])
+
+        self._vcpus = {pinned: [x[0] for x in flavor_list] for pinned, flavor_list in self._flavors.items()}
+        self._selected = {}
+
+    def find(self, vcpus, ram, pinned):
+        """
+            Find the flavor that has at least the requested vcpus and ram (in gigabyte) and is the closest to it.
+        """
+        key = (vcpus, ram, bool(pinned))
+        if key not in self._selected:
+            self._selected[key] = self._find(vcpus, ram, bool(pinned))
+
+        return self._selected[key]
+
+    def _find(self, vcpus, ram, pinned):
+        selected = (1000000, 0, None)
+        start = bisect.bisect_left(self._vcpus[pinned], vcpus)
+        for flavor_vcpus, flavor_ram, position, flavor in self._flavors[pinned][start:]:
+            d_cpu = flavor_vcpus - vcpus
+            if d_cpu > selected[0]:
+                # the flavors are sorted on vcpus, so all remaining flavors are further away
+                break
+
+            d_ram = flavor_ram - ram
+            if d_ram < 0:
+                continue
+
+            distance = math.sqrt(math.pow(d_cpu, 2) + math.pow(d_ram, 2))
+            if (distance, position) < selected[:2]:
+                selected = (distance, position, flavor)
+
+        return selected[2]
+
 
 FLAVORS = {}
 
@@ -110,32 +950,18 @@ def find_flavor(provider: "openstack::Provider", vcpus: "number", ram: "number",
     """
     global FLAVORS
     if provider.name not in FLAVORS:
-        auth = v3.Password(auth_url=provider.connection_url, username=provider.username,
-                           password=provider.password, project_name=provider.tenant,
-                           user_domain_id="default", project_domain_id="default")
-        sess = session.Session(auth=auth)
-        client = nova_client.Client("2.1", session=sess)
-
-        FLAVORS[provider.name] = list(client.flavors.list())
+        FLAVORS[provider.name] = FlavorIndex(get_catalog(provider).get()["flavors"])
 
-    selected = (1000000, None)
-    for flavor in FLAVORS[provider.name]:
-        keys = flavor.get_keys()
-        is_pinned = "hw:cpu_policy" in keys and keys["hw:cpu_policy"] == "dedicated"
-        if is_pinned ^ pinned:
-            continue
+    flavor = FLAVORS[provider.name].find(vcpus, ram, pinned)
+    if flavor is None:
+        raise Exception("No flavor found with at least %s vcpus and %s GB ram (pinned=%s)" % (vcpus, ram, pinned))
 
-        d_cpu = flavor.vcpus - vcpus
-        d_ram = (flavor.ram / 1024) - ram
-        distance = math.sqrt(math.pow(d_cpu, 2) + math.pow(d_ram, 2))
-        if d_cpu >= 0 and d_ram >= 0 and distance < selected[0]:
-                selected = (distance, flavor)
-
-    return selected[1].name
+    return flavor["name"]
 
 
 class OpenstackResource(PurgeableResource, ManagedResource):
-    fields = ("project", "admin_user", "admin_password", "admin_tenant", "auth_url")
+    fields = ("project", "admin_user", "admin_password", "admin_tenant", "auth_url", "use_inventory", "max_concurrency",
+              "session_options", "retry_policy")
 
     @staticmethod
     def get_project(exporter, resource):
@@ -157,6 +983,22 @@ class OpenstackResource(PurgeableResource, ManagedResource):
     def get_auth_url(exporter, resource):
         return resource.provider.connection_url
 
+    @staticmethod
+    def get_use_inventory(exporter, resource):
+        return resource.provider.use_inventory
+
+    @staticmethod
+    def get_max_concurrency(exporter, resource):
+        return resource.provider.max_concurrency
+
+    @staticmethod
+    def get_session_options(exporter, resource):
+        return get_session_options(resource.provider)
+
+    @staticmethod
+    def get_retry_policy(exporter, resource):
+        return get_retry_policy(resource.provider)
+
 
 @resource("openstack::VirtualMachine", agent="provider.name", id_attribute="name")
 class VirtualMachine(OpenstackResource):
@@ -304,40 +1146,45 @@ class SecurityGroup(OpenstackResource):
     """
         A security group in an OpenStack tenant
     """
-    fields = ("name", "description", "manage_all", "rules", "retries", "wait")
+    fields = ("name", "description", "manage_all", "rules", "rules_digest", "retries", "wait")
 
     @staticmethod
-    def get_rules(exporter, group):
-        rules = []
-        dedup = set()
-        for rule in group.rules:
-            json_rule = {"protocol": rule.ip_protocol,
-                         "direction": rule.direction}
+    def _json_rule(rule):
+        json_rule = {"protocol": rule.ip_protocol,
+                     "direction": rule.direction}
 
-            if rule.port > 0:
-                json_rule["port_range_min"] = rule.port
-                json_rule["port_range_max"] = rule.port
+        if rule.port > 0:
+            json_rule["port_range_min"] = rule.port
+            json_rule["port_range_max"] = rule.port
 
-            else:
-                json_rule["port_range_min"] = rule.port_min
-                json_rule["port_range_max"] = rule.port_max
+        else:
+            json_rule["port_range_min"] = rule.port_min
+            json_rule["port_range_max"] = rule.port_max
 
-            if json_rule["port_range_min"] == 0:
-                json_rule["port_range_min"] = None
+        if json_rule["port_range_min"] == 0:
+            json_rule["port_range_min"] = None
 
-            if json_rule["port_range_max"] == 0:
-                json_rule["port_range_max"] = None
+        if json_rule["port_range_max"] == 0:
+            json_rule["port_range_max"] = None
 
-            try:
-                json_rule["remote_ip_prefix"] = rule.remote_prefix
-            except Exception:
-                pass
+        try:
+            json_rule["remote_ip_prefix"] = rule.remote_prefix
+        except Exception:
+            pass
 
-            try:
-                json_rule["remote_group"] = rule.remote_group.name
-            except Exception:
-                pass
+        try:
+            json_rule["remote_group"] = rule.remote_group.name
+        except Exception:
+            pass
+
+        return json_rule
 
+    @staticmethod
+    def get_rules(exporter, group):
+        rules = []
+        dedup = set()
+        for rule in group.rules:
+            json_rule = SecurityGroup._json_rule(rule)
             key = tuple(sorted(json_rule.items()))
             if key not in dedup:
                 dedup.add(key)
@@ -347,6 +1194,14 @@ class SecurityGroup(OpenstackResource):
 
         return rules
 
+    @staticmethod
+    def get_rules_digest(exporter, group):
+        """
+            A digest of the set of rules that does not depend on the order of the rules in the model
+        """
+        keys = set(tuple(sorted(SecurityGroup._json_rule(rule).items())) for rule in group.rules)
+        return hashlib.sha256(json.dumps(sorted(keys, key=repr)).encode()).hexdigest()[:16]
+
 
 @resource("openstack::FloatingIP", agent="provider.name", id_attribute="name")
 class FloatingIP(OpenstackResource):
@@ -365,7 +1220,8 @@ class FloatingIP(OpenstackResource):
 
 
 class KeystoneResource(PurgeableResource, ManagedResource):
-    fields = ("admin_token", "url", "admin_user", "admin_password", "admin_tenant", "auth_url")
+    fields = ("admin_token", "url", "admin_user", "admin_password", "admin_tenant", "auth_url", "max_concurrency",
+              "session_options", "retry_policy")
 
     @staticmethod
     def get_admin_token(_, resource):
@@ -391,6 +1247,18 @@ class KeystoneResource(PurgeableResource, ManagedResource):
     def get_auth_url(exporter, resource):
         return resource.provider.connection_url
 
+    @staticmethod
+    def get_max_concurrency(exporter, resource):
+        return resource.provider.max_concurrency
+
+    @staticmethod
+    def get_session_options(exporter, resource):
+        return get_session_options(resource.provider)
+
+    @staticmethod
+    def get_retry_policy(exporter, resource):
+        return get_retry_policy(resource.provider)
+
 
 @resource("openstack::Project", agent="provider.name", id_attribute="name")
 class Project(KeystoneResource):
@@ -409,7 +1277,11 @@ class User(KeystoneResource):
     """
         A user in keystone
     """
-    fields = ("name", "email", "enabled", "password")
+    fields = ("name", "email", "enabled", "password", "password_check_ttl")
+
+    @staticmethod
+    def get_password_check_ttl(exporter, resource):
+        return resource.provider.password_check_ttl
 
 
 @resource("openstack::Role", agent="provider.name", id_attribute="role_id")
@@ -444,143 +1316,1220 @@ class EndPoint(KeystoneResource):
     fields = ("region", "internal_url", "public_url", "admin_url", "service_id")
 
 
-@dependency_manager
-def openstack_dependencies(config_model, resource_model):
-    projects = {}
-    networks = {}
-    routers = {}
-    subnets = {}
-    vms = {}
-    ports = {}
-    fips = {}
-    sgs = {}
-    router_map = {}
-
-    for _, res in resource_model.items():
-        if res.id.entity_type == "openstack::Project":
-            projects[res.name] = res
+class ResourceIndex(object):
+    """
+        An index on the exported resources of this module, built in a single pass over the resource model. Resources are
+        keyed on their type, provider, project and name, so resources with the same name in different providers or
+        projects do not collide. Projects are indexed under their own name and keystone resources without a project
+        under None.
+    """
+    def __init__(self, resource_model):
+        self._resources = {}
+        self._index = {}
+        self._names = {}
+        for res in resource_model.values():
+            entity_type = res.id.entity_type
+            if not entity_type.startswith("openstack::"):
+                continue
+
+            self._resources.setdefault(entity_type, []).append(res)
+            name = getattr(res, "name", None)
+            if name is None:
+                continue
+
+            provider = res.id.agent_name
+            project = name if entity_type == "openstack::Project" else getattr(res, "project", None)
+            self._index[(entity_type, provider, project, name)] = res
+            self._names.setdefault((entity_type, provider, name), []).append(res)
+
+    def resources(self, entity_type):
+        """
+            All resources of the given type
+        """
+        return self._resources.get(entity_type, [])
+
+    def get(self, entity_type, provider, project, name):
+        """
+            Get the resource of the given type with the given name in a project of a provider
+        """
+        return self._index.get((entity_type, provider, project, name))
+
+    def find(self, entity_type, provider, project, name):
+        """
+            Get the resource with the given name in the project or, when the project does not have a resource with this
+            name, the only resource with this name in the provider. Shared resources such as external networks are
+            usually defined in another project than the resources that use them.
+        """
+        res = self.get(entity_type, provider, project, name)
+        if res is None:
+            candidates = self._names.get((entity_type, provider, name), [])
+            if len(candidates) == 1:
+                return candidates[0]
+
+        return res
+
+    def project(self, provider, name):
+        return self.get("openstack::Project", provider, name, name)
 
-        elif res.id.entity_type == "openstack::Network":
-            networks[res.name] = res
 
-        elif res.id.entity_type == "openstack::Router":
-            routers[res.name] = res
+RESOURCE_INDEX = [None, None]
 
-        elif res.id.entity_type == "openstack::Subnet":
-            subnets[res.name] = res
 
-        elif res.id.entity_type == "openstack::VirtualMachine":
-            vms[res.name] = res
+def get_resource_index(resource_model):
+    """
+        Get the index of the given resource model. The index is built once per export and shared by all dependency
+        managers of this module.
+    """
+    if RESOURCE_INDEX[0] is not resource_model:
+        RESOURCE_INDEX[:] = [resource_model, ResourceIndex(resource_model)]
+
+    return RESOURCE_INDEX[1]
 
-        elif res.id.entity_type == "openstack::HostPort":
-            ports[res.name] = res
 
-        elif res.id.entity_type == "openstack::FloatingIP":
-            fips[res.name] = res
+def _require(res, dependency):
+    if dependency is not None:
+        res.requires.add(dependency)
 
-        elif res.id.entity_type == "openstack::SecurityGroup":
-            sgs[res.name] = res
+
+def openstack_dependencies(config_model, resource_model):
+    index = get_resource_index(resource_model)
+    router_map = {}
 
     # they require the tenant to exist
-    for network in networks.values():
-        if network.model.project.name in projects:
-            network.requires.add(projects[network.model.project.name])
+    for network in index.resources("openstack::Network"):
+        provider = network.id.agent_name
+        _require(network, index.project(provider, network.project))
 
-    for router in routers.values():
-        if router.model.project.name in projects:
-            router.requires.add(projects[router.model.project.name])
+    for router in index.resources("openstack::Router"):
+        provider = router.id.agent_name
+        _require(router, index.project(provider, router.project))
 
         # depend on the attached subnets
         for subnet_name in router.subnets:
-            if subnet_name in subnets:
-                router.requires.add(subnets[subnet_name])
+            _require(router, index.find("openstack::Subnet", provider, router.project, subnet_name))
 
             # create external/subnet mapping
-            router_map[(router.gateway, subnet_name)] = router
+            router_map[(provider, router.project, router.gateway, subnet_name)] = router
+
+        if router.gateway != "":
+            _require(router, index.find("openstack::Network", provider, router.project, router.gateway))
+
+    for subnet in index.resources("openstack::Subnet"):
+        provider = subnet.id.agent_name
+        _require(subnet, index.project(provider, subnet.project))
+
+        # also require the network it is attached to
+        _require(subnet, index.find("openstack::Network", provider, subnet.project, subnet.network))
+
+    for vm in index.resources("openstack::VirtualMachine"):
+        provider = vm.id.agent_name
+        _require(vm, index.project(provider, vm.project))
+
+        for port in vm.ports:
+            _require(vm, index.find("openstack::Subnet", provider, vm.project, port["network"]))
+
+        for sg in vm.security_groups:
+            _require(vm, index.find("openstack::SecurityGroup", provider, vm.project, sg))
+
+    for port in index.resources("openstack::HostPort"):
+        provider = port.id.agent_name
+        _require(port, index.project(provider, port.project))
+        _require(port, index.find("openstack::Subnet", provider, port.project, port.subnet))
+        _require(port, index.get("openstack::VirtualMachine", provider, port.project, port.host))
+
+    for fip in index.resources("openstack::FloatingIP"):
+        provider = fip.id.agent_name
+        _require(fip, index.find("openstack::Network", provider, fip.project, fip.external_network))
+
+        port = index.get("openstack::HostPort", provider, fip.project, fip.port)
+        if port is not None:
+            fip.requires.add(port)
+
+            # find router on which this floating ip is added
+            _require(fip, router_map.get((provider, fip.project, fip.external_network, port.subnet)))
+
+
+def keystone_dependencies(config_model, resource_model):
+    index = get_resource_index(resource_model)
+    for role in index.resources("openstack::Role"):
+        provider = role.id.agent_name
+        project = index.project(provider, role.project)
+        if project is None:
+            raise Exception("The project %s of role %s is not defined in the model." % (role.project, role.role_id))
+
+        user = index.get("openstack::User", provider, None, role.user)
+        if user is None:
+            raise Exception("The user %s of role %s is not defined in the model." % (role.user, role.role_id))
+
+        role.requires.add(project)
+        role.requires.add(user)
+
+
+# registered without the decorator syntax, so the functions stay available on the module for the benchmarks
+dependency_manager(openstack_dependencies)
+dependency_manager(keystone_dependencies)
+
+CRED_TIMEOUT = 600
+RESOURCE_TIMEOUT = 10
+INVENTORY_TIMEOUT = 300
+DEFAULT_CONCURRENCY = 10
+WORKER_PREFIX = "openstack-worker"
+HANDLER_PHASES = ("pre", "read_resource", "_diff", "create_resource", "update_resource", "delete_resource", "post", "facts")
+RULE_BATCH_SIZE = 500
+RULES_MARKER = re.compile(r"^(?P<description>.*?) ?\[rules (?P<digest>[0-9a-f]+)@(?P<revision>\d+)\]$", re.DOTALL)
+SERVER_INDEX_AGE = 10
+WAIT_MIN_INTERVAL = 1
+WAIT_MAX_INTERVAL = 16
+WAIT_QUERY_CHUNK = 50
+PORT_DELETE_TIMEOUT = 60
+PROJECT_TTL = 300
+PASSWORD_CHECK_TTL = 600
+FACTS_TTL = 5
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8
+RETRYABLE_STATUS = (502, 504)
+
+
+class NeutronInventory(object):
+    """
+        A snapshot of the neutron resources of a provider. Each type of resource is fetched with a single list call the
+        first time it is used and indexed on the attributes the handlers use to look them up. Handlers that change
+        resources in neutron patch the snapshot or invalidate a type so it is fetched again.
+    """
+    kinds = ("networks", "subnets", "ports", "routers", "security_groups", "floatingips")
+    indexes = ("id", "name", "device_id", "network_id", "port_id")
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._items = {}
+        self._index = {}
+
+    def _load(self, neutron, kind):
+        self._install(kind, getattr(neutron, "list_" + kind)()[kind])
+
+    def _install(self, kind, items):
+        self._items[kind] = {}
+        self._index[kind] = {key: {} for key in self.indexes}
+        for item in items:
+            self._add(kind, item)
+
+    def prefetch(self, neutron, kinds=None):
+        """
+            Fetch all kinds, or the given kinds, that are not loaded yet with concurrent list calls
+        """
+        with self._lock:
+            kinds = [kind for kind in (kinds or self.kinds) if kind not in self._items]
+
+        if len(kinds) == 0:
+            return
+
+        with futures.ThreadPoolExecutor(max_workers=len(kinds)) as executor:
+            results = executor.map(in_api_context(lambda kind: getattr(neutron, "list_" + kind)()[kind]), kinds)
+
+        with self._lock:
+            for kind, items in zip(kinds, results):
+                if kind not in self._items:
+                    self._install(kind, items)
+
+    def _add(self, kind, item):
+        self._items[kind][item["id"]] = item
+        for key in self.indexes:
+            if key in item:
+                self._index[kind][key].setdefault(item[key], {})[item["id"]] = item
+
+    def _remove(self, kind, item_id):
+        item = self._items[kind].pop(item_id, None)
+        if item is None:
+            return
+
+        for key in self.indexes:
+            if key in item:
+                self._index[kind][key].get(item[key], {}).pop(item_id, None)
+
+    def list(self, neutron, kind, **filters):
+        """
+            Return all resources of the given kind of which the attributes match the given filters.
+        """
+        # the neutron client drops query parameters without a value
+        filters = {k: v for k, v in filters.items() if v is not None}
+        with self._lock:
+            API_METRICS.cache_access("inventory_" + kind, kind in self._items)
+            if kind not in self._items:
+                self._load(neutron, kind)
+
+            candidates = None
+            for key in self.indexes:
+                if key in filters:
+                    candidates = self._index[kind][key].get(filters[key], {}).values()
+                    break
+
+            if candidates is None:
+                candidates = self._items[kind].values()
+
+            return [item for item in candidates if all(item.get(k) == v for k, v in filters.items())]
+
+    def put(self, kind, item):
+        """
+            Add a new resource or replace the current version of an existing resource.
+        """
+        with self._lock:
+            if kind not in self._items:
+                return
+
+            self._remove(kind, item["id"])
+            self._add(kind, item)
+
+    def remove(self, kind, item_id):
+        with self._lock:
+            if kind in self._items:
+                self._remove(kind, item_id)
+
+    def discard(self, kind, **filters):
+        """
+            Remove all resources of the given kind that match the filters
+        """
+        with self._lock:
+            if kind not in self._items:
+                return
+
+            for item in self.list(None, kind, **filters):
+                self._remove(kind, item["id"])
+
+    def invalidate(self, kind):
+        """
+            Drop all resources of the given kind. They are fetched again the next time they are used.
+        """
+        with self._lock:
+            self._items.pop(kind, None)
+            self._index.pop(kind, None)
+
+
+class FactsCollector(object):
+    """
+        The neutron ports, subnets and floating ips of a provider, fetched with one bulk list call per type, from which
+        the handlers compute the facts of virtual machines, host ports, subnets and floating ips when the inventory is
+        enabled, such as in a batch of collect_facts. The snapshot is taken again when it is older than ttl seconds, so
+        the facts of all resources that are collected in the same round cost three list calls. Lookups that find nothing
+        in the snapshot are sent to neutron, so a resource that was created after the snapshot was taken is not missed.
+    """
+    indexes = {"ports": ("id", "name", "device_id"), "subnets": ("id", "name"), "floatingips": ("port_id",)}
+
+    def __init__(self, ttl=FACTS_TTL):
+        self._lock = threading.Lock()
+        self._ttl = ttl
+        self._loaded = None
+        self._index = {}
+
+    def refresh(self, neutron):
+        """
+            Take a new snapshot when the current one is older than the ttl
+        """
+        with self._lock:
+            fresh = self._loaded is not None and time.time() - self._loaded < self._ttl
+            API_METRICS.cache_access("facts", fresh)
+            if fresh:
+                return
+
+            loaded = time.time()
+            kinds = list(self.indexes)
+            with futures.ThreadPoolExecutor(max_workers=len(kinds)) as executor:
+                results = executor.map(in_api_context(lambda kind: getattr(neutron, "list_" + kind)()[kind]), kinds)
+
+            self._index = {}
+            for kind, items in zip(kinds, results):
+                index = self._index[kind] = {key: {} for key in self.indexes[kind]}
+                for item in items:
+                    for key in self.indexes[kind]:
+                        index[key].setdefault(item.get(key), []).append(item)
+
+            self._loaded = loaded
+
+    def find(self, neutron, kind, key, value):
+        """
+            Return the resources of the given kind of which the attribute key has the given value
+        """
+        with self._lock:
+            items = self._index.get(kind, {}).get(key, {}).get(value, [])
+
+        if len(items) > 0:
+            return list(items)
+
+        return getattr(neutron, "list_" + kind)(**{key: value})[kind]
+
+    def expire(self):
+        with self._lock:
+            self._loaded = None
+
+
+class ServerIndex(object):
+    """
+        An index on the name and id of the nova servers of a project. After the initial listing of all servers, the index
+        is kept up to date by only requesting the servers that changed since the last refresh.
+    """
+    def __init__(self, search_opts=None):
+        self._search_opts = search_opts or {}
+        self._lock = threading.RLock()
+        self._by_id = {}
+        self._by_name = {}
+        self._changes_since = None
+        self._refreshed = None
+
+    def refresh(self, nova, max_age=SERVER_INDEX_AGE):
+        """
+            Update the index when it was refreshed more than max_age seconds ago
+        """
+        with self._lock:
+            fresh = self._refreshed is not None and time.time() - self._refreshed < max_age
+            API_METRICS.cache_access("server_index", fresh)
+            if fresh:
+                return
+
+            search_opts = dict(self._search_opts)
+            if self._changes_since is not None:
+                search_opts["changes-since"] = self._changes_since
+
+            refreshed = time.time()
+            # nova returns at most osapi_max_limit servers per request, a limit of -1 makes the client fetch all pages
+            for server in nova.servers.list(search_opts=search_opts, limit=-1):
+                self._remove(server.id)
+                # changes-since also returns the servers that have been deleted
+                if server.status not in ("DELETED", "SOFT_DELETED"):
+                    self._by_id[server.id] = server
+                    self._by_name.setdefault(server.name, {})[server.id] = server
+
+                if self._changes_since is None or server.updated > self._changes_since:
+                    self._changes_since = server.updated
+
+            self._refreshed = refreshed
+
+    def _remove(self, server_id):
+        server = self._by_id.pop(server_id, None)
+        if server is not None:
+            self._by_name.get(server.name, {}).pop(server_id, None)
+
+    def find(self, nova, name=None, server_id=None, max_age=SERVER_INDEX_AGE):
+        """
+            Return a list of all servers with the given name or id
+        """
+        self.refresh(nova, max_age)
+        with self._lock:
+            if server_id is not None:
+                return [self._by_id[server_id]] if server_id in self._by_id else []
+
+            return list(self._by_name.get(name, {}).values())
+
+    def remove(self, server_id):
+        with self._lock:
+            self._remove(server_id)
+
+    def expire(self):
+        """
+            Make sure the next lookup fetches the changes from nova
+        """
+        with self._lock:
+            self._refreshed = None
+
+
+class SecurityGroupMap(object):
+    """
+        Maps the id of the security groups of a provider to their name and back. The map is loaded with a single list call
+        and is shared by all security group handlers of the provider.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._names = None
+        self._ids = None
+
+    def _load(self, neutron):
+        self._names = {}
+        self._ids = {}
+        for group in neutron.list_security_groups(fields=["id", "name"])["security_groups"]:
+            self._add(group)
+
+    def _add(self, group):
+        self._names[group["id"]] = group["name"]
+        self._ids.setdefault(group["name"], group["id"])
+
+    def _lookup(self, neutron, mapping, key, **query):
+        with self._lock:
+            if self._names is None:
+                self._load(neutron)
+
+            API_METRICS.cache_access("security_groups", key in mapping())
+            if key not in mapping():
+                # the group may have been created after the map was loaded
+                for group in neutron.list_security_groups(fields=["id", "name"], **query)["security_groups"]:
+                    self._add(group)
+
+            return mapping().get(key)
+
+    def get_name(self, neutron, group_id):
+        return self._lookup(neutron, lambda: self._names, group_id, id=group_id)
+
+    def get_id(self, neutron, name):
+        return self._lookup(neutron, lambda: self._ids, name, name=name)
+
+    def put(self, group):
+        with self._lock:
+            if self._names is not None:
+                self._remove(group["id"])
+                self._add(group)
+
+    def _remove(self, group_id):
+        name = self._names.pop(group_id, None)
+        if name is not None and self._ids.get(name) == group_id:
+            del self._ids[name]
+
+    def remove(self, group_id):
+        with self._lock:
+            if self._names is not None:
+                self._remove(group_id)
+
+
+class ProjectDirectory(object):
+    """
+        Maps the names of the keystone projects to their ids. The directory is loaded with a single list call and is
+        reloaded when it is older than PROJECT_TTL seconds.
+    """
+    def __init__(self, ttl=PROJECT_TTL):
+        self._ttl = ttl
+        self._lock = threading.RLock()
+        self._projects = None
+        self._loaded = None
+
+    def _load(self, keystone):
+        self._projects = {}
+        self._loaded = time.time()
+        for project in keystone.projects.list():
+            self._add(project)
+
+    def _add(self, project):
+        self._projects.setdefault(project.name, {})[project.id] = project
+
+    def _remove(self, project_id):
+        for name, projects in list(self._projects.items()):
+            projects.pop(project_id, None)
+            if len(projects) == 0:
+                del self._projects[name]
+
+    def get_id(self, keystone, name):
+        """
+            Return the id of the project with the given name
+        """
+        with self._lock:
+            if self._projects is None or time.time() - self._loaded > self._ttl:
+                self._load(keystone)
+
+            API_METRICS.cache_access("projects", name in self._projects)
+            if name not in self._projects:
+                # the project may have been created after the directory was loaded
+                for project in keystone.projects.list(name=name):
+                    self._add(project)
+
+            projects = self._projects.get(name, {})
+            if len(projects) == 0:
+                raise NotFound("No project with name %s" % name)
+
+            elif len(projects) > 1:
+                raise Exception("Multiple projects with name %s" % name)
+
+            return next(iter(projects))
+
+    def put(self, project):
+        with self._lock:
+            if self._projects is not None:
+                self._remove(project.id)
+                self._add(project)
+
+    def remove(self, project_id):
+        with self._lock:
+            if self._projects is not None:
+                self._remove(project_id)
+
+
+class ServiceCatalog(object):
+    """
+        A snapshot of the services and endpoints registered in keystone, loaded with one services.list and one
+        endpoints.list call. Services are indexed on their type and name, endpoints on their service, region and
+        interface.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._services = None
+        self._endpoints = None
+
+    def _load(self, keystone):
+        API_METRICS.cache_access("service_catalog", self._services is not None)
+        if self._services is None:
+            self._services = {}
+            self._endpoints = {}
+            for service in keystone.services.list():
+                self._put_service(service)
+
+            for endpoint in keystone.endpoints.list():
+                self._put_endpoint(endpoint)
+
+    @staticmethod
+    def _endpoint_key(endpoint):
+        region = getattr(endpoint, "region_id", None) or getattr(endpoint, "region", None)
+        return endpoint.service_id, region, endpoint.interface
+
+    def _put_service(self, service):
+        self._services["%s_%s" % (service.type, service.name)] = service
+
+    def _put_endpoint(self, endpoint):
+        self._endpoints[self._endpoint_key(endpoint)] = endpoint
+
+    def get_service(self, keystone, type_name):
+        """
+            Get the service with the given type and name, joined with an underscore
+        """
+        with self._lock:
+            self._load(keystone)
+            return self._services.get(type_name)
+
+    def get_endpoints(self, keystone, service_id, region):
+        """
+            Get the endpoints of a service in a region, indexed on their interface
+        """
+        with self._lock:
+            self._load(keystone)
+            endpoints = {}
+            for interface in ("admin", "internal", "public"):
+                endpoint = self._endpoints.get((service_id, region, interface))
+                if endpoint is not None:
+                    endpoints[interface] = endpoint
+
+            return endpoints
+
+    def put_service(self, service):
+        with self._lock:
+            if self._services is not None:
+                self.remove_service(service.id)
+                self._put_service(service)
+
+    def remove_service(self, service_id):
+        with self._lock:
+            if self._services is not None:
+                for key, service in list(self._services.items()):
+                    if service.id == service_id:
+                        del self._services[key]
+
+    def put_endpoint(self, endpoint):
+        with self._lock:
+            if self._endpoints is not None:
+                self._put_endpoint(endpoint)
+
+    def remove_endpoint(self, endpoint):
+        with self._lock:
+            if self._endpoints is not None:
+                self._endpoints.pop(self._endpoint_key(endpoint), None)
+
+
+class RoleAssignments(object):
+    """
+        The role assignments of users to projects of a provider. The assignments of a project are loaded with a single
+        role_assignments.list call the first time a binding in that project is checked. The name to id maps of the roles
+        and the users are loaded with a single list call each.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._roles = None
+        self._users = None
+        self._assignments = {}
+
+    def _lookup(self, manager, mapping, name):
+        if name not in mapping:
+            # the role or user may have been created after the map was loaded
+            for item in manager.list(name=name):
+                mapping.setdefault(item.name, item.id)
+
+        return mapping.get(name)
+
+    def get_role_id(self, keystone, name):
+        with self._lock:
+            if self._roles is None:
+                self._roles = {}
+                for role in keystone.roles.list():
+                    self._roles.setdefault(role.name, role.id)
+
+            return self._lookup(keystone.roles, self._roles, name)
+
+    def get_user_id(self, keystone, name):
+        with self._lock:
+            if self._users is None:
+                self._users = {}
+                for user in keystone.users.list():
+                    self._users.setdefault(user.name, user.id)
+
+            return self._lookup(keystone.users, self._users, name)
+
+    def has(self, keystone, project_id, user_id, role_id):
+        """
+            Check if the user has the role in the project
+        """
+        with self._lock:
+            API_METRICS.cache_access("role_assignments", project_id in self._assignments)
+            if project_id not in self._assignments:
+                assignments = set()
+                for assignment in keystone.role_assignments.list(project=project_id):
+                    if hasattr(assignment, "user"):
+                        assignments.add((assignment.user["id"], assignment.role["id"]))
+
+                self._assignments[project_id] = assignments
+
+            return (user_id, role_id) in self._assignments[project_id]
+
+    def put_role(self, role):
+        with self._lock:
+            if self._roles is not None:
+                self._roles[role.name] = role.id
+
+    def remove_user(self, name):
+        with self._lock:
+            if self._users is not None:
+                self._users.pop(name, None)
+
+    def grant(self, project_id, user_id, role_id):
+        with self._lock:
+            if project_id in self._assignments:
+                self._assignments[project_id].add((user_id, role_id))
+
+    def revoke(self, project_id, user_id, role_id):
+        with self._lock:
+            if project_id in self._assignments:
+                self._assignments[project_id].discard((user_id, role_id))
+
+
+class PasswordChecks(object):
+    """
+        Remembers the outcome of the password checks of users. The outcome is stored under a salted digest of the user and
+        the password, so the cache never holds the password itself. Concurrent checks of the same password share a single
+        authentication, checks of different users run in parallel.
+    """
+    def __init__(self):
+        self._salt = os.urandom(16)
+        self._lock = threading.Lock()
+        self._results = {}
+        self._pending = {}
+
+    def _digest(self, user, password):
+        return hashlib.sha256(self._salt + user.encode() + b"\0" + password.encode()).hexdigest()
+
+    def check(self, user, password, verify, ttl=PASSWORD_CHECK_TTL):
+        """
+            Return whether password is the password of user. The outcome of verify is reused for ttl seconds.
+        """
+        digest = self._digest(user, password)
+        while True:
+            with self._lock:
+                result = self._results.get(user)
+                if result is not None and result[0] == digest and time.time() - result[2] < ttl:
+                    API_METRICS.cache_access("password_checks", True)
+                    return result[1]
+
+                pending = self._pending.get(digest)
+                if pending is None:
+                    API_METRICS.cache_access("password_checks", False)
+                    pending = self._pending[digest] = threading.Event()
+                    break
+
+            pending.wait()
+
+        try:
+            valid = verify()
+            with self._lock:
+                self._results[user] = (digest, valid, time.time())
+            return valid
+        finally:
+            with self._lock:
+                del self._pending[digest]
+            pending.set()
+
+    def invalidate(self, user):
+        with self._lock:
+            self._results.pop(user, None)
+
+
+def classify_error(error):
+    """
+        Classify an error of an API call as retryable (the connection failed or a gateway failed), throttled (429 or 503,
+        already retried by the HTTP adapter of the provider session), conflict (409, the resource is in a state that does
+        not allow the call, such as in use or still building) or fatal
+    """
+    if isinstance(error, (ConnectFailure, ConnectTimeout)):
+        return "retryable"
+
+    status = None
+    for attribute in ("status_code", "http_status", "code"):
+        if isinstance(getattr(error, attribute, None), int):
+            status = getattr(error, attribute)
+            break
+
+    if status == 409:
+        return "conflict"
+
+    if status in THROTTLE_STATUS:
+        return "throttled"
+
+    if status in RETRYABLE_STATUS:
+        return "retryable"
+
+    return "fatal"
+
+
+class RetryPolicy(object):
+    """
+        Call an API operation again when it fails with an error that is expected to go away. Retryable errors are
+        retried for idempotent operations only, because the call may have succeeded on the server when its response was
+        lost. Conflicts are retried when the caller expects the state of the resource to change by itself, for example a
+        port that is still detaching. Throttled requests are retried by the HTTP adapter and, like fatal errors, are
+        raised immediately. The delay before the nth retry is drawn uniformly between 0 and
+        min(max_delay, base_delay * 2 ** (n - 1)), so handlers that run into the same conflict do not retry in lockstep.
+    """
+    def __init__(self, attempts=RETRY_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.attempts = int(attempts)
+        self.base_delay = float(base_delay)
+        self.max_delay = float(max_delay)
+
+    def call(self, operation, function, *args, conflicts=False, idempotent=True, timeout=None, **kwargs):
+        """
+            Call function until it succeeds, at most attempts times or, when a timeout is given, until timeout seconds
+            have passed. An operation that is not idempotent is only retried after a conflict.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        attempt = 0
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                reason = classify_error(e)
+                attempt += 1
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+                if not ((reason == "conflict" and conflicts) or (reason == "retryable" and idempotent)):
+                    raise
+
+                if (attempt >= self.attempts) if deadline is None else (time.time() + delay > deadline):
+                    raise
+
+                LOGGER.debug("Retrying %s in %.2f seconds after a %s error: %s", operation, delay, reason, e)
+                API_METRICS.handler_retry(operation, reason)
+                with trace_span("retry " + operation, "wait", reason=reason, attempt=attempt):
+                    time.sleep(delay)
+
+
+class Waiter(object):
+    """
+        A pending wait on a state transition. The condition is checked with an exponential backoff, starting at
+        WAIT_MIN_INTERVAL seconds.
+    """
+    def __init__(self, kind, key):
+        self.kind = kind
+        self.key = key
+        self.result = None
+        self.event = threading.Event()
+        self.interval = WAIT_MIN_INTERVAL
+        self.due = time.time()
+
+    def done(self, result=None):
+        self.result = result
+        self.event.set()
+
+    def backoff(self):
+        self.due = time.time() + self.interval
+        self.interval = min(self.interval * 2, WAIT_MAX_INTERVAL)
+
+
+class WaitManager(object):
+    """
+        Tracks the pending waits on long running state transitions of a provider. A single polling thread checks the
+        conditions of all waiters that are due with bulk requests: one port list for all deleted servers and one server
+        list for all servers that are expected to become active. The manager polls with its own clients and server index
+        of the provider, which it gets when it is created.
+    """
+    def __init__(self, nova, neutron, server_index, provider=""):
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._nova = nova
+        self._neutron = neutron
+        self._server_index = server_index
+        self._provider = provider
+
+    def _wait(self, waiter, timeout):
+        with self._lock:
+            self._waiters.append(waiter)
+            if self._thread is None:
+                # the requests of the polling thread serve all waiters, they are not labeled with a resource
+                context = ApiContext(provider=self._provider, phase="wait")
+                self._thread = threading.Thread(target=self._run, args=(context,), name="openstack-wait", daemon=True)
+                self._thread.start()
+
+        self._wakeup.set()
+        with trace_span("wait_for_" + waiter.kind, "wait", key=waiter.key) as span:
+            span["done"] = waiter.event.wait(timeout)
+
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+        # let the polling thread stop when this was the last waiter
+        self._wakeup.set()
+        return waiter.event.is_set()
+
+    def _run(self, context):
+        with api_context(context):
+            self._poll_until_done()
+
+    def _poll_until_done(self):
+        while True:
+            self._wakeup.clear()
+            with self._lock:
+                if len(self._waiters) == 0:
+                    self._thread = None
+                    return
+
+                now = time.time()
+                due = [w for w in self._waiters if not w.event.is_set() and w.due <= now]
+
+            if len(due) > 0:
+                try:
+                    self._poll(due)
+                except Exception:
+                    LOGGER.exception("Failed to poll the state of %d pending resources", len(due))
+
+                for waiter in due:
+                    if not waiter.event.is_set():
+                        waiter.backoff()
+
+            with self._lock:
+                # released waiters are dropped here, their threads may not have woken up to remove them yet
+                self._waiters = [w for w in self._waiters if not w.event.is_set()]
+                pending = [w.due for w in self._waiters]
+
+            if len(pending) > 0:
+                # sleep until the next waiter is due or a new waiter is added
+                self._wakeup.wait(max(min(pending) - time.time(), 0))
+
+    def _poll(self, waiters):
+        ports = [w for w in waiters if w.kind == "ports"]
+        if len(ports) > 0:
+            device_ids = [w.key for w in ports]
+            in_use = set()
+            for i in range(0, len(device_ids), WAIT_QUERY_CHUNK):
+                result = self._neutron.list_ports(device_id=device_ids[i:i + WAIT_QUERY_CHUNK], fields=["device_id"])
+                in_use.update(port["device_id"] for port in result["ports"])
+
+            for waiter in ports:
+                if waiter.key not in in_use:
+                    waiter.done()
+
+        servers = [w for w in waiters if w.kind == "server"]
+        if len(servers) > 0:
+            self._server_index.refresh(self._nova, max_age=0)
+            for waiter in servers:
+                vms = self._server_index.find(self._nova, name=waiter.key, max_age=float("inf"))
+                if len(vms) != 1:
+                    waiter.done()
+                elif getattr(vms[0], "OS-EXT-STS:vm_state") == "active":
+                    waiter.done(vms[0])
+                else:
+                    waiter.result = vms[0]
+
+    def wait_for_ports_deleted(self, device_id, timeout):
+        """
+            Wait at most timeout seconds until neutron no longer reports ports for the given device.
+
+            :return: True when all ports have been deleted
+        """
+        return self._wait(Waiter("ports", device_id), timeout)
+
+    def wait_for_active_server(self, name, timeout):
+        """
+            Wait at most timeout seconds until the server with the given name is active.
+
+            :return: A tuple with a boolean that indicates whether the wait has finished and the server. The server is None
+                     when it no longer exists.
+        """
+        waiter = Waiter("server", name)
+        return self._wait(waiter, timeout), waiter.result
+
+
+class OpenStackHandler(CRUDHandler):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for phase in HANDLER_PHASES:
+            setattr(self, phase, self._in_phase(phase, getattr(self, phase)))
+
+    @staticmethod
+    def _in_phase(phase, method):
+        """
+            Wrap a method of the handler so the API requests it makes are labeled with the phase of the handler. A phase
+            that is called from another phase, such as facts from read_resource, keeps the label of the outer phase.
+        """
+        @functools.wraps(method)
+        def call(*args, **kwargs):
+            context = current_api_context()
+            with trace_span(phase, "handler"):
+                if context.phase != "":
+                    return method(*args, **kwargs)
+
+                with api_context(context.child(phase=phase)):
+                    return method(*args, **kwargs)
+
+        return call
+
+    @contextlib.contextmanager
+    def _measure(self, ctx, resource, name):
+        """
+            Label the API requests made for the resource with its provider, type and id, trace them as a span with the
+            given name, log a summary of them in the context of the handler and export the metrics when this is done
+        """
+        context = ApiContext(provider=resource.id.agent_name, resource_type=resource.id.entity_type, summary=ApiSummary(),
+                             resource_id=str(resource.id))
+        try:
+            with api_context(context), trace_span(name, "resource"):
+                yield context
+        finally:
+            context.summary.log(ctx)
+            write_api_metrics()
+
+    def execute(self, ctx, resource, dry_run=False):
+        with self._measure(ctx, resource, "execute"):
+            return super().execute(ctx, resource, dry_run)
+
+    def check_facts(self, ctx, resource):
+        with self._measure(ctx, resource, "check_facts"):
+            return super().check_facts(ctx, resource)
+
+    def get_session(self, auth_url, project, admin_user, admin_password, session_options=None):
+        return get_provider_session(auth_url, project, admin_user, admin_password, session_options)
+
+    @cache(timeout=CRED_TIMEOUT)
+    def get_nova_client(self, auth_url, project, admin_user, admin_password, session_options=None):
+        return nova_client.Client("2.1", session=self.get_session(auth_url, project, admin_user, admin_password,
+                                                                  session_options))
+
+    @cache(timeout=CRED_TIMEOUT)
+    def get_neutron_client(self, auth_url, project, admin_user, admin_password, session_options=None):
+        return neutron_client.Client("2.0", session=self.get_session(auth_url, project, admin_user, admin_password,
+                                                                     session_options))
+
+    @cache(timeout=CRED_TIMEOUT)
+    def get_keystone_client(self, auth_url, project, admin_user, admin_password, session_options=None):
+        return keystone_client.Client(session=self.get_session(auth_url, project, admin_user, admin_password,
+                                                               session_options))
+
+    @cache(timeout=INVENTORY_TIMEOUT, for_version=True)
+    def get_inventory(self, auth_url, project, admin_user, admin_password, version):
+        return NeutronInventory()
+
+    @cache(timeout=CRED_TIMEOUT)
+    def get_server_index(self, auth_url, project, admin_user, admin_password, tenant_id=None):
+        if tenant_id is None:
+            return ServerIndex()
+
+        return ServerIndex({"all_tenants": True, "tenant_id": tenant_id})
+
+    @cache(timeout=CRED_TIMEOUT)
+    def get_project_directory(self, auth_url, project, admin_user, admin_password):
+        return ProjectDirectory()
+
+    @cache(timeout=INVENTORY_TIMEOUT, for_version=True)
+    def get_service_catalog(self, auth_url, project, admin_user, admin_password, version):
+        return ServiceCatalog()
+
+    @cache(timeout=INVENTORY_TIMEOUT, for_version=True)
+    def get_role_assignments(self, auth_url, project, admin_user, admin_password, version):
+        return RoleAssignments()
+
+    @cache(timeout=CRED_TIMEOUT)
+    def get_password_checks(self, auth_url, project, admin_user, admin_password):
+        return PasswordChecks()
+
+    @cache(timeout=CRED_TIMEOUT)
+    def get_wait_manager(self, auth_url, project, admin_user, admin_password, provider, session_options=None):
+        credentials = (auth_url, project, admin_user, admin_password)
+        return WaitManager(self.get_nova_client(*credentials, session_options=session_options),
+                           self.get_neutron_client(*credentials, session_options=session_options),
+                           self.get_server_index(*credentials, tenant_id=None), provider)
+
+    @cache(timeout=CRED_TIMEOUT)
+    def get_executor(self, auth_url, project, admin_user, admin_password, max_concurrency):
+        return futures.ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=WORKER_PREFIX)
+
+    @cache(timeout=CRED_TIMEOUT)
+    def get_facts_collector(self, auth_url, project, admin_user, admin_password):
+        return FactsCollector()
+
+    def pre(self, ctx, resource):
+        project = resource.admin_tenant
+        self._credentials = (resource.auth_url, project, resource.admin_user, resource.admin_password)
+        self._version = resource.id.version
+        self._provider_name = resource.id.agent_name
+        self._session_options = getattr(resource, "session_options", None)
+        self._nova = self.get_nova_client(*self._credentials, session_options=self._session_options)
+        self._neutron = self.get_neutron_client(*self._credentials, session_options=self._session_options)
+        self._keystone = self.get_keystone_client(*self._credentials, session_options=self._session_options)
+
+        self._max_concurrency = getattr(resource, "max_concurrency", DEFAULT_CONCURRENCY)
+        self._retry = RetryPolicy(**(getattr(resource, "retry_policy", None) or {}))
+
+        self._inventory = None
+        if getattr(resource, "use_inventory", False):
+            self._inventory = self.get_inventory(*self._credentials, version=self._version)
+
+    def post(self, ctx, resource):
+        self._nova = None
+        self._neutron = None
+        self._keystone = None
+        self._inventory = None
+        self._credentials = None
+        self._version = None
+        self._provider_name = None
+
+    def _server_index(self, tenant_id=None):
+        """
+            The index of the servers in the project the handler is logged into or, with admin credentials, of the servers
+            of the project with the given id.
+        """
+        return self.get_server_index(*self._credentials, tenant_id=tenant_id)
 
-        if router.gateway in networks:
-            router.requires.add(networks[router.gateway])
+    def _project_directory(self):
+        return self.get_project_directory(*self._credentials)
 
-    for subnet in subnets.values():
-        if subnet.model.project.name in projects:
-            subnet.requires.add(projects[subnet.model.project.name])
+    def _service_catalog(self):
+        return self.get_service_catalog(*self._credentials, version=self._version)
 
-        # also require the network it is attached to
-        if subnet.model.network.name in networks:
-            subnet.requires.add(networks[subnet.model.network.name])
+    def _role_assignments(self):
+        return self.get_role_assignments(*self._credentials, version=self._version)
 
-    for vm in vms.values():
-        if vm.model.project.name in projects:
-            vm.requires.add(projects[vm.model.project.name])
+    def _wait_manager(self):
+        return self.get_wait_manager(*self._credentials, provider=self._provider_name,
+                                     session_options=self._session_options)
 
-        for port in vm.ports:
-            if port["network"] in subnets:
-                vm.requires.add(subnets[port["network"]])
+    def _facts_lookup(self, kind, key, value):
+        """
+            Find the neutron resources of the given kind of which the attribute key has the given value. When the inventory
+            is enabled, for example in a batch of collect_facts, they are looked up in the snapshot the facts of the
+            provider are computed from. Otherwise neutron is queried for them.
+        """
+        if self._inventory is None:
+            return self._neutron_list(kind, **{key: value})
 
-        for sg in vm.security_groups:
-            if sg in sgs:
-                vm.requires.add(sgs[sg])
+        collector = self.get_facts_collector(*self._credentials)
+        collector.refresh(self._neutron)
+        return collector.find(self._neutron, kind, key, value)
 
-    for port in ports.values():
-        if port.model.project.name in projects:
-            port.requires.add(projects[port.model.project.name])
+    def prefetch_facts(self):
+        """
+            Load the snapshot the facts of the provider are computed from and the index of its servers with bulk requests
+        """
+        self.get_facts_collector(*self._credentials).refresh(self._neutron)
+        self._server_index().refresh(self._nova)
 
-        if port.network in projects:
-            port.requires.add(subnets[port.network])
+    def prefetch(self):
+        """
+            Load the shared indexes of the provider with bulk requests
+        """
+        if self._inventory is not None:
+            self._inventory.prefetch(self._neutron)
 
-        if port.host in vms:
-            port.requires.add(vms[port.host])
+        self._server_index().refresh(self._nova)
 
-    for fip in fips.values():
-        if fip.external_network in networks:
-            fip.requires.add(networks[fip.external_network])
+    def concurrent_map(self, function, items):
+        """
+            Call function for each of the items and return the results in the same order. Independent API calls are
+            issued concurrently on the workers of the provider, so all handlers of the provider together have at most
+            max_concurrency of these calls in flight.
+        """
+        items = list(items)
+        # a call from a worker runs inline, it would otherwise wait for the workers it occupies
+        if min(int(self._max_concurrency), len(items)) <= 1 or threading.current_thread().name.startswith(WORKER_PREFIX):
+            return [function(item) for item in items]
 
-        if fip.port in ports:
-            port = ports[fip.port]
-            fip.requires.add(port)
+        executor = self.get_executor(*self._credentials, max_concurrency=int(self._max_concurrency))
+        return list(executor.map(in_api_context(function), items))
 
-            # find router on which this floating ip is added
-            key = (fip.external_network, port.subnet)
-            if key in router_map:
-                fip.requires.add(router_map[key])
+    def _delete(self, operation, function, *args, timeout=None):
+        """
+            Delete a resource with the retry policy of the provider. Conflicts are retried because a resource can not be
+            deleted while it is still in use, for example by ports that are being detached. A resource that is already
+            gone counts as deleted.
+        """
+        def delete():
+            try:
+                function(*args)
+            except exceptions.NotFound:
+                pass
 
+        self._retry.call(operation, delete, conflicts=True, timeout=timeout)
 
-CRED_TIMEOUT = 600
-RESOURCE_TIMEOUT = 10
+    def _neutron_list(self, kind, **filters):
+        """
+            List the neutron resources of the given kind that match the filters. When the inventory is enabled for the
+            provider the result is served from the inventory. Resources that are not in the inventory are looked up in
+            neutron to make sure a resource created after the snapshot was taken is not missed.
+        """
+        if self._inventory is not None:
+            items = self._inventory.list(self._neutron, kind, **filters)
+            if len(items) > 0:
+                return items
 
+        items = getattr(self._neutron, "list_" + kind)(**filters)[kind]
+        for item in items:
+            self._inventory_put(kind, item)
 
-class OpenStackHandler(CRUDHandler):
+        return items
 
-    @cache(timeout=CRED_TIMEOUT)
-    def get_session(self, auth_url, project, admin_user, admin_password):
-        auth = v3.Password(auth_url=auth_url, username=admin_user, password=admin_password, project_name=project,
-                           user_domain_id="default", project_domain_id="default")
-        sess = session.Session(auth=auth)
-        return sess
+    def _neutron_show(self, kind, item_id):
+        """
+            Get the neutron resource of the given kind with the given id
+        """
+        items = self._neutron_list(kind, id=item_id)
+        if len(items) == 0:
+            return None
 
-    @cache(timeout=CRED_TIMEOUT)
-    def get_nova_client(self, auth_url, project, admin_user, admin_password):
-        return nova_client.Client("2.1", session=self.get_session(auth_url, project, admin_user, admin_password))
+        return items[0]
 
-    @cache(timeout=CRED_TIMEOUT)
-    def get_neutron_client(self, auth_url, project, admin_user, admin_password):
-        return neutron_client.Client("2.0", session=self.get_session(auth_url, project, admin_user, admin_password))
+    def _facts_expire(self, *kinds):
+        """
+            Take a new snapshot for the next facts after a resource of one of the kinds the facts are computed from has
+            been modified
+        """
+        if any(kind in FactsCollector.indexes for kind in kinds):
+            self.get_facts_collector(*self._credentials).expire()
 
-    @cache(timeout=CRED_TIMEOUT)
-    def get_keystone_client(self, auth_url, project, admin_user, admin_password):
-        return keystone_client.Client(session=self.get_session(auth_url, project, admin_user, admin_password))
+    def _inventory_put(self, kind, item):
+        self._facts_expire(kind)
+        if self._inventory is not None:
+            self._inventory.put(kind, item)
 
-    def pre(self, ctx, resource):
-        project = resource.admin_tenant
-        self._nova = self.get_nova_client(resource.auth_url, project, resource.admin_user, resource.admin_password)
-        self._neutron = self.get_neutron_client(resource.auth_url, project, resource.admin_user,
-                                                resource.admin_password)
-        self._keystone = self.get_keystone_client(resource.auth_url, project, resource.admin_user, resource.admin_password)
+    def _inventory_refresh(self, kind, item_id):
+        """
+            Fetch the current version of a resource that has been modified by a call to neutron
+        """
+        self._facts_expire(kind)
+        if self._inventory is not None:
+            singular = kind[:-1]
+            self._inventory.put(kind, getattr(self._neutron, "show_" + singular)(item_id)[singular])
+
+    def _inventory_remove(self, kind, item_id=None, **filters):
+        self._facts_expire(kind)
+        if self._inventory is not None:
+            if item_id is not None:
+                self._inventory.remove(kind, item_id)
+            else:
+                self._inventory.discard(kind, **filters)
 
-    def post(self, ctx, resource):
-        self._nova = None
-        self._neutron = None
-        self._keystone = None
+    def _inventory_invalidate(self, *kinds):
+        self._facts_expire(*kinds)
+        if self._inventory is not None:
+            for kind in kinds:
+                self._inventory.invalidate(kind)
 
     def get_project_id(self, resource, name):
         """
@@ -588,14 +2537,11 @@ class OpenStackHandler(CRUDHandler):
         """
         # Fallback for non admin users
         if resource.admin_tenant == name:
-            session = self.get_session(resource.auth_url, resource.project, resource.admin_user, resource.admin_password)
+            session = self.get_session(resource.auth_url, resource.project, resource.admin_user, resource.admin_password,
+                                       self._session_options)
             return session.get_project_id()
 
-        try:
-            project = self._keystone.projects.find(name=name)
-            return project.id
-        except Exception:
-            raise
+        return self._project_directory().get_id(self._keystone, name)
 
     def get_network(self, project_id, name=None, network_id=None):
         """
@@ -612,35 +2558,35 @@ class OpenStackHandler(CRUDHandler):
         else:
             raise Exception("Either a name or an id needs to be provided.")
 
-        networks = self._neutron.list_networks(**query)
-        if len(networks["networks"]) == 0:
+        networks = self._neutron_list("networks", **query)
+        if len(networks) == 0:
             return None
 
-        elif len(networks["networks"]) > 1:
+        elif len(networks) > 1:
             raise Exception("Found more than one network with name %s/id %s for project %s" % (name, network_id, project_id))
 
         else:
-            return networks["networks"][0]
+            return networks[0]
 
     def get_subnet(self, project_id, name=None, subnet_id=None):
         """
             Retrieve the subnet id based on the name of the network
         """
         if name is not None:
-            subnets = self._neutron.list_subnets(tenant_id=project_id, name=name)
+            subnets = self._neutron_list("subnets", tenant_id=project_id, name=name)
         elif subnet_id is not None:
-            subnets = self._neutron.list_subnets(tenant_id=project_id, id=subnet_id)
+            subnets = self._neutron_list("subnets", tenant_id=project_id, id=subnet_id)
         else:
             raise Exception("Either a name or an id needs to be provided.")
 
-        if len(subnets["subnets"]) == 0:
+        if len(subnets) == 0:
             return None
 
-        elif len(subnets["subnets"]) > 1:
+        elif len(subnets) > 1:
             raise Exception("Found more than one subnet with name %s for project %s" % (name, project_id))
 
         else:
-            return subnets["subnets"][0]
+            return subnets[0]
 
     def get_router(self, project_id=None, name=None, router_id=None):
         """
@@ -657,25 +2603,25 @@ class OpenStackHandler(CRUDHandler):
         else:
             raise Exception("Either a name or an id needs to be provided.")
 
-        routers = self._neutron.list_routers(**query)
+        routers = self._neutron_list("routers", **query)
 
-        if len(routers["routers"]) == 0:
+        if len(routers) == 0:
             return None
 
-        elif len(routers["routers"]) > 1:
+        elif len(routers) > 1:
             raise Exception("Found more than one router with name %s for project %s" % (name, project_id))
 
         else:
-            return routers["routers"][0]
+            return routers[0]
 
     def get_host_id(self, project_id, name):
         return self.get_host(project_id, name).id
 
-    def get_host(self, project_id, name):
+    def get_host(self, project_id, name, max_age=SERVER_INDEX_AGE):
         """
             Retrieve the router id based on the name of the network
         """
-        vms = self._nova.servers.findall(name=name)
+        vms = self._server_index().find(self._nova, name=name, max_age=max_age)
 
         if len(vms) == 0:
             return None
@@ -690,7 +2636,7 @@ class OpenStackHandler(CRUDHandler):
         """
             Retrieve the router id based on the name of the network
         """
-        vms = self._nova.servers.findall(id=server_id)
+        vms = self._server_index().find(self._nova, server_id=server_id)
 
         if len(vms) == 0:
             return None
@@ -706,38 +2652,39 @@ class OpenStackHandler(CRUDHandler):
             Get security group details from openstack
         """
         if name is not None:
-            sgs = self._neutron.list_security_groups(name=name)
+            sgs = self._neutron_list("security_groups", name=name)
         elif group_id is not None:
-            sgs = self._neutron.list_security_groups(id=group_id)
+            sgs = self._neutron_list("security_groups", id=group_id)
 
-        if len(sgs["security_groups"]) == 0:
+        if len(sgs) == 0:
             return None
-        elif len(sgs["security_groups"]) > 1:
-            ctx.warning("Multiple security groups with name %(name)s exist.", name=name, groups=sgs["security_groups"])
+        elif len(sgs) > 1:
+            ctx.warning("Multiple security groups with name %(name)s exist.", name=name, groups=sgs)
 
-        return sgs["security_groups"][0]
+        return sgs[0]
 
 
 @provider("openstack::VirtualMachine", name="openstack")
 class VirtualMachineHandler(OpenStackHandler):
+    def _vm_index(self, resource):
+        if resource.project == resource.admin_tenant:
+            return self._server_index()
+
+        return self._server_index(self.get_project_id(resource, resource.project))
+
     @cache(timeout=10)
     def get_vm(self, ctx, resource):
-        if resource.project == resource.admin_tenant:
-            servers = self._nova.servers.list(search_opts={"name": resource.name})
-        else:
-            try:
-                project_id = self.get_project_id(resource, resource.project)
-                servers = self._nova.servers.list(search_opts={"all_tenants": True, "tenant_id": project_id,
-                                                               "name": resource.name})
-            except Exception:
-                ctx.exception("Unable to retrieve server list with a scoped login on project %(admin_project)s, "
-                              "for project %(project)s. This only works with admin credentials.",
-                              admin_project=resource.admin_tenant, project=resource.project, traceback=traceback.format_exc())
-                return None
+        try:
+            servers = self._vm_index(resource).find(self._nova, name=resource.name)
+        except Exception:
+            if resource.project == resource.admin_tenant:
+                raise
+
+            ctx.exception("Unable to retrieve server list with a scoped login on project %(admin_project)s, "
+                          "for project %(project)s. This only works with admin credentials.",
+                          admin_project=resource.admin_tenant, project=resource.project, traceback=traceback.format_exc())
+            return None
 
-        # OS query semantic are not == but "in". So "mon" matches mon and mongo
-        # Filter again to ensure a correct result
-        servers = [x for x in servers if x.name == resource.name]
         if len(servers) == 0:
             return None
 
@@ -749,17 +2696,17 @@ class VirtualMachineHandler(OpenStackHandler):
 
     @cache(timeout=10)
     def _port_id(self, port_name):
-        ports = self._neutron.list_ports(name=port_name)
-        if len(ports["ports"]) > 0:
-            return ports["ports"][0]["id"]
+        ports = self._neutron_list("ports", name=port_name)
+        if len(ports) > 0:
+            return ports[0]["id"]
 
         return None
 
     @cache(timeout=10)
     def _get_subnet_id(self, subnet_name):
-        subnets = self._neutron.list_subnets(name=subnet_name)
-        if len(subnets["subnets"]) > 0:
-            return subnets["subnets"][0]["network_id"]
+        subnets = self._neutron_list("subnets", name=subnet_name)
+        if len(subnets) > 0:
+            return subnets[0]["network_id"]
 
         return None
 
@@ -783,15 +2730,11 @@ class VirtualMachineHandler(OpenStackHandler):
         no_sort = sorted([p for p in ports if p["index"] == 0], key=lambda x: x["network"])
         sort = sorted([p for p in ports if p["index"] > 0], key=lambda x: x["index"])
 
-        return [self._create_nic_config(p) for p in sort] + [self._create_nic_config(p) for p in no_sort]
+        return self.concurrent_map(self._create_nic_config, sort + no_sort)
 
     def _build_sg_list(self, ctx, security_groups):
-        sg_list = []
-        for group in security_groups:
-            sg = self.get_security_group(ctx, name=group)
-            if sg is not None:
-                sg_list.append(sg["name"])
-        return sg_list
+        sgs = self.concurrent_map(lambda group: self.get_security_group(ctx, name=group), security_groups)
+        return [sg["name"] for sg in sgs if sg is not None]
 
     def _ensure_key(self, ctx, resource):
         keys = {k.name: k for k in self._nova.keypairs.list()}
@@ -828,25 +2771,22 @@ class VirtualMachineHandler(OpenStackHandler):
         self._nova.servers.create(resource.name, flavor=flavor.id, userdata=resource.user_data, nics=nics,
                                   security_groups=self._build_sg_list(ctx, resource.security_groups),
                                   image=resource.image, key_name=resource.key_name, config_drive=resource.config_drive)
+        # nova creates and binds ports for the new server
+        self._inventory_invalidate("ports")
+        self._vm_index(resource).expire()
         ctx.set_created()
 
     def delete_resource(self, ctx, resource: resources.PurgeableResource) -> None:
         server = ctx.get("server")
         server.delete()
+        self._vm_index(resource).remove(server.id)
 
-        # Wait until the server has been deleted
-        count = 0
         ctx.info("Server deleted, waiting for neutron to report all ports deleted.")
-        while server is not None and count < 60:
-            ports = self._neutron.list_ports(device_id=server.id)
-            if len(ports["ports"]) > 0:
-                time.sleep(1)
-                count += 1
-            else:
-                server = None
-
-        if server is not None:
+        if self._wait_manager().wait_for_ports_deleted(server.id, PORT_DELETE_TIMEOUT):
+            self._inventory_remove("ports", device_id=server.id)
+        else:
             ctx.warning("Delete still in progress, giving up waiting.")
+            self._inventory_invalidate("ports")
 
         ctx.set_purged()
 
@@ -882,19 +2822,19 @@ class VirtualMachineHandler(OpenStackHandler):
                         facts["subnet_%s_ip" % name] = ips[i]
 
             # Get the private ip of the first port
-            project_id = self.get_project_id(resource, resource.project)
             network_one = None
             for port in resource.ports:
                     if port["index"] == 1:
                         network_one = port["network"]
 
-            if project_id is not None and network_one is not None:
-                ports = self._neutron.list_ports(device_id=vm.id)
-                for port in ports["ports"]:
-                    for ips in port["fixed_ips"]:
-                        subnet = self.get_subnet(project_id, subnet_id=ips["subnet_id"])
-                        if subnet["name"] == network_one:
-                            facts["ip_address"] = ips["ip_address"]
+            if network_one is not None:
+                ports = self._facts_lookup("ports", "device_id", vm.id)
+                fixed_ips = [ips for port in ports for ips in port["fixed_ips"]]
+                subnets = self.concurrent_map(lambda ips: self._facts_lookup("subnets", "id", ips["subnet_id"]),
+                                              fixed_ips)
+                for ips, subnet in zip(fixed_ips, subnets):
+                    if len(subnet) > 0 and subnet[0]["name"] == network_one:
+                        facts["ip_address"] = ips["ip_address"]
 
             return facts
         except Exception:
@@ -940,24 +2880,28 @@ class NetworkHandler(OpenStackHandler):
 
     def create_resource(self, ctx: handler.HandlerContext, resource: resources.PurgeableResource):
         project_id = self.get_project_id(resource, resource.project)
-        self._neutron.create_network({"network": self._create_dict(resource, project_id)})
+        result = self._neutron.create_network({"network": self._create_dict(resource, project_id)})
+        self._inventory_put("networks", result["network"])
         ctx.set_created()
 
     def delete_resource(self, ctx: handler.HandlerContext, resource: resources.PurgeableResource):
         network_id = ctx.get("network_id")
-        self._neutron.delete_network(network_id)
+        self._delete("delete_network", self._neutron.delete_network, network_id)
+        self._inventory_remove("networks", network_id)
         ctx.set_purged()
 
     def update_resource(self, ctx: handler.HandlerContext, changes: dict, resource: resources.PurgeableResource):
         network_id = ctx.get("network_id")
-        self._neutron.update_network(network_id, {"network": {"name": resource.name, "router:external": resource.external}})
+        result = self._neutron.update_network(network_id, {"network": {"name": resource.name,
+                                                                       "router:external": resource.external}})
+        self._inventory_put("networks", result["network"])
 
         ctx.fields_updated(("name", "external"))
         ctx.set_updated()
 
     def facts(self, ctx, resource: Network):
         try:
-            networks = self._neutron.list_networks(name=resource.name)["networks"]
+            networks = self._neutron_list("networks", name=resource.name)
         except NotFound:
             return {}
 
@@ -989,26 +2933,30 @@ class RouterHandler(OpenStackHandler):
         if "external_gateway_info" in neutron_version and neutron_version["external_gateway_info"] is not None:
             external_net_id = neutron_version["external_gateway_info"]["network_id"]
 
-            networks = self._neutron.list_networks(id=external_net_id)
-            if len(networks["networks"]) == 1:
-                ext_name = networks["networks"][0]["name"]
+            networks = self._neutron_list("networks", id=external_net_id)
+            if len(networks) == 1:
+                ext_name = networks[0]["name"]
 
         resource.gateway = ext_name
 
-        ports = self._neutron.list_ports(device_id=neutron_version["id"])
-        subnet_list = []
-        for port in ports["ports"]:
-            subnets = port["fixed_ips"]
+        ports = self._neutron_list("ports", device_id=neutron_version["id"])
+        subnet_ids = []
+        for port in ports:
             if port["name"] == "" or port["name"] not in resource.ports:
-                for subnet in subnets:
-                    try:
-                        subnet_details = self._neutron.show_subnet(subnet["subnet_id"])["subnet"]
-                        # skip external networks and neutron networks such as ha networks
-                        if subnet_details["network_id"] != external_net_id and subnet_details["tenant_id"] != "":
-                            subnet_list.append(subnet_details["name"])
+                subnet_ids.extend([subnet["subnet_id"] for subnet in port["fixed_ips"]])
+
+        def show_subnet(subnet_id):
+            try:
+                return self._neutron_show("subnets", subnet_id)
+            except exceptions.NeutronClientException:
+                return None
 
-                    except exceptions.NeutronClientException:
-                        pass
+        subnet_list = []
+        for subnet_details in self.concurrent_map(show_subnet, subnet_ids):
+            # skip external networks and neutron networks such as ha networks
+            if subnet_details is not None and subnet_details["network_id"] != external_net_id and \
+               subnet_details["tenant_id"] != "":
+                subnet_list.append(subnet_details["name"])
 
         resource.subnets = sorted(subnet_list)
 
@@ -1024,6 +2972,7 @@ class RouterHandler(OpenStackHandler):
             raise SkipResource("Cannot create network when project id is not yet known.")
 
         result = self._neutron.create_router({"router": {"name": resource.name, "tenant_id": project_id}})
+        self._inventory_put("routers", result["router"])
         router_id = result["router"]["id"]
         ctx.info("Created router with id %(id)s", id=router_id)
         ctx.set_created()
@@ -1046,7 +2995,9 @@ class RouterHandler(OpenStackHandler):
                          port=port["id"], router_id=router_id)
                 self._neutron.remove_interface_router(router=router_id, body={"port_id": port["id"]})
 
-        self._neutron.delete_router(router_id)
+        self._delete("delete_router", self._neutron.delete_router, router_id)
+        self._inventory_remove("routers", router_id)
+        self._inventory_remove("ports", device_id=router_id)
         ctx.set_purged()
 
     def _update_subnets(self, router_id, current, desired):
@@ -1056,34 +3007,38 @@ class RouterHandler(OpenStackHandler):
         # subnets to add to the router
         for subnet in (to - current):
             # query for the subnet id
-            subnet_data = self._neutron.list_subnets(name=subnet)
-            if "subnets" not in subnet_data or len(subnet_data["subnets"]) != 1:
+            subnet_data = self._neutron_list("subnets", name=subnet)
+            if len(subnet_data) != 1:
                 raise Exception("Unable to find id of subnet %s" % subnet)
 
-            subnet_id = subnet_data["subnets"][0]["id"]
-            self._neutron.add_interface_router(router=router_id, body={"subnet_id": subnet_id})
+            subnet_id = subnet_data[0]["id"]
+            result = self._neutron.add_interface_router(router=router_id, body={"subnet_id": subnet_id})
+            self._inventory_refresh("ports", result["port_id"])
 
         # subnets to delete
         for subnet in (current - to):
             # query for the subnet id
-            subnet_data = self._neutron.list_subnets(name=subnet)
-            if "subnets" not in subnet_data or len(subnet_data["subnets"]) != 1:
+            subnet_data = self._neutron_list("subnets", name=subnet)
+            if len(subnet_data) != 1:
                 raise Exception("Unable to find id of subnet %s" % subnet)
 
-            subnet_id = subnet_data["subnets"][0]["id"]
-            self._neutron.remove_interface_router(router=router_id, body={"subnet_id": subnet_id})
+            subnet_id = subnet_data[0]["id"]
+            result = self._neutron.remove_interface_router(router=router_id, body={"subnet_id": subnet_id})
+            self._inventory_remove("ports", result["port_id"])
 
     def _set_gateway(self, router_id, network):
         network = self.get_network(None, name=network)
         if network is None:
             raise Exception("Unable to set router gateway because the gateway network that does not exist.")
 
-        self._neutron.add_gateway_router(router_id, {'network_id': network["id"]})
+        result = self._neutron.add_gateway_router(router_id, {'network_id': network["id"]})
+        self._inventory_put("routers", result["router"])
 
     def update_resource(self, ctx: handler.HandlerContext, changes: dict, resource: resources.PurgeableResource) -> None:
         router_id = ctx.get("neutron")["id"]
         if "name" in changes:
-            self._neutron.update_router(router_id, {"router": {"name": resource.name}})
+            result = self._neutron.update_router(router_id, {"router": {"name": resource.name}})
+            self._inventory_put("routers", result["router"])
             ctx.set_updated()
 
         if "subnets" in changes:
@@ -1098,16 +3053,13 @@ class RouterHandler(OpenStackHandler):
 
         if "routes" in changes:
             ctx.set_updated()
-            self._neutron.update_router(router_id, {"router": {"routes": [{"nexthop": n, "destination": d}
-                                                                          for d, n in resource.routes.items()]}})
+            result = self._neutron.update_router(router_id, {"router": {"routes": [{"nexthop": n, "destination": d}
+                                                                                   for d, n in resource.routes.items()]}})
+            self._inventory_put("routers", result["router"])
 
     def facts(self, ctx, resource: Router) -> dict:
-        routers = self._neutron.list_routers(name=resource.name)
-
-        if "routers" not in routers:
-            return {}
-
-        filtered_list = [rt for rt in routers["routers"] if rt["name"] == resource.name]
+        routers = self._neutron_list("routers", name=resource.name)
+        filtered_list = [rt for rt in routers if rt["name"] == resource.name]
 
         if len(filtered_list) == 0:
             return {}
@@ -1123,7 +3075,7 @@ class RouterHandler(OpenStackHandler):
 @provider("openstack::Subnet", name="openstack")
 class SubnetHandler(OpenStackHandler):
     def read_resource(self, ctx: handler.HandlerContext, resource: resources.PurgeableResource) -> None:
-        neutron_version = self.facts(ctx, resource)
+        neutron_version = self._select(self._neutron_list("subnets", name=resource.name), resource.name)
 
         if len(neutron_version) > 0:
             resource.purged = False
@@ -1160,12 +3112,14 @@ class SubnetHandler(OpenStackHandler):
         if len(resource.dns_servers) > 0:
             body["dns_nameservers"] = resource.dns_servers
 
-        self._neutron.create_subnet({"subnet": body})
+        result = self._neutron.create_subnet({"subnet": body})
+        self._inventory_put("subnets", result["subnet"])
         ctx.set_created()
 
     def delete_resource(self, ctx: handler.HandlerContext, resource: resources.PurgeableResource) -> None:
         neutron = ctx.get("neutron")
-        self._neutron.delete_subnet(neutron["id"])
+        self._delete("delete_subnet", self._neutron.delete_subnet, neutron["id"])
+        self._inventory_remove("subnets", neutron["id"])
         ctx.set_purged()
 
     def update_resource(self, ctx: handler.HandlerContext, changes: dict, resource: resources.PurgeableResource) -> None:
@@ -1180,17 +3134,17 @@ class SubnetHandler(OpenStackHandler):
         if len(resource.dns_servers) > 0:
             body["dns_nameservers"] = resource.dns_servers
 
-        self._neutron.update_subnet(neutron["id"], body)
+        result = self._neutron.update_subnet(neutron["id"], body)
+        self._inventory_put("subnets", result["subnet"])
         ctx.set_updated()
 
     @cache(timeout=5)
     def facts(self, ctx, resource):
-        subnets = self._neutron.list_subnets(name=resource.name)
-
-        if "subnets" not in subnets:
-            return {}
+        return self._select(self._facts_lookup("subnets", "name", resource.name), resource.name)
 
-        filtered_list = [sn for sn in subnets["subnets"] if sn["name"] == resource.name]
+    @staticmethod
+    def _select(subnets, name):
+        filtered_list = [sn for sn in subnets if sn["name"] == name]
 
         if len(filtered_list) == 0:
             return {}
@@ -1274,6 +3228,7 @@ class RouterPortHandler(OpenStackHandler):
 
         # attach it to the router
         self._neutron.add_interface_router(router["id"], body={"port_id": port_id})
+        self._inventory_refresh("ports", port_id)
         ctx.set_created()
 
     def delete_resource(self, ctx: handler.HandlerContext, resource: resources.PurgeableResource) -> None:
@@ -1286,18 +3241,15 @@ class RouterPortHandler(OpenStackHandler):
         else:
             self._neutron.delete_port(port["id"])
 
+        self._inventory_remove("ports", port["id"])
         ctx.set_purged()
 
     def update_resource(self, ctx: handler.HandlerContext, changes: dict, resource: resources.PurgeableResource) -> None:
         raise SkipResource("Making changes to router ports is not supported.")
 
     def facts(self, ctx, resource: RouterPort):
-        ports = self._neutron.list_ports(name=resource.name)
-
-        if "ports" not in ports:
-            return {}
-
-        filtered_list = [port for port in ports["ports"] if port["name"] == resource.name]
+        ports = self._neutron_list("ports", name=resource.name)
+        filtered_list = [port for port in ports if port["name"] == resource.name]
 
         if len(filtered_list) == 0:
             return {}
@@ -1313,7 +3265,7 @@ class RouterPortHandler(OpenStackHandler):
 @provider("openstack::HostPort", name="openstack")
 class HostPortHandler(OpenStackHandler):
     def get_port(self, ctx, network_id, device_id):
-        ports = self._neutron.list_ports(network_id=network_id, device_id=device_id)["ports"]
+        ports = self._neutron_list("ports", network_id=network_id, device_id=device_id)
         ctx.debug("Retrieved ports matching network %(network_id)s and device %(device_id)s",
                   network_id=network_id, device_id=device_id, ports=ports)
         if len(ports) > 0:
@@ -1325,17 +3277,22 @@ class HostPortHandler(OpenStackHandler):
             A port cannot be attached to a VM when the VM is in the building state. This method waits a limited amount of
             time for the VM to become active. If it takes to long, this resource will be skipped.
         """
-        tries = 0
-        max_attempts = resource.retries if resource.retries > 0 else 1
-        while tries < max_attempts:
-            vm = self.get_host(project_id, resource.host)
-            vm_state = getattr(vm, "OS-EXT-STS:vm_state")
-            if vm_state == "active":
-                return vm
+        vm = self.get_host(project_id, resource.host)
+        if vm is None:
+            return None
+
+        vm_state = getattr(vm, "OS-EXT-STS:vm_state")
+        if vm_state == "active":
+            return vm
+
+        ctx.info("VM for port is not in active state. Waiting until it is active.")
+        timeout = (resource.retries if resource.retries > 0 else 1) * resource.wait
+        done, vm = self._wait_manager().wait_for_active_server(resource.host, timeout)
+        if done:
+            return vm
 
-            ctx.info("VM for port is not in active state. Waiting and retrying in 5 seconds.")
-            tries += 1
-            time.sleep(resource.wait)
+        if vm is not None:
+            vm_state = getattr(vm, "OS-EXT-STS:vm_state")
 
         raise SkipResource("Unable to create host port because vm is not in active state (current %s)" % vm_state)
 
@@ -1412,8 +3369,11 @@ class HostPortHandler(OpenStackHandler):
 
             port_id = result["port"]["id"]
 
-            # attach it to the host
-            vm.interface_attach(port_id, None, None)
+            # attach it to the host, the server conflicts while a task such as building or attaching another port runs.
+            # Attaching is not idempotent, a lost response of an attach that succeeded must not attach the port again.
+            self._retry.call("interface_attach", vm.interface_attach, port_id, None, None, conflicts=True,
+                             idempotent=False)
+            self._inventory_refresh("ports", port_id)
         except novaclient.exceptions.Conflict as e:
             raise SkipResource("Host is not ready: %s" % str(e), e)
 
@@ -1422,6 +3382,7 @@ class HostPortHandler(OpenStackHandler):
     def delete_resource(self, ctx: handler.HandlerContext, resource: resources.PurgeableResource) -> None:
         port = ctx.get("port")
         response = self._neutron.delete_port(port["id"])
+        self._inventory_remove("ports", port["id"])
         ctx.info("Deleted port %(port_id)s with response %(response)s", port_id=port["id"], response=response)
         ctx.set_purged()
 
@@ -1431,31 +3392,30 @@ class HostPortHandler(OpenStackHandler):
         try:
             if ctx.get("portsecurity") and "portsecurity" in changes:
                 if not changes["portsecurity"]["desired"]:
-                    self._neutron.update_port(port=port["id"], body={"port": {"port_security_enabled": False,
-                                                                              "security_groups": None}})
+                    result = self._retry.call("update_port", self._neutron.update_port, port=port["id"], conflicts=True,
+                                              body={"port": {"port_security_enabled": False, "security_groups": None}})
+                    self._inventory_put("ports", result["port"])
                 else:
                     raise SkipResource("Turning port security on again is not supported.")
 
                 del changes["portsecurity"]
 
             if "name" in changes:
-                self._neutron.update_port(port=port["id"], body={"port": {"name": resource.name}})
+                result = self._retry.call("update_port", self._neutron.update_port, port=port["id"], conflicts=True,
+                                          body={"port": {"name": resource.name}})
+                self._inventory_put("ports", result["port"])
                 del changes["name"]
 
             if len(changes) > 0:
                 raise SkipResource("not implemented, %s" % changes)
 
-        except novaclient.exceptions.Conflict as e:
+        except (novaclient.exceptions.Conflict, exceptions.Conflict) as e:
             raise SkipResource("Host is not ready: %s" % str(e))
 
     @cache(timeout=5)
     def facts(self, ctx, resource):
-        ports = self._neutron.list_ports(name=resource.name)
-
-        if "ports" not in ports:
-            return {}
-
-        filtered_list = [port for port in ports["ports"] if port["name"] == resource.name]
+        ports = self._facts_lookup("ports", "name", resource.name)
+        filtered_list = [port for port in ports if port["name"] == resource.name]
 
         if len(filtered_list) == 0:
             return {}
@@ -1477,6 +3437,13 @@ class HostPortHandler(OpenStackHandler):
 
 @provider("openstack::SecurityGroup", name="openstack")
 class SecurityGroupHandler(OpenStackHandler):
+    @cache(timeout=INVENTORY_TIMEOUT, for_version=True)
+    def get_security_group_map(self, auth_url, project, admin_user, admin_password, version):
+        return SecurityGroupMap()
+
+    def _sg_map(self):
+        return self.get_security_group_map(*self._credentials, version=self._version)
+
     def _build_current_rules(self, ctx, security_group):
         rules = []
         for rule in security_group["security_group_rules"]:
@@ -1493,8 +3460,7 @@ class SecurityGroupHandler(OpenStackHandler):
                 current_rule["remote_ip_prefix"] = rule["remote_ip_prefix"]
 
             elif rule["remote_group_id"] is not None:
-                rgi = self.get_security_group(ctx, group_id=rule["remote_group_id"])
-                current_rule["remote_group"] = rgi["name"]
+                current_rule["remote_group"] = self._sg_map().get_name(self._neutron, rule["remote_group_id"])
 
             else:
                 current_rule["remote_ip_prefix"] = "0.0.0.0/0"
@@ -1507,74 +3473,119 @@ class SecurityGroupHandler(OpenStackHandler):
 
         return rules
 
+    @staticmethod
+    def _parse_description(description):
+        """
+            Split the description of a group in the description of the model and the digest and revision of the rules
+            that were stored in it after the last rule sync.
+        """
+        match = RULES_MARKER.match(description or "")
+        if match is None:
+            return description, None, None
+
+        return match.group("description"), match.group("digest"), int(match.group("revision"))
+
+    def _get_security_group_summary(self, ctx, name):
+        """
+            Get the security group without its rules
+        """
+        if self._inventory is not None:
+            return self.get_security_group(ctx, name=name)
+
+        sgs = self._neutron.list_security_groups(name=name, fields=["id", "name", "description", "revision_number"])
+        if len(sgs["security_groups"]) == 0:
+            return None
+
+        return sgs["security_groups"][0]
+
     def read_resource(self, ctx: handler.HandlerContext, resource: SecurityGroup) -> None:
-        sg = self.get_security_group(ctx, name=resource.name)
+        summary = self._get_security_group_summary(ctx, resource.name)
+        if summary is None:
+            ctx.set("sg", None)
+            raise ResourcePurged()
+
+        resource.purged = False
+        resource.description, digest, revision = self._parse_description(summary["description"])
+        if digest == resource.rules_digest and revision == summary.get("revision_number"):
+            # the rules are unchanged since they were synced by this handler
+            ctx.set("sg", summary)
+            return
 
+        sg = self.get_security_group(ctx, name=resource.name)
         ctx.set("sg", sg)
         if sg is None:
             raise ResourcePurged()
 
-        resource.purged = False
-        resource.description = sg["description"]
+        resource.description, digest, revision = self._parse_description(sg["description"])
         resource.rules = self._build_current_rules(ctx, sg)
+        if "revision_number" in sg and digest != resource.rules_digest:
+            # the digest of the rules in the model needs to be stored. A group with the right digest but another
+            # revision, because it was changed by someone else, is compared on its rules and only updated when they
+            # differ, so a revision that can not be predicted does not update the group on every deploy.
+            resource.rules_digest = ""
 
-    def _compare_rule(self, old, new):
-        old_keys = set([x for x in old.keys() if not x.startswith("__")])
-        new_keys = set([x for x in new.keys() if not x.startswith("__")])
-
-        if old_keys != new_keys:
-            return False
+    @staticmethod
+    def _rule_key(rule):
+        """
+            A hashable representation of a rule, without the attributes that start with __ such as the id
+        """
+        return tuple(sorted((k, v) for k, v in rule.items() if not k.startswith("__")))
 
-        for key in old_keys:
-            if old[key] != new[key]:
-                return False
+    def _diff_rules(self, current_rules, desired_rules):
+        """
+            Return the current rules that are not desired and the desired rules that do not exist yet. Each current rule
+            matches at most one desired rule.
+        """
+        current = {}
+        for rule in current_rules:
+            current.setdefault(self._rule_key(rule), []).append(rule)
+
+        new_rules = []
+        for rule in desired_rules:
+            matches = current.get(self._rule_key(rule))
+            if matches:
+                matches.pop(0)
+            else:
+                new_rules.append(rule)
 
-        return True
+        old_rules = [rule for rules in current.values() for rule in rules]
+        return old_rules, new_rules
 
     def _diff(self, current, desired):
         changes = OpenStackHandler._diff(self, current, desired)
 
         if "rules" in changes:
-            old_rules = list(changes["rules"]["current"])
-            new_rules = list(changes["rules"]["desired"])
-
-            for new_rule in changes["rules"]["desired"]:
-                for old_rule in changes["rules"]["current"]:
-                    if self._compare_rule(old_rule, new_rule):
-                        old_rules.remove(old_rule)
-                        new_rules.remove(new_rule)
-                        break
-
+            old_rules, new_rules = self._diff_rules(changes["rules"]["current"], changes["rules"]["desired"])
             if len(old_rules) == 0 and len(new_rules) == 0:
                 del changes["rules"]
 
         return changes
 
     def _update_rules(self, group_id, resource, current_rules, desired_rules):
-        # # Update rules. First add all new rules, than remove unused rules
-        old_rules = list(current_rules)
-        # new_rules = [dict(x) for x in desired_rules]
-        new_rules = list(desired_rules)
-
-        for new_rule in desired_rules:
-            for old_rule in current_rules:
-                if self._compare_rule(old_rule, new_rule):
-                    old_rules.remove(old_rule)
-                    new_rules.remove(new_rule)
-                    break
+        """
+            Add all new rules and then remove the unused rules.
 
+            :return: False when a rule was skipped because its remote group does not exist yet
+        """
+        old_rules, new_rules = self._diff_rules(current_rules, desired_rules)
+
+        complete = True
+        bodies = []
         for new_rule in new_rules:
+            new_rule = dict(new_rule)
             new_rule["ethertype"] = "IPv4"
             if "remote_group" in new_rule:
                 if new_rule["remote_group"] is not None:
                     # lookup the id of the group
-                    groups = self._neutron.list_security_groups(name=new_rule["remote_group"])["security_groups"]
-                    if len(groups) == 0:
-                        # TODO: log skip rule
-                        continue  # Do not update this rule
+                    remote_group_id = self._sg_map().get_id(self._neutron, new_rule["remote_group"])
+                    if remote_group_id is None:
+                        LOGGER.warning("Skipping a rule of security group %s because its remote group %s does not exist "
+                                       "yet", resource.name, new_rule["remote_group"])
+                        complete = False
+                        continue
 
                     del new_rule["remote_group"]
-                    new_rule["remote_group_id"] = groups[0]["id"]
+                    new_rule["remote_group_id"] = remote_group_id
 
                 else:
                     del new_rule["remote_group_id"]
@@ -1584,53 +3595,97 @@ class SecurityGroupHandler(OpenStackHandler):
             if new_rule["protocol"] == "all":
                 new_rule["protocol"] = None
 
+            bodies.append(new_rule)
+
+        def create_rule(rule):
             try:
-                self._neutron.create_security_group_rule({'security_group_rule': new_rule})
+                self._retry.call("create_security_group_rule", self._neutron.create_security_group_rule,
+                                 {"security_group_rule": rule}, conflicts=False, idempotent=False)
             except exceptions.Conflict:
-                LOGGER.exception("Rule conflict for rule %s", new_rule)
-                raise
+                # the rule already exists
+                pass
+
+        # create the rules with bulk requests. A bulk request that is sent again after it succeeded is rejected with a
+        # conflict, which is resolved by creating the rules one by one.
+        for i in range(0, len(bodies), RULE_BATCH_SIZE):
+            batch = bodies[i:i + RULE_BATCH_SIZE]
+            try:
+                self._retry.call("create_security_group_rules", self._neutron.create_security_group_rule,
+                                 {"security_group_rules": batch})
+            except exceptions.Conflict:
+                # a bulk request is rejected as a whole when one of the rules already exists, for example because it was
+                # added after the rules were read
+                LOGGER.warning("Rule conflict for one of the rules in a batch of %d, creating them one by one", len(batch))
+                self.concurrent_map(create_rule, batch)
 
-        for old_rule in old_rules:
+        def delete_rule(old_rule):
             try:
                 self._neutron.delete_security_group_rule(old_rule["__id"])
             except exceptions.NotFound:
-                # TODO: handle this
-                pass
+                # the rule was already removed, for example together with its remote group
+                LOGGER.debug("Rule %s of security group %s was already deleted", old_rule["__id"], resource.name)
+
+        self.concurrent_map(delete_rule, old_rules)
+
+        self._inventory_refresh("security_groups", group_id)
+        return complete
 
     def create_resource(self, ctx: handler.HandlerContext, resource: SecurityGroup) -> None:
         sg = self._neutron.create_security_group({"security_group": {"name": resource.name,
                                                                      "description": resource.description}})
+        self._inventory_put("security_groups", sg["security_group"])
+        self._sg_map().put(sg["security_group"])
         current_rules = self._build_current_rules(ctx, sg["security_group"])
-        self._update_rules(sg["security_group"]["id"], resource, current_rules, resource.rules)
+        complete = self._update_rules(sg["security_group"]["id"], resource, current_rules, resource.rules)
+        self._update_group(sg["security_group"]["id"], resource, complete)
         ctx.set_created()
 
     def delete_resource(self, ctx: handler.HandlerContext, resource: SecurityGroup) -> None:
         sg = ctx.get("sg")
-        tries = 0
-        max_attempts = resource.retries if resource.retries > 0 else 1
-        while tries < max_attempts:
-            try:
-                self._neutron.delete_security_group(sg["id"])
-                ctx.set_purged()
-                return
-            except Exception:
-                ctx.info("Delete failed. Waiting and trying again in 5 seconds.")
-                time.sleep(resource.wait)
-                tries += 1
+        timeout = (resource.retries if resource.retries > 0 else 1) * resource.wait
+        try:
+            self._delete("delete_security_group", self._neutron.delete_security_group, sg["id"], timeout=timeout)
+        except exceptions.Conflict:
+            raise SkipResource("Deleting the security group failed, probably because it is still in use.")
+
+        self._inventory_remove("security_groups", sg["id"])
+        self._sg_map().remove(sg["id"])
+        ctx.set_purged()
 
-        raise SkipResource("Deleting the security group failed, probably because it is still in use.")
 
+    def _update_group(self, group_id, resource, complete=True):
+        """
+            Update the name and description of the group. The digest of the rules is stored in the description together
+            with the revision the group has after this update, so the next read can skip the rules when neither the model
+            nor the group changed. When not all rules could be synced no digest is stored, so the next read compares the
+            rules again.
+        """
+        group = self._neutron.show_security_group(group_id, fields=["revision_number"])["security_group"]
+        description = resource.description
+        revision = None
+        if complete and "revision_number" in group:
+            revision = group["revision_number"] + 1
+            marker = "[rules %s@%d]" % (resource.rules_digest, revision)
+            description = "%s %s" % (description, marker) if description != "" else marker
+
+        result = self._neutron.update_security_group(group_id, {"security_group": {"name": resource.name,
+                                                                                   "description": description}})
+        if revision is not None and result["security_group"].get("revision_number") != revision:
+            # the next reads compare the rules, the group is only updated again when they differ
+            LOGGER.info("Security group %s has revision %s instead of %d after the update, its rules are read again on "
+                        "the next deploy", resource.name, result["security_group"].get("revision_number"), revision)
+        self._inventory_put("security_groups", result["security_group"])
+        self._sg_map().put(result["security_group"])
 
     def update_resource(self, ctx: handler.HandlerContext, changes: dict, resource: SecurityGroup) -> None:
         sg = ctx.get("sg")
-        if "name" in changes or "description" in changes:
-            self._neutron.update_security_group(sg["id"], {"security_group": {"name": resource.name,
-                                                                              "description": resource.description}})
-            ctx.set_updated()
-
+        complete = True
         if "rules" in changes:
-            self._update_rules(sg["id"], resource, changes["rules"]["current"], changes["rules"]["desired"])
-            ctx.set_updated()
+            complete = self._update_rules(sg["id"], resource, changes["rules"]["current"], changes["rules"]["desired"])
+
+        # also store the digest of the rules that are now in sync
+        self._update_group(sg["id"], resource, complete)
+        ctx.set_updated()
 
     @cache(timeout=5)
     def facts(self, ctx, resource):
@@ -1641,7 +3696,7 @@ class SecurityGroupHandler(OpenStackHandler):
 class FloatingIPHandler(OpenStackHandler):
     @cache(timeout=10)
     def get_port_id(self, name):
-        ports = self._neutron.list_ports(name=name)["ports"]
+        ports = self._neutron_list("ports", name=name)
         if len(ports) == 0:
             return None
 
@@ -1652,7 +3707,7 @@ class FloatingIPHandler(OpenStackHandler):
 
     @cache(timeout=10)
     def get_floating_ip(self, port_id):
-        fip = self._neutron.list_floatingips(port_id=port_id)["floatingips"]
+        fip = self._neutron_list("floatingips", port_id=port_id)
         if len(fip) == 0:
             return None
 
@@ -1672,7 +3727,7 @@ class FloatingIPHandler(OpenStackHandler):
 
     def _find_available_fips(self, project_id, network_id):
         available_fips = []
-        floating_ips = self._neutron.list_floatingips(floating_network_id=network_id, tenant_id=project_id)["floatingips"]
+        floating_ips = self._neutron_list("floatingips", floating_network_id=network_id, tenant_id=project_id)
         for fip in floating_ips:
             if fip["port_id"] is None:
                 available_fips.append(fip)
@@ -1693,16 +3748,20 @@ class FloatingIPHandler(OpenStackHandler):
         available_fips = self._find_available_fips(project_id, network_id)
         if len(available_fips) > 0:
             fip_id = available_fips[0]["id"]
-            self._neutron.update_floatingip(fip_id, {"floatingip": {"port_id": port_id, "description": resource.name}})
+            result = self._neutron.update_floatingip(fip_id, {"floatingip": {"port_id": port_id,
+                                                                             "description": resource.name}})
 
         else:
-            self._neutron.create_floatingip({"floatingip": {"port_id": port_id, "floating_network_id": network_id,
-                                                            "description": resource.name}})
+            result = self._neutron.create_floatingip({"floatingip": {"port_id": port_id, "floating_network_id": network_id,
+                                                                     "description": resource.name}})
+
+        self._inventory_put("floatingips", result["floatingip"])
 
         ctx.set_created()
 
     def delete_resource(self, ctx: handler.HandlerContext, resource: FloatingIP) -> None:
         self._neutron.delete_floatingip(ctx.get("fip"))
+        self._inventory_remove("floatingips", ctx.get("fip"))
         ctx.set_purged()
 
     def update_resource(self, ctx: handler.HandlerContext, changes: dict, resource: FloatingIP) -> None:
@@ -1710,8 +3769,11 @@ class FloatingIPHandler(OpenStackHandler):
 
     @cache(timeout=5)
     def facts(self, ctx, resource):
-        port_id = self.get_port_id(resource.port)
-        fip = self._neutron.list_floatingips(port_id=port_id)["floatingips"]
+        ports = self._facts_lookup("ports", "name", resource.port)
+        if len(ports) != 1:
+            return {}
+
+        fip = self._facts_lookup("floatingips", "port_id", ports[0]["id"])
         if len(fip) == 0:
             return {}
 
@@ -1719,32 +3781,6 @@ class FloatingIPHandler(OpenStackHandler):
             return {"ip_address": fip[0]["floating_ip_address"]}
 
 
-@dependency_manager
-def keystone_dependencies(config_model, resource_model):
-    projects = {}
-    users = {}
-    roles = []
-    for _, res in resource_model.items():
-        if res.id.entity_type == "openstack::Project":
-            projects[res.name] = res
-
-        elif res.id.entity_type == "openstack::User":
-            users[res.name] = res
-
-        elif res.id.entity_type == "openstack::Role":
-            roles.append(res)
-
-    for role in roles:
-        if role.project not in projects:
-            raise Exception("The project %s of role %s is not defined in the model." % (role.project, role.role_id))
-
-        if role.user not in users:
-            raise Exception("The user %s of role %s is not defined in the model." % (role.user, role.role_id))
-
-        role.requires.add(projects[role.project])
-        role.requires.add(users[role.user])
-
-
 @provider("openstack::Project", name="openstack")
 class ProjectHandler(OpenStackHandler):
     def read_resource(self, ctx, resource):
@@ -1758,23 +3794,27 @@ class ProjectHandler(OpenStackHandler):
             raise ResourcePurged()
 
     def create_resource(self, ctx, resource: resources.PurgeableResource) -> None:
-        self._keystone.projects.create(resource.name, description=resource.description, enabled=resource.enabled,
-                                       domain="default")
+        project = self._keystone.projects.create(resource.name, description=resource.description,
+                                                 enabled=resource.enabled, domain="default")
+        self._project_directory().put(project)
         ctx.set_created()
 
     def delete_resource(self, ctx, resource: resources.PurgeableResource) -> None:
-        ctx.get("project").delete()
+        project = ctx.get("project")
+        project.delete()
+        self._project_directory().remove(project.id)
         ctx.set_purged()
 
     def update_resource(self, ctx, changes: dict, resource: resources.PurgeableResource) -> None:
-        ctx.get("project").update(name=resource.name, description=resource.description, enabled=resource.enabled)
+        project = ctx.get("project").update(name=resource.name, description=resource.description,
+                                            enabled=resource.enabled)
+        self._project_directory().put(project)
         ctx.set_updated()
 
     def facts(self, ctx, resource: Project):
-        keystone = self.get_connection(resource)
         try:
-            project = keystone.tenants.find(name=resource.name)
-            return {"id": project.id, "name": project.name}
+            project_id = self._project_directory().get_id(self._keystone, resource.name)
+            return {"id": project_id, "name": resource.name}
         except Exception:
             return {}
 
@@ -1792,26 +3832,42 @@ class UserHandler(OpenStackHandler):
             # if a password is provided (not ""), check if it works otherwise mark it as "***"
             if resource.password != "":
                 try:
-                    s = keystone_client.Client(auth_url=resource.auth_url, username=resource.name, password=resource.password)
-                    s.authenticate()
+                    checks = self.get_password_checks(*self._credentials)
+                    if not checks.check(resource.name, resource.password, lambda: self._verify_password(resource),
+                                        getattr(resource, "password_check_ttl", PASSWORD_CHECK_TTL)):
+                        resource.password = "***"
                 except Exception:
                     resource.password = "***"
 
         except NotFound:
             raise ResourcePurged()
 
+    def _verify_password(self, resource):
+        """
+            Request an unscoped token for the user over the pooled connections of the provider
+        """
+        auth = v3.Password(auth_url=resource.auth_url, username=resource.name, password=resource.password,
+                           user_domain_id="default")
+        try:
+            self.get_session(*self._credentials, self._session_options).get_token(auth=auth)
+            return True
+        except Unauthorized:
+            return False
+
     def create_resource(self, ctx, resource: resources.PurgeableResource) -> None:
         self._keystone.users.create(resource.name, password=resource.password, email=resource.email, enabled=resource.enabled)
         ctx.set_created()
 
     def delete_resource(self, ctx, resource: resources.PurgeableResource) -> None:
         ctx.get("user").delete()
+        self._role_assignments().remove_user(resource.name)
         ctx.set_purged()
 
     def update_resource(self, ctx, changes: dict, resource: resources.PurgeableResource) -> None:
         user_id = ctx.get("user").id
         if resource.password != "":
             self._keystone.users.update(user_id, password=resource.password, email=resource.email, enabled=resource.enabled)
+            self.get_password_checks(*self._credentials).invalidate(resource.name)
         else:
             self._keystone.users.update(user_id, email=resource.email, enabled=resource.enabled)
         ctx.set_updated()
@@ -1823,51 +3879,49 @@ class RoleHandler(OpenStackHandler):
         creates roles and user, project, role assocations
     """
     def read_resource(self, ctx, resource):
+        assignments = self._role_assignments()
+
         # get the role
-        role = None
-        try:
-            role = self._keystone.roles.find(name=resource.role)
-        except NotFound:
+        role_id = assignments.get_role_id(self._keystone, resource.role)
+        if role_id is None:
             ctx.info("Role %(role)s does not exit yet.", role=resource.role)
-            pass
 
-        try:
-            user = self._keystone.users.find(name=resource.user)
-        except NotFound:
+        user_id = assignments.get_user_id(self._keystone, resource.user)
+        if user_id is None:
             raise SkipResource("The user does not exist.")
 
         try:
-            project = self._keystone.projects.find(name=resource.project)
+            project_id = self.get_project_id(resource, resource.project)
         except NotFound:
             raise SkipResource("The project does not exist.")
 
-        try:
-            self._keystone.roles.check(role=role, user=user, project=project)
-            resource.purged = False
-        except Exception:
-            resource.purged = True
+        resource.purged = role_id is None or not assignments.has(self._keystone, project_id, user_id, role_id)
 
-        ctx.set("role", role)
-        ctx.set("user", user)
-        ctx.set("project", project)
+        ctx.set("role", role_id)
+        ctx.set("user", user_id)
+        ctx.set("project", project_id)
 
     def create_resource(self, ctx, resource: resources.PurgeableResource) -> None:
-        user = ctx.get("user")
-        project = ctx.get("project")
-        role = ctx.get("role")
+        user_id = ctx.get("user")
+        project_id = ctx.get("project")
+        role_id = ctx.get("role")
 
-        if role is None:
+        if role_id is None:
             role = self._keystone.roles.create(resource.role)
+            self._role_assignments().put_role(role)
+            role_id = role.id
 
-        self._keystone.roles.grant(user=user, role=role, project=project)
+        self._keystone.roles.grant(user=user_id, role=role_id, project=project_id)
+        self._role_assignments().grant(project_id, user_id, role_id)
         ctx.set_created()
 
     def delete_resource(self, ctx, resource: resources.PurgeableResource) -> None:
-        user = ctx.get("user")
-        project = ctx.get("project")
-        role = ctx.get("role")
+        user_id = ctx.get("user")
+        project_id = ctx.get("project")
+        role_id = ctx.get("role")
 
-        self._keystone.roles.revoke(user=user, role=role, project=project)
+        self._keystone.roles.revoke(user=user_id, role=role_id, project=project_id)
+        self._role_assignments().revoke(project_id, user_id, role_id)
         ctx.set_purged()
 
     def update_resource(self, ctx, changes: dict, resource: resources.PurgeableResource) -> None:
@@ -1877,12 +3931,11 @@ class RoleHandler(OpenStackHandler):
 @provider("openstack::Service", name="openstack")
 class ServiceHandler(OpenStackHandler):
     def read_resource(self, ctx, resource):
-        service = None
-        try:
-            service = self._keystone.services.find(name=resource.name, type=resource.type)
+        service = self._service_catalog().get_service(self._keystone, "%s_%s" % (resource.type, resource.name))
+        if service is not None:
             resource.description = service.description
             resource.purged = False
-        except NotFound:
+        else:
             resource.purged = True
             resource.description = None
             resource.name = None
@@ -1891,15 +3944,19 @@ class ServiceHandler(OpenStackHandler):
         ctx.set("service", service)
 
     def create_resource(self, ctx, resource: resources.PurgeableResource) -> None:
-        self._keystone.services.create(resource.name, resource.type, description=resource.description)
+        service = self._keystone.services.create(resource.name, resource.type, description=resource.description)
+        self._service_catalog().put_service(service)
         ctx.set_created()
 
     def delete_resource(self, ctx, resource: resources.PurgeableResource) -> None:
-        ctx.get("service").delete()
+        service = ctx.get("service")
+        service.delete()
+        self._service_catalog().remove_service(service.id)
         ctx.set_purged()
 
     def update_resource(self, ctx, changes: dict, resource: resources.PurgeableResource) -> None:
-        self._keystone.services.update(ctx.get("service"), description=resource.description)
+        service = self._keystone.services.update(ctx.get("service"), description=resource.description)
+        self._service_catalog().put_service(service)
         ctx.set_updated()
 
 
@@ -1909,27 +3966,16 @@ class EndpointHandler(OpenStackHandler):
     types = {"admin": "admin_url", "internal": "internal_url", "public": "public_url"}
 
     def read_resource(self, ctx, resource):
-        service = None
-        for s in self._keystone.services.list():
-            if resource.service_id == "%s_%s" % (s.type, s.name):
-                service = s
-
+        catalog = self._service_catalog()
+        service = catalog.get_service(self._keystone, resource.service_id)
         if service is None:
             raise SkipResource("Unable to find service to which endpoint belongs")
 
-        endpoints = {}
-        try:
-            endpoints = {e.interface: e for e in self._keystone.endpoints.list(region=resource.region, service=service)}
-            for k, v in EndpointHandler.types.items():
-                setattr(resource, v, endpoints[k].url if k in endpoints else None)
+        endpoints = catalog.get_endpoints(self._keystone, service.id, resource.region)
+        for k, v in EndpointHandler.types.items():
+            setattr(resource, v, endpoints[k].url if k in endpoints else None)
 
-            resource.purged = False
-        except NotFound:
-            resource.purged = True
-            resource.region = None
-            resource.internal_url = None
-            resource.admin_url = None
-            resource.public_url = None
+        resource.purged = False
 
         ctx.set("service", service)
         ctx.set("endpoints", endpoints)
@@ -1938,20 +3984,202 @@ class EndpointHandler(OpenStackHandler):
         assert False, "Should never get here"
 
     def delete_resource(self, ctx, resource: resources.PurgeableResource) -> None:
-        for endpoint in ctx.get("endpoints"):
+        for endpoint in ctx.get("endpoints").values():
             endpoint.delete()
+            self._service_catalog().remove_endpoint(endpoint)
 
         ctx.set_purged()
 
     def update_resource(self, ctx, changes: dict, resource: resources.PurgeableResource) -> None:
         service = ctx.get("service")
         endpoints = ctx.get("endpoints")
+        catalog = self._service_catalog()
 
         for k, v in EndpointHandler.types.items():
             if k not in endpoints:
-                self._keystone.endpoints.create(service, url=getattr(resource, v), region=resource.region, interface=k)
+                endpoint = self._keystone.endpoints.create(service, url=getattr(resource, v), region=resource.region,
+                                                           interface=k)
+                catalog.put_endpoint(endpoint)
                 ctx.set_created()
 
             elif v in changes:
-                self._keystone.endpoints.update(endpoints[k], url=getattr(resource, v))
+                endpoint = self._keystone.endpoints.update(endpoints[k], url=getattr(resource, v))
+                catalog.put_endpoint(endpoint)
                 ctx.set_updated()
+
+
+class ScanProcess(object):
+    """
+        The process of the agent of a scan. The handlers of this module do not use the io loop of the agent. Like
+        ScanAgent, this mirrors agent internals of inmanta 2017.1 up to 2017.4.
+    """
+    def __init__(self):
+        self._io_loop = None
+
+
+class ScanAgent(object):
+    """
+        Stands in for the agent of the handlers that run in a scan. The handlers run in the current process, like the
+        handlers of an agent with a local uri. This mirrors the agent attributes that Commander.get_provider and the
+        ResourceHandler constructor read in inmanta 2017.1 up to 2017.4: get_hostname() and is_local() in 2017.1, uri and
+        process._io_loop from 2017.4 on. The scanner opens and closes the versions of the shared cache itself, like the
+        agent does around a deploy. Check these stand-ins when the compiler_version of the module changes.
+    """
+    uri = "local:"
+
+    def __init__(self, name):
+        self.name = name
+        self.process = ScanProcess()
+
+    def get_hostname(self):
+        return self.name
+
+    def is_local(self):
+        return True
+
+
+class DriftScanner(object):
+    """
+        Compare the resources of an exported model with the current state of the cloud without changing anything. The
+        read and diff logic of the handlers is executed as a dry run for all resources concurrently. All handlers share
+        one cache, so the neutron inventory and the other indexes of a provider are fetched once with bulk requests.
+    """
+    def __init__(self, max_workers=50):
+        self._cache = AgentCache()
+        self._max_workers = max_workers
+
+    def _provider(self, resource):
+        """
+            A new handler for the resource that uses the cache of the scanner
+        """
+        provider = handler.Commander.get_provider(self._cache, ScanAgent(resource.id.agent_name), resource)
+        provider.set_cache(self._cache)
+        return provider
+
+    def _prefetch(self, resource):
+        try:
+            provider = self._provider(resource)
+            ctx = handler.HandlerContext(resource, dry_run=True)
+            provider.pre(ctx, resource)
+            try:
+                provider.prefetch()
+            finally:
+                provider.post(ctx, resource)
+        except Exception:
+            LOGGER.warning("Unable to prefetch the indexes of agent %s", resource.id.agent_name, exc_info=True)
+
+    def _scan(self, resource):
+        result = {"id": resource.id.resource_str(), "status": "in_sync", "changes": {}}
+        try:
+            ctx = handler.HandlerContext(resource, dry_run=True)
+            self._provider(resource).execute(ctx, resource, dry_run=True)
+            result["changes"] = ctx.changes
+            if ctx.status is not None and ctx.status not in (const.ResourceState.deployed, const.ResourceState.dry):
+                result["status"] = ctx.status.name
+            elif len(ctx.changes) > 0:
+                result["status"] = "drift"
+
+        except Exception as e:
+            result["status"] = "error"
+            result["error"] = str(e)
+
+        return result
+
+    def _run(self, resources):
+        """
+            Prefetch the indexes of every provider and then scan all resources concurrently
+        """
+        # the scan works on copies, so the resources of the caller still deploy the way they were exported
+        resources = [resource.clone(use_inventory=True) if hasattr(resource, "use_inventory") else resource
+                     for resource in resources]
+
+        versions = set(resource.id.version for resource in resources)
+        for version in versions:
+            self._cache.open_version(version)
+
+        try:
+            # one representative resource per provider loads the shared indexes
+            providers = {}
+            for resource in resources:
+                if isinstance(resource, OpenstackResource):
+                    providers.setdefault((resource.auth_url, resource.admin_tenant, resource.admin_user), resource)
+
+            with futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                list(executor.map(self._prefetch, providers.values()))
+                return list(executor.map(self._scan, resources))
+        finally:
+            for version in versions:
+                self._cache.close_version(version)
+
+    def scan(self, resources):
+        """
+            Scan the given resources and return a report with the changes that a deploy would make for each resource
+        """
+        start = time.time()
+        results = self._run(resources)
+        summary = {"total": len(results)}
+        for result in results:
+            summary[result["status"]] = summary.get(result["status"], 0) + 1
+
+        return {"duration": time.time() - start, "summary": summary, "resources": results}
+
+
+class FactsScanner(DriftScanner):
+    """
+        Collect the facts of the resources of an exported model in one batch. The snapshot the facts of each provider are
+        computed from and the index of its servers are loaded once with bulk requests, after which the facts of every
+        resource are lookups in them.
+    """
+    def _prefetch(self, resource):
+        try:
+            provider = self._provider(resource)
+            ctx = handler.HandlerContext(resource)
+            provider.pre(ctx, resource)
+            try:
+                provider.prefetch_facts()
+            finally:
+                provider.post(ctx, resource)
+        except Exception:
+            LOGGER.warning("Unable to prefetch the facts of agent %s", resource.id.agent_name, exc_info=True)
+
+    def _scan(self, resource):
+        try:
+            return self._provider(resource).check_facts(handler.HandlerContext(resource), resource)
+        except Exception:
+            LOGGER.warning("Unable to collect the facts of %s", resource.id.resource_str(), exc_info=True)
+            return {}
+
+    def collect(self, resources):
+        """
+            Return the facts of the given resources by resource id
+        """
+        resources = list(resources)
+        return {resource.id.resource_str(): facts for resource, facts in zip(resources, self._run(resources))}
+
+
+def collect_facts(resources, max_workers=50):
+    """
+        Collect the facts of the given resources, for example the resources of an exported model, in one batch
+
+        :param resources: The resource objects to collect the facts of
+        :param max_workers: The number of resources of which the facts are collected concurrently
+        :return: A dict with the facts of each resource by resource id
+    """
+    return FactsScanner(max_workers).collect(resources)
+
+
+def drift_scan(resources, max_workers=50, output=None):
+    """
+        Run a read only drift scan on the given resources, for example the resources of an exported model. The report is
+        returned and written as json to output when a path is given.
+
+        :param resources: The resource objects to scan
+        :param max_workers: The number of resources that are scanned concurrently
+        :param output: An optional path to write the json report to
+    """
+    report = DriftScanner(max_workers).scan(resources)
+    if output is not None:
+        with open(output, "w") as fd:
+            json.dump(report, fd, indent=2, default=str)
+
+    return report
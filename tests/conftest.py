@@ -15,9 +15,12 @@
 
     Contact: code@inmanta.com
 """
+import importlib
 import os
 import pytest
 
+import fake_openstack
+
 from neutronclient.neutron import client as neutron_client
 from novaclient import client as nova_client
 from keystoneclient.auth.identity import v3
@@ -25,8 +28,69 @@ from keystoneauth1 import session as keystone_session
 from keystoneclient.v3 import client as keystone_client
 
 
+def pytest_addoption(parser):
+    parser.addoption("--fake-openstack", action="store_true", default=False,
+                     help="Run the tests against an in-memory fake of the OpenStack APIs instead of the cloud in OS_AUTH_URL. "
+                          "The fake is also used when OS_AUTH_URL is not set.")
+    parser.addoption("--update-api-budgets", action="store_true", default=False,
+                     help="Record the API requests made by the handlers in tests/api_budgets.json instead of checking them "
+                          "against the budgets in that file.")
+
+
+@pytest.fixture(scope="session")
+def fake_cloud():
+    """
+        An in-memory fake of the keystone, nova, neutron and glance APIs, running in a thread of the test process
+    """
+    cloud = fake_openstack.FakeOpenStack().start()
+    yield cloud
+    cloud.stop()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def openstack_environment(request, tmpdir_factory):
+    """
+        Point the OS_* environment variables, and with them the test models and clients, at the fake cloud when no cloud
+        is configured or when --fake-openstack is passed.
+    """
+    if not request.config.getoption("--fake-openstack") and "OS_AUTH_URL" in os.environ:
+        yield None
+        return
+
+    cloud = request.getfixturevalue("fake_cloud")
+    environment = dict(cloud.environment())
+    environment["INMANTA_OPENSTACK_TOKEN_DIR"] = str(tmpdir_factory.mktemp("tokens"))
+    environment["INMANTA_OPENSTACK_CATALOG_DIR"] = str(tmpdir_factory.mktemp("catalog"))
+
+    saved = {name: os.environ.get(name) for name in environment}
+    os.environ.update(environment)
+    yield cloud
+
+    for name, value in saved.items():
+        if value is None:
+            del os.environ[name]
+        else:
+            os.environ[name] = value
+
+
+@pytest.fixture
+def fake_os(request):
+    """
+        The fake cloud the tests run against, without injected faults and with an empty call log. Tests that use this
+        fixture are skipped when the suite runs against a real cloud.
+    """
+    cloud = request.getfixturevalue("openstack_environment")
+    if cloud is None:
+        pytest.skip("This test needs the fake cloud, run with --fake-openstack")
+
+    cloud.clear_faults()
+    cloud.clear_calls()
+    yield cloud
+    cloud.clear_faults()
+
+
 @pytest.fixture(scope="session")
-def session():
+def session(openstack_environment):
     auth_url = os.environ["OS_AUTH_URL"]
     username = os.environ["OS_USERNAME"]
     password = os.environ["OS_PASSWORD"]
@@ -50,3 +114,12 @@ def neutron(session):
 @pytest.fixture(scope="session")
 def keystone(session):
     yield keystone_client.Client(session=session)
+
+
+@pytest.fixture
+def plugin_module(project):
+    """
+        The python module with the plugins and handlers of the openstack module
+    """
+    project.compile("import openstack")
+    yield importlib.import_module("inmanta_plugins.openstack")
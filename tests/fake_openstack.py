@@ -0,0 +1,1541 @@
+"""
+    Copyright 2017 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+
+    An in-memory stand-in for the parts of the keystone v3, nova, neutron and glance APIs that the handlers and plugins
+    of this module use. The state lives in the process that runs the server, so the handlers can be tested and measured
+    without a cloud. Latency, errors and rate limits can be injected per service, method and path.
+
+    Run this file to start a standalone server, optionally seeded with a large number of servers and ports:
+
+        python tests/fake_openstack.py --port 5000 --servers 100000 --ports 100000
+"""
+import argparse
+import datetime
+import ipaddress
+import json
+import logging
+import random
+import re
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+LOGGER = logging.getLogger(__name__)
+
+ADMIN_USER = "admin"
+ADMIN_PASSWORD = "admin"
+ADMIN_PROJECT = "admin"
+REGION = "RegionOne"
+DOMAIN_ID = "default"
+
+NEUTRON_KINDS = {"networks": "network", "subnets": "subnet", "ports": "port", "routers": "router",
+                 "security-groups": "security_group", "security-group-rules": "security_group_rule",
+                 "floatingips": "floatingip"}
+KEYSTONE_KINDS = {"projects": "project", "users": "user", "roles": "role", "services": "service", "endpoints": "endpoint",
+                  "domains": "domain", "regions": "region"}
+MAX_LIMIT = 1000
+PAGING_PARAMETERS = ("fields", "limit", "marker", "sort_key", "sort_dir", "page_reverse", "page_size")
+
+IMAGE_SCHEMA = {
+    "name": "image",
+    "properties": {
+        "id": {"type": "string"},
+        "name": {"type": ["null", "string"]},
+        "status": {"type": "string"},
+        "visibility": {"type": "string"},
+        "protected": {"type": "boolean"},
+        "checksum": {"type": ["null", "string"]},
+        "owner": {"type": ["null", "string"]},
+        "size": {"type": ["null", "integer"]},
+        "min_ram": {"type": "integer"},
+        "min_disk": {"type": "integer"},
+        "disk_format": {"type": ["null", "string"]},
+        "container_format": {"type": ["null", "string"]},
+        "created_at": {"type": "string"},
+        "updated_at": {"type": "string"},
+        "tags": {"type": "array", "items": {"type": "string"}},
+        "self": {"type": "string"},
+        "file": {"type": "string"},
+        "schema": {"type": "string"},
+    },
+    "additionalProperties": {"type": "string"},
+    "links": [{"rel": "self", "href": "{self}"}, {"rel": "enclosure", "href": "{file}"},
+              {"rel": "describedby", "href": "{schema}"}],
+}
+
+
+def timestamp(when=None):
+    return datetime.datetime.utcfromtimestamp(time.time() if when is None else when).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def new_id():
+    return str(uuid.uuid4())
+
+
+class ApiError(Exception):
+    """
+        An error response of the API
+    """
+    def __init__(self, status, message, kind=None, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.kind = kind
+        self.headers = headers or {}
+
+
+class NotFound(ApiError):
+    def __init__(self, what, kind=None):
+        super().__init__(404, "%s could not be found." % what, kind)
+
+
+class Conflict(ApiError):
+    def __init__(self, message, kind=None):
+        super().__init__(409, message, kind)
+
+
+class Fault(object):
+    """
+        A fault injected in the calls that match the service, method and path. A fault adds latency, returns an error
+        status or both. The fault applies to a fraction of the matching calls given by probability and stops after count
+        calls when count is set.
+    """
+    def __init__(self, service=None, method=None, path=None, latency=0, status=None, probability=1.0, count=None,
+                 seed=None):
+        self.service = service
+        self.method = method
+        self.path = re.compile(path) if path is not None else None
+        self.latency = latency
+        self.status = status
+        self.probability = probability
+        self.count = count
+        self._random = random.Random(seed)
+
+    def matches(self, service, method, path):
+        if self.count is not None and self.count <= 0:
+            return False
+
+        if self.service is not None and self.service != service:
+            return False
+
+        if self.method is not None and self.method != method:
+            return False
+
+        if self.path is not None and self.path.search(path) is None:
+            return False
+
+        if self.probability < 1 and self._random.random() >= self.probability:
+            return False
+
+        if self.count is not None:
+            self.count -= 1
+
+        return True
+
+
+class RateLimit(object):
+    """
+        A token bucket that allows rate calls per second with bursts of burst calls
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self._tokens = self.burst
+        self._updated = time.time()
+
+    def acquire(self):
+        """
+            Take a token from the bucket. Return None when a token was available, otherwise the number of seconds until
+            the next token is available.
+        """
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return None
+
+        return (1 - self._tokens) / self.rate
+
+
+class Call(object):
+    """
+        A call handled by the fake cloud
+    """
+    def __init__(self, service, method, path, status, duration, request_id=None):
+        self.service = service
+        self.method = method
+        self.path = path
+        self.status = status
+        self.duration = duration
+        self.request_id = request_id
+
+    def __repr__(self):
+        return "%s %s %s -> %d" % (self.service, self.method, self.path, self.status)
+
+
+ROUTES = []
+
+
+def route(service, method, pattern):
+    def register(function):
+        ROUTES.append((service, method, re.compile("^%s/?$" % pattern), function))
+        return function
+
+    return register
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length > 0 else b""
+        body = json.loads(raw.decode()) if len(raw) > 0 else None
+
+        status, data, headers = self.server.cloud.dispatch(self.command, self.path, self.headers, body)
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_HEAD = _dispatch
+
+
+class Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeOpenStack(object):
+    """
+        A stateful, in-memory fake of the keystone v3, nova, neutron and glance APIs
+
+        :param build_time: The number of seconds a new server stays in the BUILD state.
+        :param port_cleanup_time: The number of seconds after the deletion of a server before its ports are removed.
+        :param token_ttl: The number of seconds a token is valid.
+        :param max_limit: The maximum number of items in a page of a nova or neutron list, like osapi_max_limit. Larger
+                          lists are split in pages with next links, also when the client does not ask for a limit.
+    """
+    def __init__(self, host="127.0.0.1", port=0, build_time=0, port_cleanup_time=0, token_ttl=3600, max_limit=MAX_LIMIT):
+        self.host = host
+        self.port = port
+        self.build_time = build_time
+        self.port_cleanup_time = port_cleanup_time
+        self.token_ttl = token_ttl
+        self.max_limit = max_limit
+        self.revision_step = 1
+        self.lock = threading.RLock()
+        self.calls = []
+        self.faults = []
+        self.rate_limits = {}
+        self.concurrency_limits = {}
+        self.in_flight = {}
+        self._server = None
+        self._thread = None
+        self.reset()
+
+    # server life cycle
+    def start(self):
+        self._server = Server((self.host, self.port), RequestHandler)
+        self._server.cloud = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-openstack", daemon=True)
+        self._thread.start()
+        self._register_catalog()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def url(self):
+        return "http://%s:%d" % (self.host, self.port)
+
+    @property
+    def auth_url(self):
+        return self.url + "/identity/v3"
+
+    def environment(self):
+        """
+            The OS_* environment variables that point the clients and the test models at this cloud
+        """
+        return {"OS_AUTH_URL": self.auth_url, "OS_USERNAME": ADMIN_USER, "OS_PASSWORD": ADMIN_PASSWORD,
+                "OS_PROJECT_NAME": ADMIN_PROJECT, "OS_USER_DOMAIN_ID": DOMAIN_ID, "OS_PROJECT_DOMAIN_ID": DOMAIN_ID,
+                "OS_REGION_NAME": REGION}
+
+    # fault injection
+    def add_fault(self, **kwargs):
+        """
+            Inject a fault, see Fault for the arguments
+        """
+        fault = Fault(**kwargs)
+        with self.lock:
+            self.faults.append(fault)
+
+        return fault
+
+    def add_latency(self, latency, **kwargs):
+        return self.add_fault(latency=latency, **kwargs)
+
+    def add_error(self, status, **kwargs):
+        return self.add_fault(status=status, **kwargs)
+
+    def set_rate_limit(self, rate, burst=None, service=None):
+        """
+            Limit the calls to a service, or to all services, to rate calls per second. Calls over the limit get a 429
+            response with a Retry-After header.
+        """
+        with self.lock:
+            self.rate_limits[service] = RateLimit(rate, burst)
+
+    def set_concurrency_limit(self, limit, service=None):
+        """
+            Answer calls with a 503 while more than limit calls to a service, or to all services, are being handled, like
+            an overloaded API. Only calls that overlap because of injected latency can exceed the limit.
+        """
+        with self.lock:
+            self.concurrency_limits[service] = limit
+
+    def set_max_limit(self, limit):
+        """
+            Change the maximum number of items in a page of a nova or neutron list
+        """
+        with self.lock:
+            self.max_limit = limit
+
+    def set_revision_step(self, step):
+        """
+            Increase the revision_number of a neutron resource by step on every change, like neutron does when a change
+            touches the resource more than once
+        """
+        with self.lock:
+            self.revision_step = step
+
+    def clear_faults(self):
+        with self.lock:
+            self.faults = []
+            self.rate_limits = {}
+            self.concurrency_limits = {}
+            self.max_limit = MAX_LIMIT
+            self.revision_step = 1
+
+    def clear_calls(self):
+        with self.lock:
+            self.calls = []
+
+    # state
+    def reset(self):
+        """
+            Remove all state and create the admin project and user
+        """
+        with self.lock:
+            self.keystone = {kind: {} for kind in KEYSTONE_KINDS}
+            self.passwords = {}
+            self.assignments = set()
+            self.tokens = {}
+            self.neutron = {kind: {} for kind in NEUTRON_KINDS.values()}
+            self.servers = {}
+            self.deleted_servers = {}
+            self.keypairs = {}
+            self.flavors = {}
+            self.extra_specs = {}
+            self.images = {}
+            self._allocations = {}
+            self._events = []
+
+            self._keystone_put("domains", {"id": DOMAIN_ID, "name": "Default", "enabled": True, "description": ""})
+            self._keystone_put("regions", {"id": REGION, "description": "", "parent_region_id": None})
+            project = self.create_project(ADMIN_PROJECT)
+            user = self.create_user(ADMIN_USER, ADMIN_PASSWORD, project["id"])
+            role = self._keystone_put("roles", {"id": new_id(), "name": "admin", "domain_id": None})
+            self.assignments.add((project["id"], user["id"], role["id"]))
+            self.admin_project_id = project["id"]
+
+            for name, vcpus, ram in (("m1.tiny", 1, 512), ("m1.small", 1, 2048), ("m1.medium", 2, 4096),
+                                     ("m1.large", 4, 8192)):
+                self.create_flavor(name, vcpus, ram)
+
+            if self._server is not None:
+                self._register_catalog()
+
+    def _register_catalog(self):
+        with self.lock:
+            endpoints = (("identity", "keystone", self.auth_url), ("compute", "nova", self.url + "/compute/v2.1"),
+                         ("network", "neutron", self.url + "/network"), ("image", "glance", self.url + "/image"))
+            for service_type, name, url in endpoints:
+                if any(s["type"] == service_type for s in self.keystone["services"].values()):
+                    continue
+
+                service = self._keystone_put("services", {"id": new_id(), "type": service_type, "name": name,
+                                                          "description": "", "enabled": True})
+                for interface in ("admin", "internal", "public"):
+                    self._keystone_put("endpoints", {"id": new_id(), "service_id": service["id"], "interface": interface,
+                                                     "url": url, "region": REGION, "region_id": REGION, "enabled": True})
+
+    def _keystone_put(self, kind, item):
+        item.setdefault("links", {"self": "%s/%s/%s" % (self.auth_url, kind, item["id"])})
+        self.keystone[kind][item["id"]] = item
+        return item
+
+    def create_project(self, name, description=""):
+        with self.lock:
+            project = self._keystone_put("projects", {"id": uuid.uuid4().hex, "name": name, "description": description,
+                                                      "enabled": True, "domain_id": DOMAIN_ID, "parent_id": DOMAIN_ID,
+                                                      "is_domain": False})
+            self._create_security_group({"name": "default", "description": "Default security group",
+                                         "tenant_id": project["id"]})
+            return project
+
+    def create_user(self, name, password, project_id=None, email=None):
+        with self.lock:
+            user = self._keystone_put("users", {"id": uuid.uuid4().hex, "name": name, "email": email, "enabled": True,
+                                                "domain_id": DOMAIN_ID, "default_project_id": project_id})
+            self.passwords[user["id"]] = password
+            return user
+
+    def create_flavor(self, name, vcpus, ram, disk=10, extra_specs=None):
+        with self.lock:
+            flavor = {"id": new_id(), "name": name, "vcpus": vcpus, "ram": ram, "disk": disk, "swap": "",
+                      "OS-FLV-EXT-DATA:ephemeral": 0, "OS-FLV-DISABLED:disabled": False, "rxtx_factor": 1.0,
+                      "os-flavor-access:is_public": True}
+            self.flavors[flavor["id"]] = flavor
+            self.extra_specs[flavor["id"]] = dict(extra_specs or {})
+            return flavor
+
+    def create_image(self, name, visibility="public", **properties):
+        with self.lock:
+            now = timestamp()
+            image = {"id": new_id(), "name": name, "status": "active", "visibility": visibility, "protected": False,
+                     "owner": self.admin_project_id, "size": 0, "min_ram": 0, "min_disk": 0, "disk_format": "qcow2",
+                     "container_format": "bare", "created_at": now, "updated_at": now, "tags": [], "checksum": None}
+            image.update(properties)
+            image["self"] = "/v2/images/%s" % image["id"]
+            image["file"] = "/v2/images/%s/file" % image["id"]
+            image["schema"] = "/v2/schemas/image"
+            self.images[image["id"]] = image
+            return image
+
+    def seed(self, servers=0, ports=0, networks=1, images=0, project_id=None, prefix="seed"):
+        """
+            Fill the cloud with resources, directly in memory. Every server gets a port on one of the networks, the extra
+            ports are not attached to a server.
+
+            :return: The ids of the created networks, subnets, servers and ports
+        """
+        with self.lock:
+            project_id = project_id or self.admin_project_id
+            result = {"networks": [], "subnets": [], "servers": [], "ports": []}
+            for n in range(max(networks, 1)):
+                network = self._create_network({"name": "%s-net-%d" % (prefix, n), "tenant_id": project_id})
+                subnet = self._create_subnet({"name": "%s-subnet-%d" % (prefix, n), "network_id": network["id"],
+                                              "tenant_id": project_id, "cidr": "10.%d.0.0/14" % (4 * (n % 64)),
+                                              "ip_version": 4})
+                result["networks"].append(network["id"])
+                result["subnets"].append(subnet["id"])
+
+            flavor = next(iter(self.flavors.values()))
+            for i in range(images):
+                self.create_image("%s-image-%d" % (prefix, i), os_distro="ubuntu", os_version=str(i))
+
+            for i in range(servers):
+                network_id = result["networks"][i % len(result["networks"])]
+                server = self._create_server({"name": "%s-vm-%d" % (prefix, i), "flavorRef": flavor["id"],
+                                              "imageRef": "", "networks": [{"uuid": network_id}]}, project_id)
+                result["servers"].append(server["id"])
+
+            for i in range(ports):
+                network_id = result["networks"][i % len(result["networks"])]
+                port = self._create_port({"name": "%s-port-%d" % (prefix, i), "network_id": network_id,
+                                          "tenant_id": project_id})
+                result["ports"].append(port["id"])
+
+            return result
+
+    # request handling
+    def dispatch(self, method, url, headers, body):
+        parts = urlsplit(url)
+        path = re.sub(r"\.json$", "", parts.path)
+        query = parse_qs(parts.query, keep_blank_values=True)
+        service, _, rest = path.lstrip("/").partition("/")
+        rest = "/" + rest
+
+        start = time.time()
+        request_id = "req-%s" % uuid.uuid4()
+        response_headers = {"x-openstack-request-id": request_id}
+        with self.lock:
+            self.in_flight[service] = self.in_flight.get(service, 0) + 1
+
+        try:
+            self._inject(service, method, path)
+            with self.lock:
+                self._tick()
+                function, match = self._route(service, method, rest)
+                context = None
+                if function not in UNAUTHENTICATED:
+                    context = self._authenticate(headers)
+
+                result = function(self, context, query, body, *match.groups())
+                status, payload = result[:2]
+                if len(result) > 2:
+                    response_headers.update(result[2])
+
+                data = json.dumps(payload).encode() if payload is not None else b""
+
+        except ApiError as e:
+            status = e.status
+            response_headers.update(e.headers)
+            data = json.dumps(self._error_body(service, e)).encode()
+
+        except Exception as e:
+            LOGGER.exception("Unhandled error in fake %s API for %s %s", service, method, path)
+            status = 500
+            data = json.dumps(self._error_body(service, ApiError(500, str(e), "InternalServerError"))).encode()
+
+        with self.lock:
+            self.in_flight[service] -= 1
+            self.calls.append(Call(service, method, path, status, time.time() - start, request_id))
+
+        return status, data, response_headers
+
+    def _inject(self, service, method, path):
+        with self.lock:
+            limit = self.rate_limits.get(service, self.rate_limits.get(None))
+            retry_after = limit.acquire() if limit is not None else None
+            in_flight = [(self.concurrency_limits.get(service), self.in_flight[service]),
+                         (self.concurrency_limits.get(None), sum(self.in_flight.values()))]
+            overloaded = any(maximum is not None and count > maximum for maximum, count in in_flight)
+            faults = [fault for fault in self.faults if fault.matches(service, method, path)]
+
+        if retry_after is not None:
+            raise ApiError(429, "Rate limit exceeded", "OverLimit", {"Retry-After": str(max(int(retry_after + 0.999), 1))})
+
+        if overloaded:
+            raise ApiError(503, "The service is unavailable", "ServiceUnavailable")
+
+        for fault in faults:
+            if fault.latency > 0:
+                time.sleep(fault.latency)
+
+        for fault in faults:
+            if fault.status is not None:
+                raise ApiError(fault.status, "Injected fault", "InjectedFault")
+
+    def _tick(self):
+        now = time.time()
+        due = [event for event in self._events if event[0] <= now]
+        if len(due) > 0:
+            self._events = [event for event in self._events if event[0] > now]
+            for _, function in due:
+                function()
+
+    def _schedule(self, delay, function):
+        if delay <= 0:
+            function()
+        else:
+            self._events.append((time.time() + delay, function))
+
+    def _route(self, service, method, path):
+        methods = set()
+        for route_service, route_method, pattern, function in ROUTES:
+            if route_service != service:
+                continue
+
+            match = pattern.match(path)
+            if match is not None:
+                methods.add(route_method)
+                if route_method == method or (method == "HEAD" and route_method == "GET"):
+                    return function, match
+
+        if len(methods) > 0:
+            raise ApiError(405, "The method %s is not allowed on %s" % (method, path))
+
+        raise NotFound("The resource %s" % path)
+
+    def _authenticate(self, headers):
+        token = self.tokens.get(headers.get("X-Auth-Token"))
+        if token is None or token["expires"] < time.time():
+            raise ApiError(401, "The request you have made requires authentication.", "Unauthorized")
+
+        return token
+
+    @staticmethod
+    def _error_body(service, error):
+        if service == "network":
+            return {"NeutronError": {"type": error.kind or "HTTPError", "message": error.message, "detail": ""}}
+
+        if service == "compute":
+            names = {400: "badRequest", 404: "itemNotFound", 409: "conflictingRequest", 413: "overLimit",
+                     429: "overLimit"}
+            return {names.get(error.status, "computeFault"): {"code": error.status, "message": error.message}}
+
+        return {"error": {"code": error.status, "message": error.message, "title": error.kind or "Error"}}
+
+    @staticmethod
+    def _filter(items, query, fields=None):
+        """
+            Select the items that match the filters in the query. Multiple values for a filter match any of the values.
+        """
+        filters = {key: values for key, values in query.items() if key not in PAGING_PARAMETERS}
+        result = []
+        for item in items:
+            selected = True
+            for key, values in filters.items():
+                if key in item and not isinstance(item[key], (list, dict)):
+                    value = item[key]
+                    value = str(value).lower() if isinstance(value, bool) else ("" if value is None else str(value))
+                    if value not in [v.lower() if isinstance(item[key], bool) else v for v in values]:
+                        selected = False
+                        break
+
+            if selected:
+                result.append(item)
+
+        return result
+
+    @staticmethod
+    def _next_query(query, limit, marker):
+        """
+            The query string of the next page of a list
+        """
+        return urlencode(dict(query, limit=[str(limit)], marker=[marker]), doseq=True)
+
+    @staticmethod
+    def _page(items, query, max_limit=None):
+        """
+            Return the page of items after the marker and whether more items follow. The page holds at most limit items
+            and never more than max_limit.
+        """
+        if "marker" in query:
+            ids = [item["id"] for item in items]
+            marker = query["marker"][0]
+            items = items[ids.index(marker) + 1:] if marker in ids else []
+
+        limit = int(query["limit"][0]) if "limit" in query else None
+        if max_limit is not None and (limit is None or limit > max_limit):
+            limit = max_limit
+
+        if limit is not None:
+            return items[:limit], len(items) > limit
+
+        return items, False
+
+    @staticmethod
+    def _fields(item, query):
+        if "fields" not in query:
+            return item
+
+        return {key: item[key] for key in query["fields"] if key in item}
+
+    # keystone
+    @route("identity", "GET", "")
+    def identity_versions(self, context, query, body):
+        return 300, {"versions": {"values": [self._identity_version_document()]}}
+
+    @route("identity", "GET", "/v3")
+    def identity_version(self, context, query, body):
+        return 200, {"version": self._identity_version_document()}
+
+    def _identity_version_document(self):
+        return {"id": "v3.8", "status": "stable", "updated": "2017-02-22T00:00:00Z",
+                "links": [{"rel": "self", "href": self.auth_url + "/"}],
+                "media-types": [{"base": "application/json", "type": "application/vnd.openstack.identity-v3+json"}]}
+
+    @route("identity", "POST", "/v3/auth/tokens")
+    def issue_token(self, context, query, body):
+        identity = body["auth"]["identity"]
+        if "password" in identity["methods"]:
+            user_data = identity["password"]["user"]
+            users = [u for u in self.keystone["users"].values() if u["id"] == user_data.get("id") or
+                     u["name"] == user_data.get("name")]
+            if len(users) != 1 or self.passwords.get(users[0]["id"]) != user_data.get("password"):
+                raise ApiError(401, "The request you have made requires authentication.", "Unauthorized")
+
+            user = users[0]
+
+        else:
+            token = self.tokens.get(identity["token"]["id"])
+            if token is None:
+                raise ApiError(401, "The request you have made requires authentication.", "Unauthorized")
+
+            user = self.keystone["users"][token["user_id"]]
+
+        project = None
+        scope = body["auth"].get("scope", {})
+        if "project" in scope:
+            projects = [p for p in self.keystone["projects"].values() if p["id"] == scope["project"].get("id") or
+                        p["name"] == scope["project"].get("name")]
+            if len(projects) != 1:
+                raise ApiError(401, "Unable to scope to the project", "Unauthorized")
+
+            project = projects[0]
+
+        token_id = uuid.uuid4().hex
+        expires = time.time() + self.token_ttl
+        self.tokens[token_id] = {"user_id": user["id"], "project_id": project["id"] if project else None,
+                                 "expires": expires}
+
+        token = {"methods": identity["methods"], "expires_at": timestamp(expires).replace("Z", ".000000Z"),
+                 "issued_at": timestamp().replace("Z", ".000000Z"), "audit_ids": [uuid.uuid4().hex],
+                 "user": {"id": user["id"], "name": user["name"], "domain": {"id": DOMAIN_ID, "name": "Default"}}}
+        if project is not None:
+            token["project"] = {"id": project["id"], "name": project["name"], "domain": {"id": DOMAIN_ID, "name": "Default"}}
+            token["roles"] = [{"id": r, "name": self.keystone["roles"][r]["name"]} for p, u, r in self.assignments
+                              if p == project["id"] and u == user["id"] and r in self.keystone["roles"]]
+            token["catalog"] = self._catalog()
+
+        return 201, {"token": token}, {"X-Subject-Token": token_id}
+
+    def _catalog(self):
+        catalog = []
+        for service in self.keystone["services"].values():
+            endpoints = [{"id": e["id"], "interface": e["interface"], "region": e["region"], "region_id": e["region_id"],
+                          "url": e["url"]}
+                         for e in self.keystone["endpoints"].values() if e["service_id"] == service["id"]]
+            catalog.append({"id": service["id"], "type": service["type"], "name": service["name"], "endpoints": endpoints})
+
+        return catalog
+
+    def _keystone_list(self, kind, query):
+        items = self._filter(self.keystone[kind].values(), query)
+        return 200, {kind: items, "links": {"self": "%s/%s" % (self.auth_url, kind), "next": None, "previous": None}}
+
+    def _keystone_get(self, kind, item_id):
+        if item_id not in self.keystone[kind]:
+            raise NotFound("Could not find %s: %s" % (KEYSTONE_KINDS[kind], item_id))
+
+        return self.keystone[kind][item_id]
+
+    @route("identity", "GET", "/v3/(projects|users|roles|services|endpoints|domains|regions)")
+    def keystone_list(self, context, query, body, kind):
+        return self._keystone_list(kind, query)
+
+    @route("identity", "GET", "/v3/(projects|users|roles|services|endpoints|domains|regions)/([^/]+)")
+    def keystone_show(self, context, query, body, kind, item_id):
+        return 200, {KEYSTONE_KINDS[kind]: self._keystone_get(kind, item_id)}
+
+    @route("identity", "POST", "/v3/(projects|users|roles|services|endpoints)")
+    def keystone_create(self, context, query, body, kind):
+        data = dict(body[KEYSTONE_KINDS[kind]])
+        password = data.pop("password", None)
+        if "name" in data and kind in ("projects", "users", "roles"):
+            if any(item["name"] == data["name"] for item in self.keystone[kind].values()):
+                raise Conflict("Conflict occurred attempting to store %s - Duplicate entry." % KEYSTONE_KINDS[kind])
+
+        item = {"id": uuid.uuid4().hex}
+        if kind in ("projects", "users"):
+            item.update({"enabled": True, "domain_id": DOMAIN_ID, "description": ""})
+
+        if kind == "projects":
+            item.update({"parent_id": DOMAIN_ID, "is_domain": False})
+
+        if kind == "services":
+            item.update({"enabled": True, "description": ""})
+
+        if kind == "endpoints":
+            item.update({"enabled": True})
+            data.setdefault("region_id", data.get("region"))
+            data.setdefault("region", data.get("region_id"))
+
+        item.update(data)
+        self._keystone_put(kind, item)
+        if kind == "projects":
+            self._create_security_group({"name": "default", "description": "Default security group",
+                                         "tenant_id": item["id"]})
+
+        if kind == "users" and password is not None:
+            self.passwords[item["id"]] = password
+
+        return 201, {KEYSTONE_KINDS[kind]: item}
+
+    @route("identity", "PATCH", "/v3/(projects|users|roles|services|endpoints)/([^/]+)")
+    def keystone_update(self, context, query, body, kind, item_id):
+        item = self._keystone_get(kind, item_id)
+        data = dict(body[KEYSTONE_KINDS[kind]])
+        if "password" in data:
+            self.passwords[item_id] = data.pop("password")
+
+        item.update(data)
+        return 200, {KEYSTONE_KINDS[kind]: item}
+
+    @route("identity", "DELETE", "/v3/(projects|users|roles|services|endpoints)/([^/]+)")
+    def keystone_delete(self, context, query, body, kind, item_id):
+        self._keystone_get(kind, item_id)
+        del self.keystone[kind][item_id]
+        index = {"projects": 0, "users": 1, "roles": 2}.get(kind)
+        if index is not None:
+            self.assignments = {a for a in self.assignments if a[index] != item_id}
+
+        if kind == "services":
+            for endpoint_id in [e["id"] for e in self.keystone["endpoints"].values() if e["service_id"] == item_id]:
+                del self.keystone["endpoints"][endpoint_id]
+
+        return 204, None
+
+    @route("identity", "PUT", "/v3/projects/([^/]+)/users/([^/]+)/roles/([^/]+)")
+    def grant_role(self, context, query, body, project_id, user_id, role_id):
+        self._keystone_get("projects", project_id)
+        self._keystone_get("users", user_id)
+        self._keystone_get("roles", role_id)
+        self.assignments.add((project_id, user_id, role_id))
+        return 204, None
+
+    @route("identity", "GET", "/v3/projects/([^/]+)/users/([^/]+)/roles/([^/]+)")
+    def check_role(self, context, query, body, project_id, user_id, role_id):
+        if (project_id, user_id, role_id) not in self.assignments:
+            raise NotFound("Could not find role assignment")
+
+        return 204, None
+
+    @route("identity", "DELETE", "/v3/projects/([^/]+)/users/([^/]+)/roles/([^/]+)")
+    def revoke_role(self, context, query, body, project_id, user_id, role_id):
+        self.check_role(context, query, body, project_id, user_id, role_id)
+        self.assignments.discard((project_id, user_id, role_id))
+        return 204, None
+
+    @route("identity", "GET", "/v3/projects/([^/]+)/users/([^/]+)/roles")
+    def list_user_project_roles(self, context, query, body, project_id, user_id):
+        roles = [self.keystone["roles"][r] for p, u, r in self.assignments if p == project_id and u == user_id]
+        return 200, {"roles": roles, "links": {"self": None, "next": None, "previous": None}}
+
+    @route("identity", "GET", "/v3/role_assignments")
+    def list_role_assignments(self, context, query, body):
+        assignments = []
+        for project_id, user_id, role_id in self.assignments:
+            if "scope.project.id" in query and project_id not in query["scope.project.id"]:
+                continue
+
+            if "user.id" in query and user_id not in query["user.id"]:
+                continue
+
+            if "role.id" in query and role_id not in query["role.id"]:
+                continue
+
+            assignments.append({"user": {"id": user_id}, "role": {"id": role_id}, "scope": {"project": {"id": project_id}},
+                                "links": {"assignment": "%s/projects/%s/users/%s/roles/%s" %
+                                          (self.auth_url, project_id, user_id, role_id)}})
+
+        return 200, {"role_assignments": assignments, "links": {"self": None, "next": None, "previous": None}}
+
+    # neutron
+    def _neutron_get(self, kind, item_id):
+        if item_id not in self.neutron[kind]:
+            name = "".join(part.capitalize() for part in kind.split("_"))
+            raise NotFound("%s %s" % (name, item_id), "%sNotFound" % name)
+
+        return self.neutron[kind][item_id]
+
+    def _neutron_base(self, defaults, data, context=None, exclude=()):
+        """
+            Create a neutron resource from the defaults of its type and the attributes in the request
+        """
+        item = {"id": new_id(), "name": "", "description": "", "revision_number": 1, "created_at": timestamp(),
+                "tags": []}
+        item.update(defaults)
+        item.update({key: value for key, value in data.items() if key not in exclude})
+        project_id = data.get("tenant_id", data.get("project_id", item.get("tenant_id")))
+        if project_id is None and context is not None:
+            project_id = context["project_id"]
+
+        item["tenant_id"] = item["project_id"] = project_id
+        item["updated_at"] = item["created_at"]
+        return item
+
+    def _touch(self, item):
+        item["revision_number"] += self.revision_step
+        item["updated_at"] = timestamp()
+
+    def _create_network(self, data, context=None):
+        network = self._neutron_base({"admin_state_up": True, "status": "ACTIVE", "shared": False,
+                                      "router:external": False, "provider:network_type": "vxlan",
+                                      "provider:physical_network": None, "provider:segmentation_id": None, "mtu": 1450,
+                                      "port_security_enabled": True}, data, context)
+        network["subnets"] = []
+        self.neutron["network"][network["id"]] = network
+        return network
+
+    def _create_subnet(self, data, context=None):
+        network = self._neutron_get("network", data["network_id"])
+        cidr = ipaddress.ip_network(data["cidr"], strict=False)
+        hosts = cidr.num_addresses
+        gateway = data.get("gateway_ip", str(cidr.network_address + 1))
+        subnet = self._neutron_base({"ip_version": cidr.version, "enable_dhcp": True, "dns_nameservers": [],
+                                     "host_routes": [], "gateway_ip": gateway, "ipv6_ra_mode": None,
+                                     "ipv6_address_mode": None, "subnetpool_id": None,
+                                     "tenant_id": network["tenant_id"]}, data, context)
+        subnet["cidr"] = str(cidr)
+        if "allocation_pools" not in data:
+            subnet["allocation_pools"] = [{"start": str(cidr.network_address + 2),
+                                           "end": str(cidr.network_address + hosts - 2)}]
+
+        self.neutron["subnet"][subnet["id"]] = subnet
+        self._allocations[subnet["id"]] = {"next": 0, "used": set()}
+        network["subnets"].append(subnet["id"])
+        self._touch(network)
+        return subnet
+
+    def _allocate_ip(self, subnet, address=None):
+        allocation = self._allocations[subnet["id"]]
+        if address is not None:
+            if address in allocation["used"]:
+                raise Conflict("IP address %s already allocated in subnet %s" % (address, subnet["id"]),
+                               "IpAddressAlreadyAllocated")
+
+            allocation["used"].add(address)
+            return address
+
+        pool = subnet["allocation_pools"][0]
+        start = ipaddress.ip_address(pool["start"])
+        size = int(ipaddress.ip_address(pool["end"])) - int(start) + 1
+        while allocation["next"] < size:
+            address = str(start + allocation["next"])
+            allocation["next"] += 1
+            if address not in allocation["used"]:
+                allocation["used"].add(address)
+                return address
+
+        raise Conflict("No more IP addresses available on network", "IpAddressGenerationFailure")
+
+    def _release_ips(self, port):
+        for fixed_ip in port["fixed_ips"]:
+            allocation = self._allocations.get(fixed_ip["subnet_id"])
+            if allocation is not None:
+                allocation["used"].discard(fixed_ip["ip_address"])
+
+    def _create_port(self, data, context=None):
+        network = self._neutron_get("network", data["network_id"])
+        port = self._neutron_base({"admin_state_up": True, "status": "ACTIVE", "device_id": "", "device_owner": "",
+                                   "mac_address": "fa:16:3e:%02x:%02x:%02x" % tuple(uuid.uuid4().bytes[:3]),
+                                   "binding:vnic_type": "normal", "allowed_address_pairs": [], "extra_dhcp_opts": [],
+                                   "port_security_enabled": network["port_security_enabled"],
+                                   "tenant_id": network["tenant_id"]}, data, context, exclude=("fixed_ips",))
+
+        fixed_ips = []
+        requested = data.get("fixed_ips")
+        if requested is None:
+            requested = [{"subnet_id": network["subnets"][0]}] if len(network["subnets"]) > 0 else []
+
+        for fixed_ip in requested:
+            subnet_id = fixed_ip.get("subnet_id")
+            if subnet_id is None:
+                subnet_id = self._subnet_for_address(network, fixed_ip["ip_address"])
+
+            subnet = self._neutron_get("subnet", subnet_id)
+            fixed_ips.append({"subnet_id": subnet_id, "ip_address": self._allocate_ip(subnet, fixed_ip.get("ip_address"))})
+
+        port["fixed_ips"] = fixed_ips
+        if "security_groups" not in data:
+            default = [sg["id"] for sg in self.neutron["security_group"].values()
+                       if sg["name"] == "default" and sg["tenant_id"] == port["tenant_id"]]
+            port["security_groups"] = default if port["port_security_enabled"] and port["device_owner"] == "" else []
+
+        self.neutron["port"][port["id"]] = port
+        return port
+
+    def _subnet_for_address(self, network, address):
+        for subnet_id in network["subnets"]:
+            if ipaddress.ip_address(address) in ipaddress.ip_network(self.neutron["subnet"][subnet_id]["cidr"]):
+                return subnet_id
+
+        raise ApiError(400, "IP address %s is not a valid IP for any subnet of the network" % address, "InvalidInput")
+
+    def _delete_port(self, port_id):
+        port = self.neutron["port"].pop(port_id, None)
+        if port is not None:
+            self._release_ips(port)
+            for fip in self.neutron["floatingip"].values():
+                if fip["port_id"] == port_id:
+                    fip.update({"port_id": None, "fixed_ip_address": None, "router_id": None, "status": "DOWN"})
+
+    def _create_security_group(self, data, context=None):
+        group = self._neutron_base({}, data, context)
+        group["security_group_rules"] = []
+        self.neutron["security_group"][group["id"]] = group
+        for ethertype in ("IPv4", "IPv6"):
+            self._create_security_group_rule({"security_group_id": group["id"], "direction": "egress",
+                                              "ethertype": ethertype}, context)
+
+        group["revision_number"] = 1
+        return group
+
+    def _create_security_group_rule(self, data, context=None):
+        group = self._neutron_get("security_group", data["security_group_id"])
+        rule = self._neutron_base({"direction": "ingress", "ethertype": "IPv4", "protocol": None,
+                                   "port_range_min": None, "port_range_max": None, "remote_ip_prefix": None,
+                                   "remote_group_id": None, "tenant_id": group["tenant_id"]}, data, context)
+        del rule["name"]
+
+        key = tuple(rule[k] for k in ("direction", "ethertype", "protocol", "port_range_min", "port_range_max",
+                                      "remote_ip_prefix", "remote_group_id"))
+        for other in group["security_group_rules"]:
+            if key == tuple(other[k] for k in ("direction", "ethertype", "protocol", "port_range_min", "port_range_max",
+                                               "remote_ip_prefix", "remote_group_id")):
+                raise Conflict("Security group rule already exists. Rule id is %s." % other["id"], "SecurityGroupRuleExists")
+
+        self.neutron["security_group_rule"][rule["id"]] = rule
+        group["security_group_rules"].append(rule)
+        self._touch(group)
+        return rule
+
+    def _create_router(self, data, context=None):
+        router = self._neutron_base({"admin_state_up": True, "status": "ACTIVE", "external_gateway_info": None,
+                                     "routes": [], "distributed": False, "ha": False}, data, context,
+                                    exclude=("external_gateway_info",))
+        self.neutron["router"][router["id"]] = router
+        self._set_gateway(router, data.get("external_gateway_info"))
+        return router
+
+    def _set_gateway(self, router, gateway):
+        for port in [p for p in self.neutron["port"].values()
+                     if p["device_id"] == router["id"] and p["device_owner"] == "network:router_gateway"]:
+            self._delete_port(port["id"])
+
+        router["external_gateway_info"] = None
+        if gateway:
+            port = self._create_port({"network_id": gateway["network_id"], "device_id": router["id"],
+                                      "device_owner": "network:router_gateway", "tenant_id": ""})
+            router["external_gateway_info"] = {"network_id": gateway["network_id"], "enable_snat": True,
+                                               "external_fixed_ips": port["fixed_ips"]}
+
+    def _create_floatingip(self, data, context=None):
+        network = self._neutron_get("network", data["floating_network_id"])
+        if not network["router:external"]:
+            raise ApiError(400, "Network %s is not a valid external network" % network["id"], "BadRequest")
+
+        if len(network["subnets"]) == 0:
+            raise Conflict("No more IP addresses available on network %s" % network["id"], "IpAddressGenerationFailure")
+
+        external = self._create_port({"network_id": network["id"], "device_owner": "network:floatingip"})
+        fip = self._neutron_base({"status": "DOWN", "fixed_ip_address": None, "router_id": None,
+                                  "floating_ip_address": external["fixed_ips"][0]["ip_address"]}, data, context,
+                                 exclude=("port_id",))
+        del fip["name"]
+        try:
+            self._associate(fip, data.get("port_id"))
+        except ApiError:
+            self._delete_port(external["id"])
+            raise
+
+        external["device_id"] = fip["id"]
+        self.neutron["floatingip"][fip["id"]] = fip
+        return fip
+
+    def _associate(self, fip, port_id):
+        fip.update({"port_id": None, "fixed_ip_address": None, "router_id": None, "status": "DOWN"})
+        if port_id is None:
+            return
+
+        port = self._neutron_get("port", port_id)
+        subnet_ids = [ip["subnet_id"] for ip in port["fixed_ips"]]
+        for router in self.neutron["router"].values():
+            gateway = router["external_gateway_info"]
+            if gateway is None or gateway["network_id"] != fip["floating_network_id"]:
+                continue
+
+            interfaces = [p for p in self.neutron["port"].values()
+                          if p["device_id"] == router["id"] and p["device_owner"] == "network:router_interface"]
+            if any(ip["subnet_id"] in subnet_ids for p in interfaces for ip in p["fixed_ips"]):
+                fip.update({"port_id": port_id, "fixed_ip_address": port["fixed_ips"][0]["ip_address"],
+                            "router_id": router["id"], "status": "ACTIVE"})
+                return
+
+        raise ApiError(404, "External network %s is not reachable from subnet %s" %
+                       (fip["floating_network_id"], subnet_ids[0] if subnet_ids else ""), "ExternalGatewayForFloatingIPNotFound")
+
+    @route("network", "GET", "/v2.0/(networks|subnets|ports|routers|security-groups|security-group-rules|floatingips)")
+    def neutron_list(self, context, query, body, collection):
+        kind = NEUTRON_KINDS[collection]
+        items = self._filter(self.neutron[kind].values(), query)
+        items, more = self._page(items, query, self.max_limit)
+        key = kind + "s"
+        response = {key: [self._fields(item, query) for item in items]}
+        if more:
+            response[key + "_links"] = [{"rel": "next", "href": "%s/network/v2.0/%s?%s" %
+                                         (self.url, collection, self._next_query(query, len(items), items[-1]["id"]))}]
+
+        return 200, response
+
+    @route("network", "GET", "/v2.0/(networks|subnets|ports|routers|security-groups|security-group-rules|floatingips)/"
+                             "([^/]+)")
+    def neutron_show(self, context, query, body, collection, item_id):
+        kind = NEUTRON_KINDS[collection]
+        return 200, {kind: self._fields(self._neutron_get(kind, item_id), query)}
+
+    @route("network", "POST", "/v2.0/(networks|subnets|ports|routers|security-groups|security-group-rules|floatingips)")
+    def neutron_create(self, context, query, body, collection):
+        kind = NEUTRON_KINDS[collection]
+        create = getattr(self, "_create_" + kind)
+        if kind + "s" in body:
+            return 201, {kind + "s": [create(dict(item), context) for item in body[kind + "s"]]}
+
+        return 201, {kind: create(dict(body[kind]), context)}
+
+    @route("network", "PUT", "/v2.0/(networks|subnets|ports|routers|security-groups|floatingips)/([^/]+)")
+    def neutron_update(self, context, query, body, collection, item_id):
+        kind = NEUTRON_KINDS[collection]
+        item = self._neutron_get(kind, item_id)
+        data = dict(body[kind])
+        if kind == "router" and "external_gateway_info" in data:
+            self._set_gateway(item, data.pop("external_gateway_info"))
+
+        if kind == "floatingip":
+            self._associate(item, data.pop("port_id", item["port_id"]))
+
+        if kind == "port" and "fixed_ips" in data:
+            self._release_ips(item)
+            network = self._neutron_get("network", item["network_id"])
+            item["fixed_ips"] = [{"subnet_id": ip.get("subnet_id") or self._subnet_for_address(network, ip["ip_address"]),
+                                  "ip_address": None} for ip in data.pop("fixed_ips")]
+            for fixed_ip, requested in zip(item["fixed_ips"], body[kind]["fixed_ips"]):
+                fixed_ip["ip_address"] = self._allocate_ip(self._neutron_get("subnet", fixed_ip["subnet_id"]),
+                                                           requested.get("ip_address"))
+
+        item.update(data)
+        self._touch(item)
+        return 200, {kind: item}
+
+    @route("network", "DELETE", "/v2.0/(networks|subnets|ports|routers|security-groups|security-group-rules|floatingips)/"
+                                "([^/]+)")
+    def neutron_delete(self, context, query, body, collection, item_id):
+        kind = NEUTRON_KINDS[collection]
+        item = self._neutron_get(kind, item_id)
+        ports = self.neutron["port"].values()
+        if kind == "network":
+            if any(p["network_id"] == item_id and p["device_owner"] not in ("", "network:dhcp") for p in ports):
+                raise Conflict("Unable to complete operation on network %s. There are one or more ports still in use on "
+                               "the network." % item_id, "NetworkInUse")
+
+            for port_id in [p["id"] for p in ports if p["network_id"] == item_id]:
+                self._delete_port(port_id)
+
+            for subnet_id in item["subnets"]:
+                self.neutron["subnet"].pop(subnet_id, None)
+
+        elif kind == "subnet":
+            if any(ip["subnet_id"] == item_id for p in ports for ip in p["fixed_ips"]):
+                raise Conflict("Unable to complete operation on subnet %s: One or more ports have an IP allocation from "
+                               "this subnet." % item_id, "SubnetInUse")
+
+            network = self.neutron["network"].get(item["network_id"])
+            if network is not None:
+                network["subnets"].remove(item_id)
+
+        elif kind == "port":
+            if item["device_owner"] == "network:router_interface":
+                raise Conflict("Port %s cannot be deleted directly via the port API: has device owner "
+                               "network:router_interface." % item_id, "L3PortInUse")
+
+            self._delete_port(item_id)
+            return 204, None
+
+        elif kind == "router":
+            if any(p["device_id"] == item_id and p["device_owner"] == "network:router_interface" for p in ports):
+                raise Conflict("Router %s still has ports" % item_id, "RouterInUse")
+
+            self._set_gateway(item, None)
+
+        elif kind == "security_group":
+            if any(item_id in p.get("security_groups", []) for p in ports):
+                raise Conflict("Security Group %s in use." % item_id, "SecurityGroupInUse")
+
+            for rule in item["security_group_rules"]:
+                self.neutron["security_group_rule"].pop(rule["id"], None)
+
+        elif kind == "security_group_rule":
+            group = self.neutron["security_group"][item["security_group_id"]]
+            group["security_group_rules"] = [r for r in group["security_group_rules"] if r["id"] != item_id]
+            self._touch(group)
+
+        elif kind == "floatingip":
+            for port_id in [p["id"] for p in ports if p["device_id"] == item_id]:
+                self._delete_port(port_id)
+
+        del self.neutron[kind][item_id]
+        return 204, None
+
+    @route("network", "PUT", "/v2.0/routers/([^/]+)/(add|remove)_router_interface")
+    def router_interface(self, context, query, body, router_id, action):
+        router = self._neutron_get("router", router_id)
+        if action == "add":
+            if "port_id" in body:
+                port = self._neutron_get("port", body["port_id"])
+                if port["device_id"] != "":
+                    raise Conflict("Port %s is in use" % port["id"], "PortInUse")
+            else:
+                subnet = self._neutron_get("subnet", body["subnet_id"])
+                port = self._create_port({"network_id": subnet["network_id"], "tenant_id": router["tenant_id"],
+                                          "fixed_ips": [{"subnet_id": subnet["id"], "ip_address": subnet["gateway_ip"]}]})
+
+            port.update({"device_id": router_id, "device_owner": "network:router_interface", "security_groups": []})
+        else:
+            candidates = [p for p in self.neutron["port"].values()
+                          if p["device_id"] == router_id and p["device_owner"] == "network:router_interface" and
+                          (p["id"] == body.get("port_id") or
+                           any(ip["subnet_id"] == body.get("subnet_id") for ip in p["fixed_ips"]))]
+            if len(candidates) == 0:
+                raise NotFound("Router %s does not have an interface with id %s" %
+                               (router_id, body.get("port_id", body.get("subnet_id"))), "RouterInterfaceNotFound")
+
+            port = candidates[0]
+            self._delete_port(port["id"])
+
+        self._touch(router)
+        return 200, {"id": router_id, "tenant_id": router["tenant_id"], "port_id": port["id"],
+                     "subnet_id": port["fixed_ips"][0]["subnet_id"] if port["fixed_ips"] else None,
+                     "subnet_ids": [ip["subnet_id"] for ip in port["fixed_ips"]]}
+
+    # nova
+    def _server_state(self, server):
+        if server["status"] == "BUILD" and time.time() >= server["_ready"]:
+            server.update({"status": "ACTIVE", "OS-EXT-STS:vm_state": "active", "OS-EXT-STS:task_state": None,
+                           "OS-EXT-STS:power_state": 1, "updated": timestamp()})
+
+        return {key: value for key, value in server.items() if not key.startswith("_")}
+
+    def _get_server(self, server_id):
+        if server_id not in self.servers:
+            raise NotFound("Instance %s" % server_id)
+
+        return self.servers[server_id]
+
+    def _server_ports(self, server_id):
+        return [p for p in self.neutron["port"].values() if p["device_id"] == server_id]
+
+    def _update_addresses(self, server, ports=None):
+        addresses = {}
+        for port in self._server_ports(server["id"]) if ports is None else ports:
+            network = self.neutron["network"][port["network_id"]]
+            for fixed_ip in port["fixed_ips"]:
+                addresses.setdefault(network["name"], []).append(
+                    {"addr": fixed_ip["ip_address"], "version": 4, "OS-EXT-IPS:type": "fixed",
+                     "OS-EXT-IPS-MAC:mac_addr": port["mac_address"]})
+
+        server["addresses"] = addresses
+
+    def _create_server(self, data, project_id, user_id=None):
+        if data["flavorRef"] not in self.flavors:
+            raise ApiError(400, "Flavor %s could not be found." % data["flavorRef"])
+
+        now = time.time()
+        server_id = new_id()
+        building = self.build_time > 0
+        groups = [g["name"] for g in data.get("security_groups", [])]
+        server = {"id": server_id, "name": data["name"], "tenant_id": project_id, "user_id": user_id,
+                  "status": "BUILD" if building else "ACTIVE", "OS-EXT-STS:vm_state": "building" if building else "active",
+                  "OS-EXT-STS:task_state": "spawning" if building else None,
+                  "OS-EXT-STS:power_state": 0 if building else 1, "created": timestamp(now), "updated": timestamp(now),
+                  "flavor": {"id": data["flavorRef"], "links": []}, "image": {"id": data.get("imageRef", ""), "links": []},
+                  "key_name": data.get("key_name"), "metadata": data.get("metadata", {}),
+                  "config_drive": "True" if data.get("config_drive") else "", "hostId": uuid.uuid4().hex,
+                  "OS-EXT-AZ:availability_zone": "nova", "OS-DCF:diskConfig": "MANUAL", "accessIPv4": "",
+                  "accessIPv6": "", "progress": 0, "os-extended-volumes:volumes_attached": [],
+                  "security_groups": [{"name": name} for name in groups or ["default"]],
+                  "links": [{"rel": "self", "href": "%s/compute/v2.1/servers/%s" % (self.url, server_id)}],
+                  "_ready": now + self.build_time, "_ports": []}
+
+        group_ids = [self._group_id(name, project_id) for name in groups]
+        ports = []
+        for network in data.get("networks", []):
+            if "port" in network:
+                port = self._neutron_get("port", network["port"])
+                if port["device_id"] != "":
+                    raise Conflict("Port %s is still in use." % port["id"])
+            else:
+                fixed_ips = [{"ip_address": network["fixed_ip"]}] if "fixed_ip" in network else None
+                port = self._create_port({"network_id": network["uuid"], "tenant_id": project_id, "fixed_ips": fixed_ips})
+                server["_ports"].append(port["id"])
+                if len(group_ids) > 0:
+                    port["security_groups"] = list(group_ids)
+
+            port.update({"device_id": server_id, "device_owner": "compute:nova"})
+            ports.append(port)
+
+        self.servers[server_id] = server
+        self._update_addresses(server, ports)
+        return server
+
+    def _group_id(self, name, project_id):
+        for group in self.neutron["security_group"].values():
+            if group["id"] == name or (group["name"] == name and group["tenant_id"] == project_id):
+                return group["id"]
+
+        raise ApiError(400, "Security group %s not found for project %s." % (name, project_id))
+
+    @route("compute", "GET", "/v2.1")
+    def compute_version(self, context, query, body):
+        return 200, {"version": {"id": "v2.1", "status": "CURRENT", "version": "2.38", "min_version": "2.1",
+                                 "links": [{"rel": "self", "href": self.url + "/compute/v2.1/"}]}}
+
+    @route("compute", "GET", "/v2.1/servers(/detail)?")
+    def list_servers(self, context, query, body, detail):
+        project_id = context["project_id"]
+        all_tenants = query.get("all_tenants", ["0"])[0].lower() in ("1", "true")
+        servers = [self._server_state(s) for s in self.servers.values()]
+        if "changes-since" in query:
+            since = query["changes-since"][0]
+            servers = [s for s in servers + [self._server_state(s) for s in self.deleted_servers.values()]
+                       if s["updated"] >= since]
+
+        if not all_tenants:
+            servers = [s for s in servers if s["tenant_id"] == project_id]
+        elif "tenant_id" in query:
+            servers = [s for s in servers if s["tenant_id"] in query["tenant_id"]]
+
+        if "name" in query:
+            pattern = re.compile(query["name"][0])
+            servers = [s for s in servers if pattern.search(s["name"])]
+
+        if "status" in query:
+            servers = [s for s in servers if s["status"] in query["status"]]
+
+        servers, more = self._page(servers, query, self.max_limit)
+        response = {"servers": servers}
+        if more:
+            response["servers_links"] = [{"rel": "next", "href": "%s/compute/v2.1/servers%s?%s" %
+                                          (self.url, detail or "", self._next_query(query, len(servers),
+                                                                                    servers[-1]["id"]))}]
+
+        if detail is None:
+            response["servers"] = [{"id": s["id"], "name": s["name"], "links": s["links"]} for s in servers]
+
+        return 200, response
+
+    @route("compute", "POST", "/v2.1/servers")
+    def create_server(self, context, query, body):
+        server = self._create_server(body["server"], context["project_id"], context["user_id"])
+        return 202, {"server": {"id": server["id"], "links": server["links"], "OS-DCF:diskConfig": "MANUAL",
+                                "security_groups": server["security_groups"], "adminPass": uuid.uuid4().hex[:12]}}
+
+    @route("compute", "GET", "/v2.1/servers/([^/]+)")
+    def show_server(self, context, query, body, server_id):
+        return 200, {"server": self._server_state(self._get_server(server_id))}
+
+    @route("compute", "DELETE", "/v2.1/servers/([^/]+)")
+    def delete_server(self, context, query, body, server_id):
+        server = self.servers.pop(self._get_server(server_id)["id"])
+        server.update({"status": "DELETED", "OS-EXT-STS:vm_state": "deleted", "updated": timestamp()})
+        self.deleted_servers[server_id] = server
+
+        def cleanup():
+            for port in self._server_ports(server_id):
+                if port["id"] in server["_ports"]:
+                    self._delete_port(port["id"])
+                else:
+                    port.update({"device_id": "", "device_owner": ""})
+
+        self._schedule(self.port_cleanup_time, cleanup)
+        return 204, None
+
+    @route("compute", "POST", "/v2.1/servers/([^/]+)/action")
+    def server_action(self, context, query, body, server_id):
+        server = self._get_server(server_id)
+        for action in ("addSecurityGroup", "removeSecurityGroup"):
+            if action in body:
+                name = body[action]["name"]
+                group_id = self._group_id(name, server["tenant_id"])
+                names = [g["name"] for g in server["security_groups"]]
+                for port in self._server_ports(server_id):
+                    groups = [g for g in port["security_groups"] if g != group_id]
+                    port["security_groups"] = groups + [group_id] if action == "addSecurityGroup" else groups
+
+                if action == "addSecurityGroup" and name not in names:
+                    server["security_groups"].append({"name": name})
+                elif action == "removeSecurityGroup":
+                    server["security_groups"] = [g for g in server["security_groups"] if g["name"] != name]
+
+                server["updated"] = timestamp()
+                return 202, None
+
+        raise ApiError(400, "Unsupported server action")
+
+    @route("compute", "GET", "/v2.1/servers/([^/]+)/os-security-groups")
+    def list_server_security_groups(self, context, query, body, server_id):
+        server = self._get_server(server_id)
+        groups = []
+        for name in [g["name"] for g in server["security_groups"]]:
+            for group in self.neutron["security_group"].values():
+                if group["name"] == name and group["tenant_id"] == server["tenant_id"]:
+                    groups.append({"id": group["id"], "name": group["name"], "description": group["description"],
+                                   "tenant_id": group["tenant_id"], "rules": []})
+
+        return 200, {"security_groups": groups}
+
+    def _interface(self, port):
+        return {"port_id": port["id"], "net_id": port["network_id"], "mac_addr": port["mac_address"],
+                "port_state": port["status"], "fixed_ips": port["fixed_ips"]}
+
+    @route("compute", "GET", "/v2.1/servers/([^/]+)/os-interface")
+    def list_interfaces(self, context, query, body, server_id):
+        self._get_server(server_id)
+        return 200, {"interfaceAttachments": [self._interface(port) for port in self._server_ports(server_id)]}
+
+    @route("compute", "POST", "/v2.1/servers/([^/]+)/os-interface")
+    def attach_interface(self, context, query, body, server_id):
+        server = self._get_server(server_id)
+        if server["status"] != "ACTIVE" and self._server_state(server)["status"] != "ACTIVE":
+            raise Conflict("Cannot 'attach_interface' instance %s while it is in vm_state building" % server_id)
+
+        attachment = body["interfaceAttachment"]
+        if "port_id" in attachment:
+            port = self._neutron_get("port", attachment["port_id"])
+            if port["device_id"] != "":
+                raise Conflict("Port %s is still in use." % port["id"])
+        else:
+            port = self._create_port({"network_id": attachment["net_id"], "tenant_id": server["tenant_id"],
+                                      "fixed_ips": attachment.get("fixed_ips")})
+            server["_ports"].append(port["id"])
+
+        port.update({"device_id": server_id, "device_owner": "compute:nova"})
+        self._update_addresses(server)
+        server["updated"] = timestamp()
+        return 200, {"interfaceAttachment": self._interface(port)}
+
+    @route("compute", "GET", "/v2.1/os-keypairs")
+    def list_keypairs(self, context, query, body):
+        return 200, {"keypairs": [{"keypair": keypair} for keypair in self.keypairs.values()]}
+
+    @route("compute", "POST", "/v2.1/os-keypairs")
+    def create_keypair(self, context, query, body):
+        data = body["keypair"]
+        if data["name"] in self.keypairs:
+            raise Conflict("Key pair '%s' already exists." % data["name"])
+
+        keypair = {"name": data["name"], "public_key": data.get("public_key", "ssh-rsa fake"),
+                   "fingerprint": ":".join("%02x" % b for b in uuid.uuid4().bytes), "user_id": context["user_id"]}
+        self.keypairs[data["name"]] = keypair
+        return 200, {"keypair": keypair}
+
+    @route("compute", "DELETE", "/v2.1/os-keypairs/([^/]+)")
+    def delete_keypair(self, context, query, body, name):
+        if self.keypairs.pop(name, None) is None:
+            raise NotFound("Keypair %s" % name)
+
+        return 202, None
+
+    @route("compute", "GET", "/v2.1/flavors(/detail)?")
+    def list_flavors(self, context, query, body, detail):
+        flavors = [dict(flavor, links=[]) for flavor in self.flavors.values()]
+        if detail is None:
+            flavors = [{"id": f["id"], "name": f["name"], "links": []} for f in flavors]
+
+        return 200, {"flavors": flavors}
+
+    @route("compute", "GET", "/v2.1/flavors/([^/]+)")
+    def show_flavor(self, context, query, body, flavor_id):
+        if flavor_id not in self.flavors:
+            raise NotFound("Flavor %s" % flavor_id)
+
+        return 200, {"flavor": dict(self.flavors[flavor_id], links=[])}
+
+    @route("compute", "GET", "/v2.1/flavors/([^/]+)/os-extra_specs")
+    def flavor_extra_specs(self, context, query, body, flavor_id):
+        if flavor_id not in self.flavors:
+            raise NotFound("Flavor %s" % flavor_id)
+
+        return 200, {"extra_specs": self.extra_specs[flavor_id]}
+
+    # glance
+    @route("image", "GET", "(/versions)?")
+    def image_versions(self, context, query, body, suffix):
+        return 300, {"versions": [{"id": "v2.5", "status": "CURRENT",
+                                   "links": [{"rel": "self", "href": self.url + "/image/v2/"}]}]}
+
+    @route("image", "GET", "/v2/schemas/image")
+    def image_schema(self, context, query, body):
+        return 200, IMAGE_SCHEMA
+
+    @route("image", "GET", "/v2/schemas/images")
+    def images_schema(self, context, query, body):
+        return 200, {"name": "images", "properties": {"images": {"type": "array", "items": IMAGE_SCHEMA}},
+                     "links": [{"rel": "first", "href": "{first}"}, {"rel": "next", "href": "{next}"}]}
+
+    @route("image", "GET", "/v2/images")
+    def list_images(self, context, query, body):
+        images = sorted(self.images.values(), key=lambda i: (i["created_at"], i["id"]), reverse=True)
+        images = self._filter(images, query)
+        images, more = self._page(images, {k: v for k, v in query.items() if k in ("limit", "marker")})
+        response = {"images": images, "first": "/v2/images", "schema": "/v2/schemas/images"}
+        if more:
+            response["next"] = "/v2/images?marker=%s&limit=%s" % (images[-1]["id"], query["limit"][0])
+
+        return 200, response
+
+    @route("image", "GET", "/v2/images/([^/]+)")
+    def show_image(self, context, query, body, image_id):
+        if image_id not in self.images:
+            raise NotFound("Image %s" % image_id)
+
+        return 200, self.images[image_id]
+
+
+UNAUTHENTICATED = (FakeOpenStack.issue_token, FakeOpenStack.identity_versions, FakeOpenStack.identity_version,
+                   FakeOpenStack.compute_version, FakeOpenStack.image_versions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run an in-memory fake of the OpenStack APIs used by this module")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--servers", type=int, default=0, help="The number of servers to seed")
+    parser.add_argument("--ports", type=int, default=0, help="The number of unattached ports to seed")
+    parser.add_argument("--networks", type=int, default=1, help="The number of networks the seeded resources use")
+    parser.add_argument("--images", type=int, default=0, help="The number of public images to seed")
+    parser.add_argument("--latency", type=float, default=0, help="Latency in seconds added to every call")
+    parser.add_argument("--rate-limit", type=float, default=None, help="The number of calls per second per service")
+    parser.add_argument("--build-time", type=float, default=0, help="The number of seconds a new server is building")
+    parser.add_argument("--max-limit", type=int, default=MAX_LIMIT, help="The maximum number of items in a page of a list")
+    options = parser.parse_args()
+
+    cloud = FakeOpenStack(options.host, options.port, build_time=options.build_time, max_limit=options.max_limit)
+    start = time.time()
+    cloud.seed(servers=options.servers, ports=options.ports, networks=options.networks, images=options.images)
+    if options.latency > 0:
+        cloud.add_latency(options.latency)
+
+    if options.rate_limit is not None:
+        for service in ("identity", "compute", "network", "image"):
+            cloud.set_rate_limit(options.rate_limit, service=service)
+
+    cloud.start()
+    print("Seeded in %.1fs, listening on %s" % (time.time() - start, cloud.url))
+    for name, value in sorted(cloud.environment().items()):
+        print("export %s=%s" % (name, value))
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        cloud.stop()
+
+
+if __name__ == "__main__":
+    main()
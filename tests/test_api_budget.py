@@ -0,0 +1,295 @@
+"""
+    Copyright 2017 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+import collections
+import importlib
+import json
+import os
+import re
+
+import inmanta
+import pytest
+
+from inmanta.agent import handler
+
+BUDGET_FILE = os.path.join(os.path.dirname(__file__), "api_budgets.json")
+IDS = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|[0-9a-f]{32}")
+ID_ATTRIBUTES = {"Role": "role_id", "EndPoint": "service_id"}
+
+PROVIDER = """
+import unittest
+import openstack
+import ssh
+
+tenant = std::get_env("OS_PROJECT_NAME")
+p = openstack::Provider(name="test", connection_url=std::get_env("OS_AUTH_URL"), username=std::get_env("OS_USERNAME"),
+                        password=std::get_env("OS_PASSWORD"), tenant=tenant)
+"""
+
+KEYSTONE_MODEL = PROVIDER + """
+project = openstack::Project(provider=p, name="budget_project", description="%(description)s", enabled=true,
+                             purged=%(purged)s)
+user = openstack::User(provider=p, name="budget_user", email="%(email)s", password="secret", purged=%(purged)s)
+openstack::Role(role="budget_member", project=project, user=user, purged=%(purged)s)
+
+service = openstack::Service(provider=p, name="budget_service", type="budget", description="%(description)s",
+                             purged=%(purged)s)
+openstack::EndPoint(service=service, region="RegionOne", internal_url="http://localhost:1234", public_url="%(url)s",
+                    admin_url="http://localhost:1234", purged=%(purged)s)
+"""
+
+KEYSTONE_RESOURCES = [("Project", "budget_project", True),
+                      ("User", "budget_user", True),
+                      ("Role", "budget_project_budget_user_budget_member", True),
+                      ("Service", "budget_service", True),
+                      ("EndPoint", "budget_budget_service", True)]
+
+KEYSTONE_PHASES = {"create": {"description": "", "email": "budget@example.com", "url": "http://localhost:1234"},
+                   "update": {"description": "updated", "email": "updated@example.com", "url": "http://localhost:4321"}}
+
+NETWORK_MODEL = PROVIDER + """
+project = openstack::Project(provider=p, name=tenant, description="", enabled=true, managed=false)
+
+openstack::Network(provider=p, project=project, name="budget_network", external=%(external)s, purged=%(purged)s)
+
+ext = openstack::Network(provider=p, project=project, name="budget_ext", external=true, purged=%(purged)s)
+openstack::Subnet(provider=p, project=project, network=ext, name="budget_ext", dhcp=false, network_address="172.31.0.0/24",
+                  purged=%(purged)s)
+
+net = openstack::Network(provider=p, project=project, name="budget_net", purged=%(purged)s)
+subnet = openstack::Subnet(provider=p, project=project, network=net, name="budget_subnet", dhcp=true,
+                           network_address="10.255.0.0/24", dns_servers=%(dns_servers)s, purged=%(purged)s)
+net2 = openstack::Network(provider=p, project=project, name="budget_net2", purged=%(purged)s)
+subnet2 = openstack::Subnet(provider=p, project=project, network=net2, name="budget_subnet2", dhcp=true,
+                            network_address="10.255.1.0/24", purged=%(purged)s)
+rp_net = openstack::Network(provider=p, project=project, name="budget_rp_net", purged=%(purged)s)
+rp_subnet = openstack::Subnet(provider=p, project=project, network=rp_net, name="budget_rp_subnet", dhcp=true,
+                              network_address="10.255.2.0/24", purged=%(purged)s)
+
+router = openstack::Router(provider=p, project=project, name="budget_router", ext_gateway=ext, subnets=[subnet, subnet2],
+                           purged=%(purged)s)
+%(routes)s
+openstack::RouterPort(provider=p, project=project, name="budget_router_port", router=router, subnet=rp_subnet,
+                      address="10.255.2.10", purged=%(purged)s)
+
+default = openstack::SecurityGroup(provider=p, project=project, name="default", managed=false)
+sg = openstack::SecurityGroup(provider=p, project=project, name="budget_sg", description="Budget", purged=%(purged)s)
+openstack::IPrule(group=sg, direction="egress", ip_protocol="all", remote_prefix="0.0.0.0/0")
+%(rules)s
+
+key = ssh::Key(name="budget_key", public_key="ssh-rsa AAAA budget")
+vm = openstack::VirtualMachine(provider=p, project=project, name="budget_vm", key_pair=key, image="%(image)s",
+                               flavor="m1.tiny", user_data="", security_groups=%(security_groups)s, purged=%(purged)s)
+vm.eth0_port = openstack::HostPort(provider=p, project=project, vm=vm, subnet=subnet, name="budget_vm_eth0", port_index=1,
+                                   address=std::getfact(vm, "ip_address"), purged=%(purged)s)
+port = openstack::HostPort(provider=p, project=project, vm=vm, subnet=subnet2, name="budget_port", port_index=2,
+                           address=std::getfact(vm, "subnet_budget_net2_ip"), portsecurity=%(portsecurity)s,
+                           purged=%(purged)s)
+openstack::FloatingIP(provider=p, project=project, external_network=ext, port=port, purged=%(purged)s)
+"""
+
+NETWORK_RESOURCES = [("Network", "budget_network", True),
+                     ("Network", "budget_ext", False),
+                     ("Network", "budget_net", False),
+                     ("Network", "budget_net2", False),
+                     ("Network", "budget_rp_net", False),
+                     ("Subnet", "budget_ext", False),
+                     ("Subnet", "budget_subnet", True),
+                     ("Subnet", "budget_subnet2", False),
+                     ("Subnet", "budget_rp_subnet", False),
+                     ("Router", "budget_router", True),
+                     ("RouterPort", "budget_router_port", True),
+                     ("SecurityGroup", "budget_sg", True),
+                     ("VirtualMachine", "budget_vm", True),
+                     ("HostPort", "budget_vm_eth0", False),
+                     ("HostPort", "budget_port", True),
+                     ("FloatingIP", "budget_ext_budget_port", True)]
+
+NETWORK_PHASES = {"create": {"external": "false", "dns_servers": "[]", "routes": "", "rules": "",
+                             "security_groups": "[default]", "portsecurity": "true"},
+                  "update": {"external": "true", "dns_servers": '["8.8.8.8"]',
+                             "routes": 'router.routes = openstack::Route(destination="192.168.100.0/24", nexthop="10.255.0.5")',
+                             "rules": 'openstack::IPrule(group=sg, direction="ingress", ip_protocol="tcp", port=22, '
+                                      'remote_prefix="0.0.0.0/0")',
+                             "security_groups": "[default, sg]", "portsecurity": "false"}}
+
+
+def request_kind(call):
+    """
+        The kind of an API request: its method and its path with the ids replaced by {id}
+    """
+    return "%s %s" % (call.method, IDS.sub("{id}", call.path))
+
+
+class ApiBudget(object):
+    """
+        Records the API requests the handlers make per resource type and operation and compares them to the budgets in
+        api_budgets.json. Authentication (token requests and the requests that were rejected with a 401 before the session
+        authenticated again) is not counted because it depends on the token cache and not on the handlers. When recording,
+        the measurements replace the budgets instead of being checked against them.
+    """
+    def __init__(self, cloud, budgets, recording=False):
+        self.cloud = cloud
+        self.budgets = budgets
+        self.recording = recording
+        self.measured = {}
+
+    def measure(self, entity, operation, function):
+        self.cloud.clear_calls()
+        result = function()
+        requests = collections.Counter(request_kind(call) for call in self.cloud.calls
+                                       if not call.path.endswith("/auth/tokens") and call.status != 401)
+        self.measured.setdefault(entity, {})[operation] = dict(requests)
+        return result
+
+    def overruns(self):
+        """
+            Describe every operation that made more API requests than its budget allows
+        """
+        if self.recording:
+            return []
+
+        messages = []
+        for entity, operations in sorted(self.measured.items()):
+            for operation, requests in sorted(operations.items()):
+                budget = self.budgets.get(entity, {}).get(operation)
+                if budget is None:
+                    messages.append("%s %s has no budget" % (entity, operation))
+                    continue
+
+                total = sum(requests.values())
+                if total > sum(budget.values()):
+                    diff = ["%+d %s" % (requests.get(kind, 0) - budget.get(kind, 0), kind)
+                            for kind in sorted(set(requests) | set(budget)) if requests.get(kind, 0) != budget.get(kind, 0)]
+                    messages.append("%s %s made %d API requests, the budget is %d (%s)" %
+                                    (entity, operation, total, sum(budget.values()), ", ".join(diff)))
+
+        return messages
+
+
+@pytest.fixture
+def api_budget(request, fake_os):
+    with open(BUDGET_FILE, "r") as fd:
+        budgets = json.load(fd)
+
+    recording = request.config.getoption("--update-api-budgets")
+    fake_os.reset()
+    budget = ApiBudget(fake_os, budgets, recording)
+    try:
+        yield budget
+    finally:
+        fake_os.reset()
+
+    if recording:
+        for entity, operations in budget.measured.items():
+            budgets.setdefault(entity, {}).update(operations)
+
+        with open(BUDGET_FILE, "w") as fd:
+            json.dump(budgets, fd, indent=4, sort_keys=True)
+            fd.write("\n")
+
+
+def get_resource(project, entity, name):
+    return project.get_resource("openstack::" + entity, **{ID_ATTRIBUTES.get(entity, "name"): name})
+
+
+def deploy(project, resource):
+    ctx = project.deploy(resource)
+    assert ctx.status == inmanta.const.ResourceState.deployed, "Deploying %s failed" % resource.id
+    return ctx
+
+
+def facts(project, resource):
+    h = project.get_handler(resource, False)
+    return h.check_facts(handler.HandlerContext(resource), resource)
+
+
+def run_lifecycle(project, api_budget, model, resources, phases, **values):
+    """
+        Create, redeploy, update and purge all resources in the model and measure the API requests of each operation on
+        the resources that are marked as measured. The resources are created in the given order and purged in the
+        reverse order.
+    """
+    def compile(phase, purged):
+        project.compile(model % dict(values, purged="true" if purged else "false", **phases[phase]))
+
+    compile("create", False)
+    for entity, name, measured in resources:
+        resource = get_resource(project, entity, name)
+        if measured:
+            api_budget.measure(entity, "create", lambda: deploy(project, resource))
+        else:
+            deploy(project, resource)
+
+    for entity, name, measured in resources:
+        if measured:
+            resource = get_resource(project, entity, name)
+            api_budget.measure(entity, "read", lambda: deploy(project, resource))
+
+    compile("update", False)
+    for entity, name, measured in resources:
+        if measured:
+            resource = get_resource(project, entity, name)
+            api_budget.measure(entity, "update", lambda: deploy(project, resource))
+            api_budget.measure(entity, "facts", lambda: facts(project, resource))
+
+    compile("update", True)
+    for entity, name, measured in reversed(resources):
+        resource = get_resource(project, entity, name)
+        if measured:
+            api_budget.measure(entity, "delete", lambda: deploy(project, resource))
+        else:
+            deploy(project, resource)
+
+
+def test_keystone_api_budget(project, api_budget):
+    run_lifecycle(project, api_budget, KEYSTONE_MODEL, KEYSTONE_RESOURCES, KEYSTONE_PHASES)
+    assert api_budget.overruns() == []
+
+
+def test_network_api_budget(project, api_budget, fake_os):
+    image = fake_os.create_image("budget")
+    run_lifecycle(project, api_budget, NETWORK_MODEL, NETWORK_RESOURCES, NETWORK_PHASES, image=image["id"])
+    assert api_budget.overruns() == []
+
+
+def test_network_facts_batch(project, fake_os):
+    """
+        The facts of a batch of resources are computed from one snapshot per provider
+    """
+    image = fake_os.create_image("budget")
+    project.compile(NETWORK_MODEL % dict(NETWORK_PHASES["create"], purged="false", image=image["id"]))
+    for entity, name, _ in NETWORK_RESOURCES:
+        deploy(project, get_resource(project, entity, name))
+
+    resources = [get_resource(project, entity, name) for entity, name in
+                 [("VirtualMachine", "budget_vm"), ("HostPort", "budget_vm_eth0"), ("HostPort", "budget_port"),
+                  ("Subnet", "budget_subnet"), ("Subnet", "budget_subnet2"), ("FloatingIP", "budget_ext_budget_port")]]
+
+    plugin_module = importlib.import_module("inmanta_plugins.openstack")
+    fake_os.clear_calls()
+    result = plugin_module.collect_facts(resources)
+
+    requests = collections.Counter(request_kind(call) for call in fake_os.calls
+                                   if not call.path.endswith("/auth/tokens") and call.status != 401)
+    assert sum(requests.values()) <= 5, requests
+
+    vm, eth0, port, subnet, subnet2, fip = [result[resource.id.resource_str()] for resource in resources]
+    assert vm["subnet_budget_net2_ip"] == port["ip_address"]
+    assert eth0["ip_address"].startswith("10.255.0.")
+    assert subnet["name"] == "budget_subnet" and subnet2["name"] == "budget_subnet2"
+    assert fip["ip_address"].startswith("172.31.0.")
@@ -0,0 +1,136 @@
+"""
+    Copyright 2017 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+import random
+import time
+
+
+def make_rules(count):
+    rules = []
+    for i in range(count):
+        rule = {"protocol": random.choice(["tcp", "udp"]), "direction": random.choice(["ingress", "egress"]),
+                "port_range_min": 1 + i % 60000, "port_range_max": 1 + i % 60000}
+        if i % 10 == 0:
+            rule["remote_group"] = "group_%d" % i
+        else:
+            rule["remote_ip_prefix"] = "10.%d.%d.0/24" % (i // 256 % 256, i % 256)
+        rules.append(rule)
+
+    return rules
+
+
+def test_security_group_rule_diff(plugin_module):
+    handler_class = plugin_module.SecurityGroupHandler
+    sg_handler = handler_class.__new__(handler_class)
+
+    desired = make_rules(10000)
+    current = [dict(rule, __id="id_%d" % i) for i, rule in enumerate(desired)]
+    random.shuffle(current)
+
+    # replace 100 rules
+    removed = current[:100]
+    current = current[100:] + [dict(rule, __id="extra_%d" % i) for i, rule in enumerate(make_rules(100))
+                               if rule not in desired]
+
+    start = time.time()
+    old_rules, new_rules = sg_handler._diff_rules(current, desired)
+    duration = time.time() - start
+
+    assert len(new_rules) == 100
+    assert sorted(r["__id"] for r in removed) == sorted("id_%d" % desired.index(r) for r in new_rules)
+    assert all(r["__id"].startswith("extra_") for r in old_rules)
+    assert duration < 1, "Diffing a security group with 10k rules took %.2fs" % duration
+
+
+class FakeId(object):
+    def __init__(self, entity_type, agent_name, name):
+        self.entity_type = entity_type
+        self.agent_name = agent_name
+        self.name = name
+
+
+class FakeResource(object):
+    def __init__(self, entity_type, provider, **attributes):
+        self.id = FakeId(entity_type, provider, attributes.get("name", attributes.get("role_id")))
+        self.requires = set()
+        for name, value in attributes.items():
+            setattr(self, name, value)
+
+
+def make_model(tenants, provider="provider"):
+    """
+        Generate a resource model with 20 resources per tenant, with the same names in every tenant
+    """
+    model = {}
+
+    def add(entity_type, **attributes):
+        res = FakeResource("openstack::" + entity_type, provider, **attributes)
+        model["%s[%s,%s]" % (entity_type, attributes.get("project"), res.id.name)] = res
+        return res
+
+    add("Network", name="external", project="admin")
+    for t in range(tenants):
+        project = "tenant_%d" % t
+        add("Project", name=project)
+        add("User", name="user_%d" % t)
+        add("Role", role_id="role_%d" % t, role="member", project=project, user="user_%d" % t)
+        add("Network", name="net", project=project)
+        add("Network", name="mgmt", project=project)
+        add("Subnet", name="subnet", project=project, network="net")
+        add("Router", name="router", project=project, subnets=["subnet"], gateway="external")
+        add("SecurityGroup", name="web", project=project)
+        for v in range(4):
+            add("VirtualMachine", name="vm_%d" % v, project=project, ports=[{"network": "subnet"}],
+                security_groups=["web"])
+            add("HostPort", name="port_%d" % v, project=project, subnet="subnet", host="vm_%d" % v)
+            add("FloatingIP", name="fip_%d" % v, project=project, port="port_%d" % v, external_network="external")
+
+    return model
+
+
+def resolve(plugin_module, model):
+    start = time.time()
+    plugin_module.openstack_dependencies(None, model)
+    plugin_module.keystone_dependencies(None, model)
+    return time.time() - start
+
+
+def test_dependency_resolution(plugin_module):
+    model = make_model(5000)
+    assert len(model) == 100001
+
+    duration = resolve(plugin_module, model)
+
+    resources = {(res.id.entity_type, getattr(res, "project", None), res.id.name): res for res in model.values()}
+    fip = resources[("openstack::FloatingIP", "tenant_42", "fip_1")]
+    assert fip.requires == {resources[("openstack::Network", "admin", "external")],
+                            resources[("openstack::HostPort", "tenant_42", "port_1")],
+                            resources[("openstack::Router", "tenant_42", "router")]}
+
+    port = resources[("openstack::HostPort", "tenant_7", "port_2")]
+    assert port.requires == {resources[("openstack::Project", None, "tenant_7")],
+                             resources[("openstack::Subnet", "tenant_7", "subnet")],
+                             resources[("openstack::VirtualMachine", "tenant_7", "vm_2")]}
+
+    role = resources[("openstack::Role", "tenant_3", "role_3")]
+    assert role.requires == {resources[("openstack::Project", None, "tenant_3")],
+                             resources[("openstack::User", None, "user_3")]}
+
+    # resolution has to stay linear in the size of the model
+    small = resolve(plugin_module, make_model(500))
+    assert duration < 10, "Resolving the dependencies of 100k resources took %.2fs" % duration
+    assert duration < 30 * max(small, 0.01), "Resolving 10x more resources took %.2fs instead of %.2fs" % (duration, small)
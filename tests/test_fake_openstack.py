@@ -0,0 +1,84 @@
+"""
+    Copyright 2017 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+from concurrent import futures
+
+import pytest
+
+from neutronclient.common import exceptions
+
+
+def test_seed(fake_os, neutron, nova):
+    seeded = fake_os.seed(servers=1000, ports=500, networks=2, prefix="test-seed")
+    try:
+        assert len(nova.servers.list(search_opts={"name": "^test-seed-vm-"})) == 1000
+
+        ports = neutron.list_ports(network_id=seeded["networks"][0])["ports"]
+        assert len(ports) == 750
+        assert len(neutron.list_ports(device_id=seeded["servers"][:10])["ports"]) == 10
+    finally:
+        fake_os.reset()
+
+
+def test_fault_injection(fake_os, neutron):
+    fake_os.add_error(503, service="network", method="GET", count=1)
+    with pytest.raises(exceptions.ServiceUnavailable):
+        neutron.list_networks()
+
+    neutron.list_networks()
+
+    fake_os.set_rate_limit(1, burst=1, service="network")
+    neutron.list_networks()
+    with pytest.raises(exceptions.NeutronClientException) as e:
+        neutron.list_networks()
+
+    assert e.value.status_code == 429
+    assert [call.status for call in fake_os.calls if call.service == "network"] == [503, 200, 200, 429]
+
+
+
+def test_concurrency_limit(fake_os, neutron):
+    fake_os.add_latency(0.2, service="network")
+    fake_os.set_concurrency_limit(1, service="network")
+
+    def list_networks(_):
+        try:
+            neutron.list_networks()
+            return 200
+        except exceptions.ServiceUnavailable:
+            return 503
+
+    with futures.ThreadPoolExecutor(max_workers=2) as executor:
+        assert sorted(executor.map(list_networks, range(2))) == [200, 503]
+
+
+def test_max_limit(fake_os, neutron, nova):
+    fake_os.set_max_limit(2)
+    for i in range(5):
+        neutron.create_network({"network": {"name": "test-max-limit-%d" % i}})
+
+    try:
+        # lists are split in pages like the real APIs, the clients follow the next links when asked to
+        fake_os.clear_calls()
+        assert len([n for n in neutron.list_networks()["networks"] if n["name"].startswith("test-max-limit-")]) == 5
+        assert len([call for call in fake_os.calls if call.service == "network"]) >= 3
+
+        fake_os.seed(servers=5, networks=1, prefix="test-max-limit")
+        assert len(nova.servers.list(search_opts={"name": "^test-max-limit-vm-"})) == 2
+        assert len(nova.servers.list(search_opts={"name": "^test-max-limit-vm-"}, limit=-1)) == 5
+    finally:
+        fake_os.reset()
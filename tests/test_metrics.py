@@ -0,0 +1,88 @@
+"""
+    Copyright 2017 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+import importlib
+import json
+
+import inmanta
+
+MODEL = """
+import unittest
+import openstack
+
+tenant = std::get_env("OS_PROJECT_NAME")
+p = openstack::Provider(name="test", connection_url=std::get_env("OS_AUTH_URL"), username=std::get_env("OS_USERNAME"),
+                        password=std::get_env("OS_PASSWORD"), tenant=tenant)
+project = openstack::Project(provider=p, name=tenant, description="", enabled=true, managed=false)
+openstack::Network(provider=p, project=project, name="metrics_net", purged=%(purged)s)
+"""
+
+
+def test_api_metrics(project, fake_os, monkeypatch, tmpdir):
+    metrics_file = str(tmpdir.join("openstack.prom"))
+    project.compile(MODEL % {"purged": "false"})
+    monkeypatch.setattr(importlib.import_module("inmanta_plugins.openstack"), "METRICS_FILE", metrics_file)
+
+    net = project.get_resource("openstack::Network", name="metrics_net")
+    fake_os.add_error(500, service="network", method="GET", count=1)
+    ctx = project.deploy(net)
+    assert ctx.status == inmanta.const.ResourceState.failed
+
+    ctx = project.deploy(net)
+    assert ctx.status == inmanta.const.ResourceState.deployed
+    assert any(l._data["msg"].startswith("Made") and "operations" in l._data["kwargs"] for l in ctx.logs)
+
+    with open(metrics_file, "r") as fd:
+        metrics = fd.read()
+
+    labels = 'provider="test",resource_type="openstack::Network",phase="%s",service="network",operation="%s"'
+    read = labels % ("read_resource", "GET /network/v2.0/networks")
+    create = labels % ("create_resource", "POST /network/v2.0/networks")
+    assert 'openstack_api_requests_total{%s,status="500"} 1' % read in metrics
+    assert 'openstack_api_requests_total{%s,status="201"} 1' % create in metrics
+    assert "openstack_api_request_duration_seconds_count{%s} 1" % create in metrics
+
+    project.compile(MODEL % {"purged": "true"})
+    ctx = project.deploy(project.get_resource("openstack::Network", name="metrics_net"))
+    assert ctx.status == inmanta.const.ResourceState.deployed
+
+
+def test_trace(project, fake_os, monkeypatch, tmpdir):
+    trace_file = str(tmpdir.join("trace.json"))
+    project.compile(MODEL % {"purged": "false"})
+    monkeypatch.setattr(importlib.import_module("inmanta_plugins.openstack"), "TRACE_FILE", trace_file)
+
+    net = project.get_resource("openstack::Network", name="metrics_net")
+    fake_os.clear_calls()
+    ctx = project.deploy(net)
+    assert ctx.status == inmanta.const.ResourceState.deployed
+
+    # the array of events is left open
+    with open(trace_file, "r") as fd:
+        events = json.loads(fd.read().rstrip().rstrip(",") + "]")
+
+    spans = [event for event in events if event["ph"] == "X"]
+    assert {"execute", "pre", "read_resource", "create_resource", "post"} <= {span["name"] for span in spans}
+    assert all(span["args"]["resource_id"] == str(net.id) for span in spans)
+
+    requests = [span for span in spans if span["cat"] == "http"]
+    assert "POST /network/v2.0/networks" in [span["name"] for span in requests]
+    assert {span["args"]["request_id"] for span in requests} <= {call.request_id for call in fake_os.calls}
+
+    project.compile(MODEL % {"purged": "true"})
+    ctx = project.deploy(project.get_resource("openstack::Network", name="metrics_net"))
+    assert ctx.status == inmanta.const.ResourceState.deployed
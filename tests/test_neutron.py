@@ -15,6 +15,8 @@
 
     Contact: code@inmanta.com
 """
+import importlib
+
 import inmanta
 
 
@@ -125,6 +127,41 @@ def test_subnet(project, neutron):
                 neutron.delete_network(network["id"])
 
 
+def test_subnet_inventory(project, neutron):
+    name = "inmanta_unit_test_inventory"
+    try:
+        project.compile("""
+    import unittest
+    import openstack
+
+    tenant = std::get_env("OS_PROJECT_NAME")
+    p = openstack::Provider(name="test", connection_url=std::get_env("OS_AUTH_URL"), username=std::get_env("OS_USERNAME"),
+                            password=std::get_env("OS_PASSWORD"), tenant=tenant, use_inventory=true)
+    project = openstack::Project(provider=p, name=tenant, description="", enabled=true, managed=false)
+    n = openstack::Network(provider=p, name="%(name)s", project=project)
+    subnet = openstack::Subnet(provider=p, project=project, network=n, dhcp=true, name="%(name)s",
+                               network_address="10.255.254.0/24")
+            """ % {"name": name})
+
+        net = project.deploy_resource("openstack::Network")
+        subnet = project.deploy_resource("openstack::Subnet")
+
+        assert len(neutron.list_subnets(name=subnet.name)["subnets"]) == 1
+        assert len(neutron.list_networks(name=net.name)["networks"]) == 1
+
+        # a second deploy is served from the inventory and should not change anything
+        ctx = project.deploy(project.get_resource("openstack::Subnet"))
+        assert ctx.status == inmanta.const.ResourceState.deployed
+        assert len(ctx.changes) == 0
+
+    finally:
+        for subnet in neutron.list_subnets(name=name)["subnets"]:
+            neutron.delete_subnet(subnet["id"])
+
+        for network in neutron.list_networks(name=name)["networks"]:
+            neutron.delete_network(network["id"])
+
+
 def test_router(project, neutron):
     name = "inmanta_unit_test"
 
@@ -334,6 +371,12 @@ openstack::IPrule(group=sg_base, direction="ingress", ip_protocol="tcp", port_mi
     assert len(sgs["security_groups"]) == 1
     assert len([x for x in sgs["security_groups"][0]["security_group_rules"] if x["ethertype"] == "IPv4"]) == 3
 
+    # the digest of the synced rules is stored in the description, an unchanged group is not updated again
+    assert sgs["security_groups"][0]["description"].startswith("Clearwater base [rules ")
+    ctx = project.deploy(project.get_resource("openstack::SecurityGroup"))
+    assert ctx.status == inmanta.const.ResourceState.deployed
+    assert len(ctx.changes) == 0
+
     # purge it
     project.compile("""
 import unittest
@@ -355,6 +398,96 @@ openstack::IPrule(group=sg_base, direction="ingress", ip_protocol="udp", port_mi
     assert len(sgs["security_groups"]) == 0
 
 
+def test_security_group_cross_reference(project, neutron):
+    """
+        A rule of which the remote group does not exist yet is created by a later deploy
+    """
+    names = ["inmanta_unit_test_ref_a", "inmanta_unit_test_ref_b"]
+    for name in names:
+        for sg in neutron.list_security_groups(name=name)["security_groups"]:
+            neutron.delete_security_group(sg["id"])
+
+    project.compile("""
+import unittest
+import openstack
+
+tenant = std::get_env("OS_PROJECT_NAME")
+p = openstack::Provider(name="test", connection_url=std::get_env("OS_AUTH_URL"), username=std::get_env("OS_USERNAME"),
+                        password=std::get_env("OS_PASSWORD"), tenant=tenant)
+project = openstack::Project(provider=p, name=tenant, description="", enabled=true, managed=false)
+
+sg_a = openstack::SecurityGroup(provider=p, project=project, name="%(a)s", description="a")
+sg_b = openstack::SecurityGroup(provider=p, project=project, name="%(b)s", description="b")
+openstack::GroupRule(group=sg_a, direction="ingress", ip_protocol="tcp", port_min=22, port_max=22, remote_group=sg_b)
+openstack::GroupRule(group=sg_b, direction="ingress", ip_protocol="tcp", port_min=22, port_max=22, remote_group=sg_a)
+        """ % {"a": names[0], "b": names[1]})
+
+    def rules(name):
+        sgs = neutron.list_security_groups(name=name)["security_groups"]
+        assert len(sgs) == 1
+        return [x for x in sgs[0]["security_group_rules"] if x["ethertype"] == "IPv4"]
+
+    # the rule of a is skipped because b does not exist yet, the rule of b is created
+    for name in names:
+        ctx = project.deploy(project.get_resource("openstack::SecurityGroup", name=name))
+        assert ctx.status == inmanta.const.ResourceState.deployed
+
+    assert len(rules(names[0])) == 0
+    assert len(rules(names[1])) == 1
+
+    # no digest was stored for a, so the next deploy creates the skipped rule
+    ctx = project.deploy(project.get_resource("openstack::SecurityGroup", name=names[0]))
+    assert ctx.status == inmanta.const.ResourceState.deployed
+    assert "rules" in ctx.changes
+    assert len(rules(names[0])) == 1
+
+    ctx = project.deploy(project.get_resource("openstack::SecurityGroup", name=names[0]))
+    assert len(ctx.changes) == 0
+
+    for name in names:
+        for sg in neutron.list_security_groups(name=name)["security_groups"]:
+            neutron.delete_security_group(sg["id"])
+
+
+def test_security_group_revision(project, fake_os, neutron):
+    """
+        A group of which the revision does not match the stored digest is compared on its rules and not updated again
+    """
+    name = "inmanta_unit_test_revision"
+    project.compile("""
+import unittest
+import openstack
+
+tenant = std::get_env("OS_PROJECT_NAME")
+p = openstack::Provider(name="test", connection_url=std::get_env("OS_AUTH_URL"), username=std::get_env("OS_USERNAME"),
+                        password=std::get_env("OS_PASSWORD"), tenant=tenant)
+project = openstack::Project(provider=p, name=tenant, description="", enabled=true, managed=false)
+
+sg = openstack::SecurityGroup(provider=p, project=project, name="%(name)s", description="revision")
+openstack::IPrule(group=sg, direction="ingress", ip_protocol="tcp", port=22, remote_prefix="0.0.0.0/0")
+        """ % {"name": name})
+
+    # every change bumps the revision by two, so the revision stored with the digest is never the actual one
+    fake_os.set_revision_step(2)
+    ctx = project.deploy(project.get_resource("openstack::SecurityGroup"))
+    assert ctx.status == inmanta.const.ResourceState.deployed
+
+    ctx = project.deploy(project.get_resource("openstack::SecurityGroup"))
+    assert ctx.status == inmanta.const.ResourceState.deployed
+    assert len(ctx.changes) == 0
+
+    # another writer changes the group
+    fake_os.set_revision_step(1)
+    sg = neutron.list_security_groups(name=name)["security_groups"][0]
+    neutron.update_security_group(sg["id"], {"security_group": {"name": name}})
+
+    ctx = project.deploy(project.get_resource("openstack::SecurityGroup"))
+    assert ctx.status == inmanta.const.ResourceState.deployed
+    assert len(ctx.changes) == 0
+
+    neutron.delete_security_group(sg["id"])
+
+
 def test_security_group_vm(project, neutron, nova):
     name = "inmanta-unit-test"
     key = ("ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAAAgQCsiYV4Cr2lD56bkVabAs2i0WyGSjJbuNHP6IDf8Ru3Pg7DJkz0JaBmETHNjIs+yQ98DNkwH9gZX0"
@@ -420,3 +553,68 @@ vm2.vm.security_groups=[sg_mgmt]
     hp1 = project.get_resource("openstack::HostPort", name=name + "-2_eth0")
     ctx = project.deploy(hp1)
     assert ctx.status == inmanta.const.ResourceState.deployed
+
+
+def test_drift_scan(project, neutron):
+    name = "inmanta_unit_test_drift"
+    project.compile("""
+import unittest
+import openstack
+
+tenant = std::get_env("OS_PROJECT_NAME")
+p = openstack::Provider(name="test", connection_url=std::get_env("OS_AUTH_URL"), username=std::get_env("OS_USERNAME"),
+                        password=std::get_env("OS_PASSWORD"), tenant=tenant)
+project = openstack::Project(provider=p, name=tenant, description="", enabled=true, managed=false)
+n = openstack::Network(provider=p, name="%(name)s", project=project)
+        """ % {"name": name})
+
+    assert len(neutron.list_networks(name=name)["networks"]) == 0
+
+    plugin_module = importlib.import_module("inmanta_plugins.openstack")
+    report = plugin_module.drift_scan([project.get_resource("openstack::Network", name=name)])
+
+    assert report["summary"] == {"total": 1, "drift": 1}
+    assert "purged" in report["resources"][0]["changes"]
+
+
+def test_drift_scan_handlers(project, fake_os):
+    """
+        The scan builds the handlers itself and does not change the resources it scans
+    """
+    name = "inmanta_unit_test_scan"
+    project.compile("""
+import unittest
+import openstack
+
+tenant = std::get_env("OS_PROJECT_NAME")
+p = openstack::Provider(name="test", connection_url=std::get_env("OS_AUTH_URL"), username=std::get_env("OS_USERNAME"),
+                        password=std::get_env("OS_PASSWORD"), tenant=tenant)
+project = openstack::Project(provider=p, name=tenant, description="", enabled=true, managed=false)
+n1 = openstack::Network(provider=p, name="%(name)s_1", project=project)
+n2 = openstack::Network(provider=p, name="%(name)s_2", project=project)
+        """ % {"name": name})
+
+    n1 = project.get_resource("openstack::Network", name=name + "_1")
+    n2 = project.get_resource("openstack::Network", name=name + "_2")
+    ctx = project.deploy(n1)
+    assert ctx.status == inmanta.const.ResourceState.deployed
+
+    plugin_module = importlib.import_module("inmanta_plugins.openstack")
+    report = plugin_module.drift_scan([n1, n2])
+
+    assert report["summary"] == {"total": 2, "in_sync": 1, "drift": 1}
+    assert [r["status"] for r in report["resources"]] == ["in_sync", "drift"]
+    assert not n1.use_inventory and not n2.use_inventory
+
+    project.compile("""
+import unittest
+import openstack
+
+tenant = std::get_env("OS_PROJECT_NAME")
+p = openstack::Provider(name="test", connection_url=std::get_env("OS_AUTH_URL"), username=std::get_env("OS_USERNAME"),
+                        password=std::get_env("OS_PASSWORD"), tenant=tenant)
+project = openstack::Project(provider=p, name=tenant, description="", enabled=true, managed=false)
+n1 = openstack::Network(provider=p, name="%(name)s_1", project=project, purged=true)
+        """ % {"name": name})
+    ctx = project.deploy(project.get_resource("openstack::Network", name=name + "_1"))
+    assert ctx.status == inmanta.const.ResourceState.deployed
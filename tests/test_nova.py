@@ -16,6 +16,7 @@
     Contact: code@inmanta.com
 """
 import time
+from concurrent import futures
 
 import inmanta
 
@@ -145,3 +146,76 @@ vm = openstack::Host(provider=p, project=project, key_pair=key, name="%(name)s",
     if len(networks) > 0:
         for network in networks:
             neutron.delete_network(network["id"])
+
+
+def test_find_image_offline(project, tmpdir, monkeypatch):
+    monkeypatch.setenv("INMANTA_OPENSTACK_CATALOG_DIR", str(tmpdir))
+    model = """
+import unittest
+import openstack
+
+os = std::OS(name="cirros", version="0.3", family=std::linux)
+
+p = openstack::Provider(name="test", connection_url=std::get_env("OS_AUTH_URL"), username=std::get_env("OS_USERNAME"),
+                        password=%(password)s, tenant=std::get_env("OS_PROJECT_NAME"), catalog_offline=%(offline)s)
+image = openstack::find_image(p, os)
+flavor = openstack::find_flavor(p, 1, 0.5)
+"""
+
+    # the first compile stores the catalog on disk
+    project.compile(model % {"password": 'std::get_env("OS_PASSWORD")', "offline": "false"})
+    assert len(tmpdir.listdir()) == 1
+
+    # an offline compile uses the stored catalog and never authenticates
+    project.compile(model % {"password": '"wrong"', "offline": "true"})
+
+
+def test_catalog_loaded_on_first_use(project, fake_os, tmpdir, monkeypatch):
+    monkeypatch.setenv("INMANTA_OPENSTACK_CATALOG_DIR", str(tmpdir))
+    project.compile("""
+import unittest
+import openstack
+
+p = openstack::Provider(name="lazy_catalog", connection_url=std::get_env("OS_AUTH_URL"),
+                        username=std::get_env("OS_USERNAME"), password=std::get_env("OS_PASSWORD"),
+                        tenant=std::get_env("OS_PROJECT_NAME"))
+""")
+
+    # a model that never looks up an image or a flavor does not fetch the catalog
+    assert [call for call in fake_os.calls if "/flavors" in call.path or "/images" in call.path] == []
+    assert len(tmpdir.listdir()) == 0
+
+
+def test_wait_manager(plugin_module, fake_os, nova, neutron):
+    network = neutron.create_network({"network": {"name": "test-wait-manager"}})["network"]
+    port = neutron.create_port({"port": {"network_id": network["id"], "device_id": "busy"}})["port"]
+    try:
+        manager = plugin_module.WaitManager(nova, neutron, plugin_module.ServerIndex())
+        fake_os.clear_calls()
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            busy = executor.submit(manager.wait_for_ports_deleted, "busy", 1.5)
+            assert manager.wait_for_ports_deleted("gone", 5)
+            assert not busy.result()
+
+        # the ports are only polled when a waiter is due, and polling stops when no waiters are left
+        polls = len([call for call in fake_os.calls if call.path.endswith("/ports")])
+        assert 1 <= polls <= 4
+        time.sleep(2)
+        assert len([call for call in fake_os.calls if call.path.endswith("/ports")]) == polls
+    finally:
+        neutron.delete_port(port["id"])
+        neutron.delete_network(network["id"])
+
+
+def test_server_index_pages(plugin_module, fake_os, nova):
+    fake_os.set_max_limit(3)
+    try:
+        fake_os.seed(servers=7, networks=1, prefix="test-index")
+        index = plugin_module.ServerIndex()
+        assert all(len(index.find(nova, name="test-index-vm-%d" % i)) == 1 for i in range(7))
+
+        # a burst of changes that does not fit in one page is not truncated either
+        fake_os.seed(servers=5, networks=1, prefix="test-index-burst")
+        assert all(len(index.find(nova, name="test-index-burst-vm-%d" % i, max_age=0)) == 1 for i in range(5))
+    finally:
+        fake_os.reset()
@@ -0,0 +1,102 @@
+"""
+    Copyright 2017 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+import inmanta
+import novaclient.exceptions
+import pytest
+
+from keystoneauth1.exceptions import ConnectFailure
+from neutronclient.common import exceptions
+
+MODEL = """
+import unittest
+import openstack
+
+tenant = std::get_env("OS_PROJECT_NAME")
+p = openstack::Provider(name="test", connection_url=std::get_env("OS_AUTH_URL"), username=std::get_env("OS_USERNAME"),
+                        password=std::get_env("OS_PASSWORD"), tenant=tenant, retry_base_delay=0.05, retry_max_delay=0.2)
+project = openstack::Project(provider=p, name=tenant, description="", enabled=true, managed=false)
+
+sg = openstack::SecurityGroup(provider=p, project=project, name="retry_sg", description="", purged=%(purged)s)
+openstack::IPrule(group=sg, direction="ingress", ip_protocol="tcp", port=22, remote_prefix="0.0.0.0/0")
+openstack::IPrule(group=sg, direction="ingress", ip_protocol="tcp", port=80, remote_prefix="0.0.0.0/0")
+"""
+
+
+def test_classify_error(plugin_module):
+    assert plugin_module.classify_error(ConnectFailure()) == "retryable"
+    assert plugin_module.classify_error(exceptions.ServiceUnavailable()) == "throttled"
+    assert plugin_module.classify_error(exceptions.Conflict()) == "conflict"
+    assert plugin_module.classify_error(novaclient.exceptions.Conflict(409)) == "conflict"
+    assert plugin_module.classify_error(exceptions.BadRequest()) == "fatal"
+    assert plugin_module.classify_error(ValueError()) == "fatal"
+
+
+def test_retry_policy(plugin_module):
+    policy = plugin_module.RetryPolicy(attempts=3, base_delay=0.01, max_delay=0.01)
+    errors = [exceptions.Conflict(), ConnectFailure()]
+
+    def call():
+        if len(errors) > 0:
+            raise errors.pop(0)
+        return "done"
+
+    assert policy.call("test", call, conflicts=True) == "done"
+
+    # conflicts are fatal unless the caller expects them to resolve
+    errors = [exceptions.Conflict()]
+    with pytest.raises(exceptions.Conflict):
+        policy.call("test", call)
+
+    errors = [ConnectFailure()] * 3
+    with pytest.raises(ConnectFailure):
+        policy.call("test", call)
+
+    # throttled requests are retried by the HTTP adapter of the session, not again by the policy
+    errors = [exceptions.ServiceUnavailable()]
+    with pytest.raises(exceptions.ServiceUnavailable):
+        policy.call("test", call)
+
+    # a call that is not idempotent may have succeeded when the connection failed, so it is only retried on conflicts
+    errors = [ConnectFailure()]
+    with pytest.raises(ConnectFailure):
+        policy.call("test", call, conflicts=True, idempotent=False)
+
+    errors = [exceptions.Conflict()]
+    assert policy.call("test", call, conflicts=True, idempotent=False) == "done"
+
+
+def test_security_group_conflicts(project, fake_os, neutron):
+    project.compile(MODEL % {"purged": "false"})
+
+    # a rule of the bulk request already exists
+    fake_os.add_error(409, service="network", method="POST", path="security-group-rules$", count=1)
+    ctx = project.deploy(project.get_resource("openstack::SecurityGroup", name="retry_sg"))
+    assert ctx.status == inmanta.const.ResourceState.deployed
+
+    sgs = neutron.list_security_groups(name="retry_sg")["security_groups"]
+    assert len([rule for rule in sgs[0]["security_group_rules"] if rule["direction"] == "ingress"]) == 2
+
+    # the group is still in use while ports detach
+    project.compile(MODEL % {"purged": "true"})
+    fake_os.add_error(409, service="network", method="DELETE", path="security-groups/", count=2)
+    ctx = project.deploy(project.get_resource("openstack::SecurityGroup", name="retry_sg"))
+    assert ctx.status == inmanta.const.ResourceState.deployed
+
+    assert len(neutron.list_security_groups(name="retry_sg")["security_groups"]) == 0
+    assert [call.status for call in fake_os.calls if call.method == "DELETE" and "security-groups/" in call.path] == \
+        [409, 409, 204]
@@ -0,0 +1,73 @@
+"""
+    Copyright 2017 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+import os
+from concurrent import futures
+
+from neutronclient.neutron import client as neutron_client
+
+
+def list_networks(plugin_module, fake_os, count, workers, **options):
+    """
+        List the networks count times from workers threads through a new provider session with the given options and
+        return the statuses of the calls the fake received and the limiter of the session
+    """
+    plugin_module.SESSIONS.clear()
+    sess = plugin_module.get_provider_session(os.environ["OS_AUTH_URL"], os.environ["OS_PROJECT_NAME"],
+                                              os.environ["OS_USERNAME"], os.environ["OS_PASSWORD"],
+                                              dict(options, token_cache=False))
+    neutron = neutron_client.Client("2.0", session=sess)
+    neutron.list_networks()
+
+    fake_os.clear_calls()
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda _: neutron.list_networks(), range(count)))
+
+    statuses = [call.status for call in fake_os.calls if call.service == "network"]
+    return statuses, sess.session.get_adapter(os.environ["OS_AUTH_URL"])._limiter
+
+
+def test_adaptive_concurrency(plugin_module, fake_os):
+    fake_os.add_latency(0.05, service="network")
+    fake_os.set_concurrency_limit(4, service="network")
+
+    statuses, limiter = list_networks(plugin_module, fake_os, 60, 20, max_inflight=20)
+    assert statuses.count(200) == 60
+    # the window shrinks to what the fake can handle instead of retrying every request that was throttled
+    assert statuses.count(503) < 30
+    assert limiter.window < 20
+
+
+def test_rate_limit(plugin_module, fake_os):
+    fake_os.set_rate_limit(20, burst=5, service="network")
+
+    statuses, _ = list_networks(plugin_module, fake_os, 40, 10, rate_limit=20, rate_burst=5)
+    assert statuses.count(200) == 40
+    assert 429 not in statuses
+
+
+def test_session_per_password(plugin_module):
+    plugin_module.SESSIONS.clear()
+    url = os.environ["OS_AUTH_URL"]
+    first = plugin_module.get_provider_session(url, "project", "user", "secret-1", {"token_cache": False})
+    assert plugin_module.get_provider_session(url, "project", "user", "secret-1", {"token_cache": False}) is first
+
+    # a new password replaces the sessions of the old one, and passwords are not kept in the keys
+    second = plugin_module.get_provider_session(url, "project", "user", "secret-2", {"token_cache": False})
+    assert second is not first
+    assert list(plugin_module.SESSIONS.values()) == [second]
+    assert all("secret-2" not in key for key in plugin_module.SESSIONS)